@@ -1,34 +1,41 @@
-import numpy as np
 import subprocess
 import sys
-import yaml
-import yt
 import os
+import shutil
 import logging
-import jinja2
-from yt.analysis_modules.halo_analysis.api import HaloCatalog
-import matplotlib
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
-
-MPI_CORE = 32
+import templating
+import workflow_cache
+import workflow_profile
+import workflow_config
+import parameter_files
+import jobqueue
+
+MPI_CORE = min(32, len(jobqueue.node_cpus()))
+MUSIC_THREADS = 8
+GB = 1024**3
 MUSIC_CONFIG = "init.music"
 ENZO_CONFIG  = "music_input.enzo"
+REQUIRED_SECTIONS = ("run_directory", "executables", "music_configs")
 
 class EnzoWorkFlow:
     def __init__(self, config_file):
+        # configured before the config is parsed so nothing is lost
+        workflow_profile.setup_logging()
         self.config = self.parse_config(config_file)
-        templateLoader = jinja2.FileSystemLoader(searchpath='./templates')
-        self.templateEnv = jinja2.Environment(loader=templateLoader)
         self.test_dir = self.config["run_directory"]
-        #logging.basicConfig(filename="logWorkFlow.log", level=logging.DEBUG)
-        logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p', filename='logWorkFlow.log')
+        # MUSIC runs here and leaves its config, log and power spectrum here
+        self.work_dir = "."
+        self.final_redshift = (self.config.get("enzo_configs") or {}).get("FinalRedshift", 18)
+
+    @property
+    def templateEnv(self):
+        # jinja2 is only imported by the stages that render templates
+        return templating.get_environment('./templates')
 
     def parse_config(self, config_file):
+        """the validated config, see workflow_config.py"""
         logging.info("Parsing Config File = {}".format(config_file))
-        stream = open(config_file, 'r')
-        data = yaml.load(stream, Loader=yaml.FullLoader)
-        return data
+        return workflow_config.load_config(config_file, require=REQUIRED_SECTIONS)
 
     def write_music_configs(self):
         config = self.config["music_configs"]
@@ -38,61 +45,81 @@ class EnzoWorkFlow:
         else:
             self.baryons = True
         logging.info("Write Music configurations = {}".format(config))
-        with open(MUSIC_CONFIG, 'w') as f:
-            for k, v in config.items():
-                f.write("[{}]\n".format(k))
-                for param, val in  v.items():
-                    f.write("{0:10} = {1}\n".format(param, val))
-            f.write( "filename = {0}".format(self.test_dir))
-
-    def run_subprocess(self, commands, outfile=None):
-        p = subprocess.run(commands, check=True, stdout=subprocess.PIPE,
-                           universal_newlines=True)
+        parameter_files.write_music_config(config, os.path.join(self.work_dir, MUSIC_CONFIG),
+                                           os.path.relpath(self.test_dir, self.work_dir))
+
+    def run_subprocess(self, commands, outfile=None, cwd=None, cpus=1, threads=None, memory=0):
+        """run `commands` once the node's job queue grants it `cpus` cpus
+        and `memory` bytes, pinned to those cpus"""
+        name = os.path.basename(str(commands[0]))
+        with jobqueue.reserve(cpus, memory, name=name) as reserved:
+            command, env = jobqueue.pinned(commands, reserved, threads)
+            _, out = workflow_profile.run_command(command, cwd=cwd, env=env, name=name)
         if outfile:
             with open(outfile, 'w') as f:
-                f.write(p.stdout)
+                f.write(out)
+
+    def resources(self):
+        """the optional `resources` section of the config
+
+            resources:
+              music_threads: 8
+              music_memory_gb: 16
+              enzo_memory_gb: 64
+        """
+        return self.config.get("resources") or {}
 
     def run_music(self):
         config = self.config
-        music  = config["executables"]["music"]
-        music_configs = self.write_music_configs()
-        self.run_subprocess(["./"+music, MUSIC_CONFIG],
-                            "run_music.out")
+        music  = os.path.abspath(config["executables"]["music"])
+        self.write_music_configs()
+        threads = self.resources().get("music_threads", MUSIC_THREADS)
+        self.run_subprocess([music, MUSIC_CONFIG],
+                            os.path.join(self.work_dir, "run_music.out"),
+                            cwd=self.work_dir, cpus=threads, threads=threads,
+                            memory=int(self.resources().get("music_memory_gb", 0) * GB))
         music_out = ["input_powerspec.txt", "{0}".format(MUSIC_CONFIG), "{0}_log.txt".format(MUSIC_CONFIG)]
-        self.run_subprocess(["mv", *music_out, self.test_dir])
+        for f in music_out:
+            shutil.move(os.path.join(self.work_dir, f), os.path.join(self.test_dir, f))
 
 
     def write_enzo_config(self):
+        """MUSIC's parameter_file.txt, the simulation template and the
+        final redshift, written once"""
         config = self.config
-        fenzo  = open(os.path.join(self.test_dir,ENZO_CONFIG), 'w')
-        fmusic = open(os.path.join(self.test_dir, "parameter_file.txt"), "r")
-
-        fenzo.write("# [Configurations from MUSIC]\n")
-        fenzo.write(fmusic.read())
+        params = parameter_files.EnzoParameters.read(
+            os.path.join(self.test_dir, "parameter_file.txt"), "Configurations from MUSIC")
 
         if self.baryons:
             enzo_baryon_templates = self.templateEnv.get_template( "enzo_baryons.template")
             out = enzo_baryon_templates.render(config["enzo_configs"])
         else:
-            enzo_dmonly = open("templates/enzo_dmonly.template")
-            out = enzo_dmonly.read()
-
-        fenzo.write("# [Enzo Simulation Configs]\n")
-        fenzo.write(out)
-
-        fenzo.close()
-        fmusic.close()
-
-        # specify the final redshift
-        os.system("sed -i 's/CosmologyFinalRedshift                   = 0/CosmologyFinalRedshift = 18/g' {}/{}".format(self.test_dir, "music_input.enzo"))
-
-    def run_enzo(self):
+            with open("templates/enzo_dmonly.template") as enzo_dmonly:
+                out = enzo_dmonly.read()
+        params.merge(parameter_files.EnzoParameters.parse(out, "Enzo Simulation Configs"))
+        params.update(parameter_files.enzo_parameters(config.get("enzo_configs")))
+        # set_resolution may have moved it away from the config's
+        params["CosmologyFinalRedshift"] = self.final_redshift
+        params.write(os.path.join(self.test_dir, ENZO_CONFIG))
+
+    def run_enzo(self, **kwargs):
+        import asyncio
+        import enzo_monitor
         self.write_enzo_config()
 
-        os.system("cp {} {}".format(self.config["executables"]["enzo"],
-                                    self.test_dir))
-        os.chdir(self.test_dir)
-        command = "mpirun -np {0} ./enzo -d {1} > enzo_run.out 2>&1".format(self.MPI_CORE, ENZO_CONFIG)
-        os.system(command)
-        os.chdir("../")
-
+        workflow_cache.share_file(self.config["executables"]["enzo"],
+                                  os.path.join(self.test_dir, "enzo"))
+        self.MPI_CORE, _ = jobqueue.fit_layout(self.MPI_CORE, 1)
+        command = ["mpirun", "-np", str(self.MPI_CORE), "./enzo", "-d", ENZO_CONFIG]
+        restart = lambda dump: ["mpirun", "-np", str(self.MPI_CORE), "./enzo", "-d", "-r", dump]
+        # crashes restart from the latest dump; an unchanged config is not
+        # rewritten, so a killed run resumes from its dumps, a changed one
+        # starts over
+        memory = int(self.resources().get("enzo_memory_gb", 0) * GB)
+        with jobqueue.reserve(self.MPI_CORE, memory, name=f"enzo {self.test_dir}") as cpus:
+            run = asyncio.run(enzo_monitor.run_with_restarts(
+                self.test_dir, command, restart,
+                parameter_file=os.path.join(self.test_dir, ENZO_CONFIG), cpus=cpus, **kwargs))
+        if run.preempted:
+            raise Exception(f"enzo run in {self.test_dir} was preempted")
+        return run.progress
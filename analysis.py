@@ -0,0 +1,255 @@
+"""Reductions over the outputs of finished runs, compared across runs.
+
+    python analysis.py cvode_run bechem_run [-j 8] [--plot compare.png]
+
+Every dataset listed in a run directory's `OutputLog` is reduced once to
+
+- mass weighted species fraction vs. density profiles (H2_1, H_m0, de),
+- a mass weighted temperature-density histogram,
+- max density, redshift and time,
+
+in a process pool over all outputs of all runs. Each output's summary is
+cached as `<run_dir>/analysis/<output>.npz` together with the output's
+path, mtime and the binning, so rerunning after one more run (or a rerun
+of a variant) only reduces what changed.
+
+`InflightAnalysis` does the same while enzo is still running: every dump
+is reduced as soon as enzo logs it in `OutputLog`, and the run can be
+stopped once a target (e.g. a max density) is reached.
+"""
+import os
+import sys
+import logging
+import asyncio
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import workflow_cache
+from enzo_monitor import parse_output_log
+
+ANALYSIS_DIR = "analysis"
+# bump when the reductions change, invalidates every cached summary
+REDUCTION_VERSION = 1
+SPECIES = ["H2_1", "H_m0", "de"]
+# enzo field names of a species with dengo, and their grackle counterparts
+SPECIES_FIELDS = {"H2_1": ["H2_1_Density", "H2_1Density", "H2I_Density"],
+                  "H_m0": ["H_m0_Density", "H_m0Density", "HM_Density"],
+                  "de":   ["de_Density", "deDensity", "Electron_Density"]}
+DENSITY_BINS     = np.linspace(-30.0, -5.0, 101)    # log10 g/cm^3
+TEMPERATURE_BINS = np.linspace(0.0, 5.0, 81)        # log10 K
+
+
+def run_outputs(run_dir):
+    """dataset paths of `run_dir` in the order enzo wrote them"""
+    output_log = os.path.join(run_dir, "OutputLog")
+    if not os.path.exists(output_log):
+        return []
+    with open(output_log) as f:
+        return [os.path.normpath(os.path.join(run_dir, name))
+                for name, _, _ in parse_output_log(f)]
+
+
+def summary_file(dataset):
+    run_dir = os.path.dirname(os.path.dirname(dataset))
+    return os.path.join(run_dir, ANALYSIS_DIR, os.path.basename(dataset) + ".npz")
+
+
+def summary_key(dataset):
+    """what a cached summary of `dataset` depends on"""
+    return workflow_cache.hash_config({"dataset": os.path.abspath(dataset),
+                                       "mtime": os.path.getmtime(dataset),
+                                       "version": REDUCTION_VERSION,
+                                       "species": SPECIES,
+                                       "density_bins": DENSITY_BINS.tolist(),
+                                       "temperature_bins": TEMPERATURE_BINS.tolist()})
+
+
+def species_field(ds, species):
+    """the on-disk field holding `species`' density, or None"""
+    fields = {f for _, f in ds.field_list}
+    for name in SPECIES_FIELDS[species]:
+        if name in fields:
+            return ("enzo", name)
+    return None
+
+
+def reduce_output(dataset):
+    """all reductions of one dataset, read chunk by chunk"""
+    import yt
+    ds = yt.load(dataset)
+    fields = {s: species_field(ds, s) for s in SPECIES}
+    nd, nt = len(DENSITY_BINS) - 1, len(TEMPERATURE_BINS) - 1
+
+    mass_in_bin = np.zeros(nd)
+    species_mass = {s: np.zeros(nd) for s in SPECIES if fields[s]}
+    phase = np.zeros((nd, nt))
+    max_density = 0.0
+    for chunk in ds.all_data().chunks([], "io"):
+        density = chunk["gas", "density"].in_units("g/cm**3").v
+        mass    = chunk["gas", "cell_mass"].in_units("Msun").v
+        logd    = np.log10(density)
+        logT    = np.log10(chunk["gas", "temperature"].in_units("K").v)
+        max_density = max(max_density, density.max())
+
+        mass_in_bin += np.histogram(logd, DENSITY_BINS, weights=mass)[0]
+        phase += np.histogram2d(logd, logT, [DENSITY_BINS, TEMPERATURE_BINS], weights=mass)[0]
+        for s in species_mass:
+            fraction = chunk[fields[s]].v / chunk["enzo", "Density"].v
+            species_mass[s] += np.histogram(logd, DENSITY_BINS, weights=mass*fraction)[0]
+
+    out = {"max_density": max_density,
+           "redshift": float(getattr(ds, "current_redshift", np.nan)),
+           "time": float(ds.current_time.in_units("yr")),
+           "mass_profile": mass_in_bin,
+           "temperature_density": phase}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for s, m in species_mass.items():
+            out[f"fraction_{s}"] = m / mass_in_bin
+    return out
+
+
+def summarize_output(dataset, force=False):
+    """the cached summary of `dataset`, reducing it on a miss"""
+    fname = summary_file(dataset)
+    key   = summary_key(dataset)
+    if not force and os.path.exists(fname):
+        with np.load(fname) as cached:
+            if str(cached["key"]) == key:
+                return {k: cached[k] for k in cached.files if k != "key"}
+    logging.info(f"Reducing {dataset}")
+    out = reduce_output(dataset)
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmp = fname + ".tmp.npz"
+    np.savez_compressed(tmp, key=key, **out)
+    os.replace(tmp, fname)
+    return {k: np.asarray(v) for k, v in out.items()}
+
+
+def analyze_runs(run_dirs, max_workers=None, force=False):
+    """{run_dir: {"outputs": [...], "summaries": [...], "max_density": ..., "redshift": ...}}"""
+    datasets = [(r, d) for r in run_dirs for d in run_outputs(r)]
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        summaries = list(pool.map(summarize_output, [d for _, d in datasets],
+                                  [force] * len(datasets)))
+    results = {r: {"outputs": [], "summaries": []} for r in run_dirs}
+    for (r, d), s in zip(datasets, summaries):
+        results[r]["outputs"].append(d)
+        results[r]["summaries"].append(s)
+    for r, res in results.items():
+        for k in ["max_density", "redshift", "time"]:
+            res[k] = np.array([float(s[k]) for s in res["summaries"]])
+    return results
+
+
+def reduce_and_check(dataset, stop_when=None):
+    """pool task of InflightAnalysis: the summary and the stop_when verdict"""
+    summary = summarize_output(dataset)
+    return summary, bool(stop_when(dataset, summary)) if stop_when else False
+
+
+class InflightAnalysis:
+    """reduce the dumps of a running EnzoRun in a bounded process pool
+
+    Parameters
+    ----------
+    max_workers  : int, size of the reduction pool
+    stop_density : float, optional, terminate the run once an output's max
+                   density reaches this [g/cm^3]
+    stop_when    : callable(dataset, summary) -> bool, optional, any other
+                   early stopping criterion, e.g. a halo mass check; runs in
+                   the pool, so it has to be a module level function
+    """
+    def __init__(self, max_workers=2, stop_density=None, stop_when=None):
+        self.max_workers  = max_workers
+        self.stop_density = stop_density
+        self.stop_when    = stop_when
+        self.summaries    = {}
+        self.stopped      = None
+        self._pending     = []
+
+    def target_reached(self, summary, stop):
+        if self.stop_density is not None and float(summary["max_density"]) >= self.stop_density:
+            return f"max density {float(summary['max_density']):.3e} >= {self.stop_density:.3e}"
+        if stop:
+            return f"{self.stop_when.__name__} reached"
+        return None
+
+    def on_output(self, run, entry):
+        """EnzoRun.on_output hook, runs in the event loop"""
+        dataset = os.path.normpath(os.path.join(run.run_dir, entry[0]))
+        loop    = asyncio.get_event_loop()
+        future  = loop.run_in_executor(self._pool, reduce_and_check, dataset, self.stop_when)
+        future.add_done_callback(lambda f: self.reduced(run, dataset, f))
+        self._pending.append(future)
+
+    def reduced(self, run, dataset, future):
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            logging.error(f"Reducing {dataset} failed: {future.exception()!r}")
+            return
+        summary, stop = future.result()
+        self.summaries[dataset] = summary
+        reason = self.target_reached(summary, stop)
+        if reason and self.stopped is None:
+            self.stopped = (dataset, reason)
+            logging.info(f"Stopping enzo run {run.name} early at {dataset}: {reason}")
+            run.stop()
+
+    async def watch(self, run):
+        """run `run` and reduce its outputs as they appear; the run's exit code"""
+        run.on_output = self.on_output
+        with ProcessPoolExecutor(max_workers=self.max_workers) as self._pool:
+            returncode = await run.run()
+            # dumps logged in the last cycles may still be in the pool
+            await asyncio.gather(*self._pending, return_exceptions=True)
+        return returncode
+
+
+def plot_comparison(results, filename):
+    """max density vs. redshift and the final species profiles of every run"""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    f, ax = plt.subplots(1, 1 + len(SPECIES), figsize=(4*(1 + len(SPECIES)), 3.5))
+    centers = 0.5*(DENSITY_BINS[1:] + DENSITY_BINS[:-1])
+    for run_dir, res in results.items():
+        if not res["summaries"]:
+            continue
+        label = os.path.basename(os.path.normpath(run_dir))
+        ax[0].semilogy(res["redshift"], res["max_density"], label=label)
+        last = res["summaries"][-1]
+        for a, s in zip(ax[1:], SPECIES):
+            if f"fraction_{s}" in last:
+                a.semilogy(centers, last[f"fraction_{s}"], label=label)
+    ax[0].set_xlabel("redshift")
+    ax[0].set_ylabel(r"max density [g/cm$^3$]")
+    ax[0].invert_xaxis()
+    ax[0].legend()
+    for a, s in zip(ax[1:], SPECIES):
+        a.set_xlabel(r"log density [g/cm$^3$]")
+        a.set_ylabel(f"{s} mass fraction")
+    f.tight_layout()
+    f.savefig(filename)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="reduce and compare the outputs of runs")
+    parser.add_argument("run_dirs", nargs="+")
+    parser.add_argument("-j", "--workers", type=int, default=None)
+    parser.add_argument("--force", action="store_true", help="ignore cached summaries")
+    parser.add_argument("--plot", default=None, help="write a comparison figure")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    results = analyze_runs(args.run_dirs, args.workers, args.force)
+    for run_dir, res in results.items():
+        print(f"{run_dir}: {len(res['outputs'])} outputs")
+        for d, z, rho in zip(res["outputs"], res["redshift"], res["max_density"]):
+            print("    {:30s} z = {:8.3f}  max density = {:.3e} g/cm^3".format(
+                os.path.basename(d), z, rho))
+    if args.plot:
+        plot_comparison(results, args.plot)
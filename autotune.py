@@ -0,0 +1,134 @@
+"""Pick omp_num_threads and the MPI rank count for this host from timings.
+
+    python autotune.py mynetwork --solver-option cv_omp [--cells 1e5]
+
+For every split of the local cores into `ranks x threads`, `ranks`
+concurrent solver processes with `threads` OpenMP threads each integrate
+their share of a synthetic cell batch (see solver_bench.py); the split
+with the highest aggregate cells/second wins. Results are recorded per
+host and solver option in the build cache, and workflow configs with
+`omp_num_threads: auto` reuse them instead of guessing.
+"""
+import os
+import json
+import socket
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import solver_bench
+import workflow_cache
+
+TUNING_FILE = os.path.join(workflow_cache.BUILD_CACHE, "omp_tuning.json")
+# records of an older version were timed with every thread count running the
+# first one's -DNTHREADS build, they are ignored
+TUNING_VERSION = 2
+
+
+def local_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def host_signature():
+    """hostname, core count and cpu model; a tuning is only valid for the same host"""
+    model = ""
+    if os.path.exists("/proc/cpuinfo"):
+        with open("/proc/cpuinfo") as f:
+            for l in f:
+                if l.startswith("model name"):
+                    model = l.split(":", 1)[1].strip()
+                    break
+    return f"{socket.gethostname()}|{local_cores()}|{model}"
+
+
+def candidate_layouts(cores):
+    """(mpi ranks, omp threads) splits that fill `cores` without oversubscribing"""
+    threads = sorted({t for t in [2**i for i in range(cores.bit_length())] + [cores]
+                      if t <= cores})
+    return [(cores // t, t) for t in threads]
+
+
+def load_tunings():
+    if not os.path.exists(TUNING_FILE):
+        return {}
+    with open(TUNING_FILE) as f:
+        return json.load(f)
+
+
+def tuned_layout(solver_option):
+    """the recorded best layout for this host, or None"""
+    record = load_tunings().get(host_signature(), {}).get(solver_option)
+    if record is None or record.get("version") != TUNING_VERSION:
+        return None
+    return record
+
+
+def record_layout(solver_option, record):
+    tunings = load_tunings()
+    tunings.setdefault(host_signature(), {})[solver_option] = record
+    os.makedirs(os.path.dirname(TUNING_FILE), exist_ok=True)
+    tmp = TUNING_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(tunings, f, indent=2, sort_keys=True)
+    os.replace(tmp, TUNING_FILE)
+
+
+def time_layout(build_dir, solver_name, ranks, threads, ncells, tf):
+    """run `ranks` concurrent workers with `threads` threads on ncells/ranks cells each"""
+    per_rank = max(1, ncells // ranks)
+    # compile the extension for this thread count once before timing
+    solver_bench.run_batch_subprocess(build_dir, solver_name, 16, threads, tf)
+    with ThreadPoolExecutor(max_workers=ranks) as pool:
+        results = list(pool.map(
+            lambda _: solver_bench.run_batch_subprocess(build_dir, solver_name, per_rank,
+                                                        threads, tf),
+            range(ranks)))
+    errors = [r["error"] for r in results if "error" in r]
+    if errors:
+        return {"mpi_ranks": ranks, "omp_num_threads": threads, "error": errors[0]}
+    wall = max(r["wall"] for r in results)
+    return {"mpi_ranks": ranks, "omp_num_threads": threads, "wall": wall,
+            "cells_per_second": per_rank * ranks / wall,
+            "failures": sum(r["failures"] for r in results)}
+
+
+def autotune(network, solver_option, solver_name="autotune", cores=None,
+             ncells=100000, tf=1e13, build_root="autotune_build"):
+    """time every layout on this host, record and return the fastest"""
+    cores = cores or local_cores()
+    build_dir = os.path.abspath(os.path.join(build_root, solver_option))
+    solver_bench.write_benchmark_solver(network, solver_option, solver_name, build_dir)
+
+    timings = []
+    for ranks, threads in candidate_layouts(cores):
+        t = time_layout(build_dir, solver_name, ranks, threads, ncells, tf)
+        logging.info(f"autotune {solver_option}: {t}")
+        timings.append(t)
+    valid = [t for t in timings if "error" not in t]
+    if not valid:
+        raise Exception(f"autotune: every layout failed for {solver_option}: {timings}")
+    best = max(valid, key=lambda t: t["cells_per_second"])
+    record = {"omp_num_threads": best["omp_num_threads"], "mpi_ranks": best["mpi_ranks"],
+              "version": TUNING_VERSION, "cores": cores, "ncells": ncells, "timings": timings}
+    record_layout(solver_option, record)
+    logging.info(f"autotune {solver_option}: best {best}")
+    return record
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="tune omp_num_threads / MPI ranks on this host")
+    parser.add_argument("network", nargs="?", default="mynetwork:setup_network")
+    parser.add_argument("--solver-option", nargs="+", default=["cv_omp"],
+                        choices=sorted(solver_bench.SOLVER_OPTIONS))
+    parser.add_argument("--cells", type=float, default=1e5)
+    parser.add_argument("--tf", type=float, default=1e13)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    network = solver_bench.load_network(args.network)
+    for option in args.solver_option:
+        record = autotune(network, option, ncells=int(args.cells), tf=args.tf)
+        print(f"{option}: omp_num_threads = {record['omp_num_threads']}, "
+              f"mpi ranks = {record['mpi_ranks']}")
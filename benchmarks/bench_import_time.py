@@ -0,0 +1,76 @@
+"""Startup cost of the workflow entry points.
+
+    python benchmarks/bench_import_time.py [--repeat 5] [--budget-ms 200]
+
+Imports every entry point in a fresh interpreter under `python -X
+importtime`, reports the import time on top of a bare interpreter and the
+slowest modules it pulled in, and exits non-zero when an entry point goes
+over the budget or imports one of the heavy packages (yt, matplotlib,
+dengo, ...) that are only meant to be loaded by the stages using them.
+"""
+import os
+import sys
+import argparse
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+ENTRY_POINTS = ["dengo-workflow", "EnzoWorkFlow", "centerhalo-workflow", "sweep-workflow",
+                "utilities", "autotune", "solver_bench", "workflow_profile"]
+# only imported inside the stages that need them
+HEAVY = ["yt", "matplotlib", "dengo", "h5py", "pytest", "pyximport", "sympy", "jinja2",
+         "numpy", "asyncio"]
+# the numerical drivers work on arrays from the start
+ALLOWED = {"centerhalo-workflow": ["numpy"], "solver_bench": ["numpy"], "autotune": ["numpy"]}
+
+
+def importtime(module):
+    """{imported module: (self us, cumulative us)} and the top level total in us"""
+    code = "import importlib; importlib.import_module(%r)" % module if module else "pass"
+    p = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=ROOT,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                       universal_newlines=True)
+    if p.returncode != 0:
+        raise Exception(f"importing {module} failed:\n{p.stderr}")
+    modules, total = {}, 0
+    for l in p.stderr.splitlines():
+        if not l.startswith("import time:") or "self [us]" in l:
+            continue
+        self_us, cumulative, name = l[len("import time:"):].split("|")
+        modules[name.strip()] = (int(self_us), int(cumulative))
+        if not name[1:].startswith(" "):
+            total += int(cumulative)
+    return modules, total
+
+
+def measure(module, repeat):
+    """best of `repeat` runs, the os/page cache makes the first one noisy"""
+    runs = [importtime(module) for _ in range(repeat)]
+    return min(runs, key=lambda r: r[1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="import time of the workflow entry points")
+    parser.add_argument("modules", nargs="*", default=ENTRY_POINTS)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=200.0,
+                        help="allowed import time on top of a bare interpreter")
+    parser.add_argument("--top", type=int, default=5, help="slowest imports to list")
+    args = parser.parse_args()
+
+    _, baseline = measure(None, args.repeat)
+    print(f"bare interpreter: {baseline/1e3:.1f} ms")
+    failed = False
+    for module in args.modules:
+        imported, total = measure(module, args.repeat)
+        cost  = (total - baseline) / 1e3
+        heavy = sorted(h for h in HEAVY
+                       if h in imported and h not in ALLOWED.get(module, []))
+        over  = cost > args.budget_ms
+        failed |= over or bool(heavy)
+        print(f"{module:22s} {cost:8.1f} ms {'OVER BUDGET' if over else ''}")
+        for name, (self_us, cum) in sorted(imported.items(), key=lambda m: -m[1][0])[:args.top]:
+            print(f"    {self_us/1e3:7.1f} ms  {name}")
+        if heavy:
+            print(f"    heavy imports at startup: {', '.join(heavy)}")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,55 @@
+"""Vectorized vs scalar primordial initial fractions.
+
+    python benchmarks/bench_initial_fraction.py [-n 100000]
+
+Draws random (Omega_b, Omega_m, h, z_start) combinations, computes the
+fractions once with a python loop over
+`EnzoChemistryInitialCondition.calculate_fraction` and once with
+`primordial_fractions`, checks both agree and prints the timings.
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from enzo_chemistry import EnzoChemistryInitialCondition, primordial_fractions, SPECIES
+
+
+def scalar_loop(Omega_b, Omega_m, h, z_start):
+    out = {s: np.empty(len(Omega_b)) for s in SPECIES}
+    for i in range(len(Omega_b)):
+        ic = EnzoChemistryInitialCondition(
+            cosmology={"Omega_b": Omega_b[i], "Omega_m": Omega_m[i], "H0": 100*h[i]},
+            zstart=z_start[i])
+        for s, v in ic.calculate_fraction().items():
+            out[s][i] = v
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=100000, help="number of combinations")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    Omega_b = rng.uniform(0.040, 0.050, args.n)
+    Omega_m = rng.uniform(0.25, 0.32, args.n)
+    h       = rng.uniform(0.65, 0.75, args.n)
+    z_start = rng.uniform(50, 200, args.n)
+
+    t0 = time.perf_counter()
+    ref = scalar_loop(Omega_b, Omega_m, h, z_start)
+    t_loop = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    vec = primordial_fractions(Omega_b, Omega_m, h, z_start=z_start)
+    t_vec = time.perf_counter() - t0
+
+    for s in SPECIES:
+        assert np.allclose(ref[s], vec[s], rtol=1e-12, atol=0), s
+    print(f"{args.n} combinations")
+    print(f"python loop : {t_loop:10.4f} s")
+    print(f"vectorized  : {t_vec:10.4f} s")
+    print(f"speedup     : {t_loop / t_vec:10.1f}x")
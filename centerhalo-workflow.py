@@ -1,16 +1,17 @@
 import numpy as np
 import subprocess
 import sys
-import yaml
-import yt
+import json
+import signal
+import argparse
 import os
 import logging
-import jinja2
-from yt.analysis_modules.halo_analysis.api import HaloCatalog
-import matplotlib
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
-from EnzoWorkFlow import EnzoWorkFlow
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from EnzoWorkFlow import EnzoWorkFlow, REQUIRED_SECTIONS
+import workflow_profile
+import workflow_config
+import run_registry
+from workflow_profile import TRACER
 
 
 class FindHaloWorkFlow(EnzoWorkFlow):
@@ -24,58 +25,76 @@ class FindHaloWorkFlow(EnzoWorkFlow):
         config = self.config["music_configs"]["setup"]
         config["ref_center"] = str(list(center))[1:-1]
 
-    def update_music_random_seed(self):
+    def set_resolution(self, levelmin, levelmax, final_redshift=None):
+        """lower the MUSIC levels (and stop earlier) for a cheap prescreen run"""
+        config = self.config["music_configs"]["setup"]
+        tf_offset = config["levelmin_TF"] - config["levelmin"]
+        config["levelmin"]    = levelmin
+        config["levelmin_TF"] = levelmin + max(0, tf_offset)
+        config["levelmax"]    = levelmax
+        if final_redshift is not None:
+            self.final_redshift = final_redshift
+
+    def update_music_random_seed(self, base_level=None):
+        """write seed[l] for every level from `base_level` (default levelmin)
+        up to levelmax
+
+        seed[l] only depends on random_seed, l and base_level, so runs that
+        share a base level get the same large-scale modes whatever their
+        levelmin/levelmax; use the lowest levelmin of all tiers.
+        """
         config = self.config["music_configs"]["setup"]
         print(config)
         lmin = config["levelmin"]
         lmax = config["levelmax"]
-        rand = np.random.randint(1e4,1e5,lmax-lmin+1)
+        if base_level is not None:
+            lmin = min(lmin, base_level)
+        rand = np.random.RandomState(self.random_seed).randint(1e4,1e5,lmax-lmin+1)
         seed_dict = {}
         for l, r in zip(range(lmin, lmax+1), rand):
-            seed_dict["seed[{0:d}]".format(l)] = r
+            seed_dict["seed[{0:d}]".format(l)] = int(r)
         self.config["music_configs"]["random"].update(seed_dict)
         print(self.config["music_configs"]["random"])
 
-    def find_halos(self):
-
-        final_output = os.popen("tail -1 {}/OutputLog".format(self.test_dir)).read()
-        fname = final_output.split(" ")[2]
-
-        ds = yt.load(os.path.join(self.test_dir, fname))
-
-        hc = HaloCatalog(data_ds = ds, finder_method='hop')
-        hc.create()
-        hc.load("halo_catalogs/catalog/catalog.0.h5")
-
-        f, ax = plt.subplots(1,3, figsize=(9,3),sharex=True, sharey=True)
-
-        halo_positions = []
-        halo_mass = []
-        dw = ds.domain_width
+    def final_output(self):
+        """name of the last dataset enzo wrote according to OutputLog"""
+        from enzo_monitor import parse_output_log
+        with open(os.path.join(self.test_dir, "OutputLog")) as f:
+            outputs = parse_output_log(f)
+        return outputs[-1][0]
 
-        def get_relative_position( halo_dict, dw ):
-            k = "particle_position_{}"
-            relpos = []
-            for orient in ["x", "y", "z"]:
-                key = k.format(orient)
-                relpos.append( halo_dict[key]/ dw[0] )
-            return relpos
+    def create_halo_catalog(self, dataset, catalog_dir, nprocs=1):
+        """run HOP on `dataset`; with nprocs > 1 the finder runs under
+        MPI-parallel yt so every rank only holds its share of the particles"""
+        if nprocs > 1:
+            command = ["mpirun", "-np", str(nprocs), sys.executable,
+                       os.path.abspath(__file__), "--hop", dataset, catalog_dir]
+            self.run_subprocess(command, f"{self.test_dir}_hop.out", cpus=nprocs)
+        else:
+            run_hop(dataset, catalog_dir)
+        return os.path.join(catalog_dir, os.path.basename(catalog_dir) + ".0.h5")
 
-        for h in hc.catalog:
-            halo_positions.append( get_relative_position(h,dw ))
-            halo_mass.append(h["particle_mass"].in_units("Msun").v)
+    def find_halos(self, nprocs=1):
+        fname = self.final_output()
+        catalog_dir = os.path.abspath(f"{self.test_dir}_halo_catalogs")
+        catalog = self.create_halo_catalog(os.path.join(self.test_dir, fname),
+                                           catalog_dir, nprocs=nprocs)
 
-        halo_positions = np.array(halo_positions).transpose()
-        if (len(halo_positions) < 1):
+        halo_positions, halo_mass = read_halo_catalog(catalog)
+        if (halo_mass.size < 1):
             return False
 
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+        f, ax = plt.subplots(1,3, figsize=(9,3),sharex=True, sharey=True)
         ax[0].scatter( halo_positions[0], halo_positions[1], s = np.log10(halo_mass)*10)
         ax[1].scatter( halo_positions[0], halo_positions[2], s = np.log10(halo_mass)*10)
         ax[2].scatter( halo_positions[1], halo_positions[2], s = np.log10(halo_mass)*10)
         ax[0].set_xlim(0,1)
         ax[0].set_ylim(0,1)
 
-        f.savefig("halo_position.png")
+        f.savefig(self.test_dir+"_halo_position.png")
 
         np.save(self.test_dir+"_halo_positions.npy", halo_positions)
         np.save(self.test_dir+"_halo_mass.npy", halo_mass)
@@ -85,38 +104,240 @@ class FindHaloWorkFlow(EnzoWorkFlow):
         return True
 
 
+def run_hop(dataset, catalog_dir):
+    """write the HOP halo catalog of `dataset` into `catalog_dir`"""
+    import yt
+    from yt.analysis_modules.halo_analysis.api import HaloCatalog
+    ds = yt.load(dataset)
+    hc = HaloCatalog(data_ds = ds, finder_method='hop', output_dir=catalog_dir)
+    hc.create()
+
+
+def read_halo_catalog(catalog):
+    """halo positions (3, N) in units of the box and masses (N,) in Msun
+
+    The catalog is read chunk by chunk with whole-array unit conversions
+    instead of building a dict per halo.
+    """
+    import yt
+    halos_ds  = yt.load(catalog)
+    positions = []
+    masses    = []
+    for chunk in halos_ds.all_data().chunks([], "io"):
+        positions.append(np.array([chunk["all", f"particle_position_{ax}"].in_units("unitary").v
+                                   for ax in "xyz"]))
+        masses.append(chunk["all", "particle_mass"].in_units("Msun").v)
+    if not masses:
+        return np.empty((3, 0)), np.empty(0)
+    return np.concatenate(positions, axis=1), np.concatenate(masses)
+
+
+def select_halo(positions, masses, center, min_mass=0.0, max_offset=1.0):
+    """index of the most massive halo with mass >= min_mass [Msun] within
+    max_offset (box units) of `center`, or None"""
+    offset = np.sqrt(((positions - np.asarray(center, dtype=float)[:, None])**2).sum(axis=0))
+    ok = (masses >= min_mass) & (offset <= max_offset)
+    if not ok.any():
+        return None
+    return int(np.flatnonzero(ok)[np.argmax(masses[ok])])
+
+
+def run_candidate(config_file, seed, ranks=1, min_mass=0.0, max_offset=1.0,
+                  levels=None, final_redshift=None, seed_base_level=None, suffix=""):
+    """MUSIC + enzo + halo finding for one seed in its own run directory,
+    the outcome is also written to <run_directory><seed><suffix>_candidate.json
+
+    `levels` = (levelmin, levelmax) and `final_redshift` give a reduced
+    resolution prescreen run.
+    """
+    fhw = FindHaloWorkFlow(config_file, random_seed=seed)
+    fhw.test_dir += str(seed) + suffix
+    fhw.work_dir = fhw.test_dir + ".work"
+    fhw.MPI_CORE = ranks
+    os.makedirs(fhw.work_dir, exist_ok=True)
+    if levels is not None:
+        fhw.set_resolution(*levels, final_redshift=final_redshift)
+    # the difference here is that the random seed in MUSIC is generated
+    # by the numpy random seed
+    fhw.update_music_random_seed(base_level=seed_base_level)
+    result = {"seed": int(seed), "run_directory": fhw.test_dir, "success": False}
+    with run_registry.recording(fhw), workflow_profile.trace_to(fhw.test_dir):
+        with TRACER.stage("music"):
+            fhw.run_music()
+        with TRACER.stage("enzo"):
+            fhw.run_enzo()
+        with TRACER.stage("find_halos"):
+            found = fhw.find_halos()
+    if found:
+        center = [float(c) for c in
+                  str(fhw.config["music_configs"]["setup"]["ref_center"]).replace(",", " ").split()]
+        idx = select_halo(fhw.halo_positions, fhw.halo_mass, center, min_mass, max_offset)
+        if idx is not None:
+            result.update(success=True, halo_mass=float(fhw.halo_mass[idx]),
+                          position=[float(p) for p in fhw.halo_positions[:, idx]])
+    with open(f"{fhw.test_dir}_candidate.json", "w") as f:
+        json.dump(result, f, indent=2)
+    return result
+
+
+class SeedSearch:
+    """run candidate seeds concurrently, each as its own process group,
+    and cancel the rest as soon as one finds a suitable halo"""
+    def __init__(self, config_file, seeds, concurrency, ranks=1, min_mass=0.0, max_offset=1.0,
+                 extra_args=(), suffix=""):
+        self.config_file = config_file
+        self.extra_args  = [str(a) for a in extra_args]
+        self.suffix      = suffix
+        self.seeds       = [int(s) for s in seeds]
+        self.concurrency = concurrency
+        self.ranks       = ranks
+        self.min_mass    = min_mass
+        self.max_offset  = max_offset
+        # a broken config fails here, not in every candidate
+        self.run_directory = workflow_config.load_config(
+            config_file, require=REQUIRED_SECTIONS)["run_directory"]
+
+    def launch(self, seed):
+        command = [sys.executable, os.path.abspath(__file__), self.config_file,
+                   "--candidate", str(seed), "--ranks", str(self.ranks),
+                   "--min-mass", str(self.min_mass), "--max-offset", str(self.max_offset),
+                   "--suffix", self.suffix, *self.extra_args]
+        logging.info(f"Launching seed candidate {seed}")
+        return subprocess.Popen(command, start_new_session=True)
+
+    def cancel(self, procs):
+        for seed, p in procs.items():
+            if p.poll() is None:
+                logging.info(f"Cancelling seed candidate {seed}")
+                os.killpg(p.pid, signal.SIGTERM)
+        for p in procs.values():
+            p.wait()
+
+    def result(self, seed):
+        fname = f"{self.run_directory}{seed}{self.suffix}_candidate.json"
+        if not os.path.exists(fname):
+            return None
+        with open(fname) as f:
+            return json.load(f)
+
+    def run(self, stop_at_first=True):
+        """return the winning candidate's result dict (or None); with
+        `stop_at_first` False, run every seed and return all results"""
+        queue = list(self.seeds)
+        procs = {}
+        results = []
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            waiting = {}
+            while queue or waiting:
+                while queue and len(waiting) < self.concurrency:
+                    seed = queue.pop(0)
+                    procs[seed] = self.launch(seed)
+                    waiting[pool.submit(procs[seed].wait)] = seed
+                finished, _ = wait(waiting, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    seed = waiting.pop(future)
+                    result = self.result(seed)
+                    if result is not None:
+                        results.append(result)
+                    if future.result() == 0 and result and result["success"]:
+                        logging.info(f"Seed candidate {seed} succeeded: {result}")
+                        if stop_at_first:
+                            self.cancel(procs)
+                            return result
+                    else:
+                        logging.info(f"Seed candidate {seed} found no suitable halo")
+        return None if stop_at_first else results
+
+
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["--hop"]:
+        # launched by create_halo_catalog under mpirun
+        import yt
+        yt.enable_parallelism()
+        run_hop(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="find a halo and recenter the simulation on it")
+    parser.add_argument("config_file", nargs="?", default="dmonly.yaml")
+    parser.add_argument("--trials", type=int, default=10, help="number of seeds to try")
+    parser.add_argument("--concurrency", type=int, default=None,
+                        help="candidates run at once, defaults to cores / ranks")
+    parser.add_argument("--ranks", type=int, default=1, help="MPI ranks per candidate")
+    parser.add_argument("--min-mass", type=float, default=0.0, help="[Msun]")
+    parser.add_argument("--max-offset", type=float, default=1.0,
+                        help="max distance from ref_center in box units")
+    parser.add_argument("--prescreen-levels", type=int, nargs=2, default=None,
+                        metavar=("LEVELMIN", "LEVELMAX"),
+                        help="run every seed at these MUSIC levels first")
+    parser.add_argument("--prescreen-redshift", type=float, default=None,
+                        help="final redshift of the prescreen runs")
+    parser.add_argument("--promote", type=int, default=2,
+                        help="seeds promoted from the prescreen to full resolution")
+    # used by the candidate processes SeedSearch launches
+    parser.add_argument("--candidate", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--levels", type=int, nargs=2, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--final-redshift", type=float, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--seed-base-level", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--suffix", default="", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.candidate is not None:
+        result = run_candidate(args.config_file, args.candidate, args.ranks,
+                               args.min_mass, args.max_offset, levels=args.levels,
+                               final_redshift=args.final_redshift,
+                               seed_base_level=args.seed_base_level, suffix=args.suffix)
+        sys.exit(0 if result["success"] else 1)
 
     np.random.seed(33127)
 
-    seed = np.random.randint(1e5,1e6,size=10)
-    for s in seed:
-        fhw = FindHaloWorkFlow("dmonly.yaml", random_seed = s)
-        fhw.test_dir += str(s)
-        # the difference here is that the random seed in MUSIC is generated
-        # by the numpy random seed
-        fhw.update_music_random_seed()
-        fhw.find_halos()
-        break
-        fhw.run_music()
-        fhw.run_enzo()
-        if fhw.find_halos():
-            break
+    seed = np.random.randint(1e5,1e6,size=args.trials)
+    concurrency = args.concurrency or max(1, os.cpu_count() // args.ranks)
 
-    print("SEED!!!!! {}".format(s))
+    base_level = None
+    if args.prescreen_levels:
+        # the same seed[l] from the prescreen levelmin up in both tiers
+        levelmin = workflow_config.load_config(args.config_file)["music_configs"]["setup"]["levelmin"]
+        base_level = min(levelmin, args.prescreen_levels[0])
+        extra = ["--seed-base-level", base_level, "--levels", *args.prescreen_levels]
+        if args.prescreen_redshift is not None:
+            extra += ["--final-redshift", args.prescreen_redshift]
+        prescreen = SeedSearch(args.config_file, seed, concurrency, args.ranks,
+                               args.min_mass, args.max_offset,
+                               extra_args=extra, suffix="_prescreen")
+        ranked = sorted((r for r in prescreen.run(stop_at_first=False) if r["success"]),
+                        key=lambda r: -r["halo_mass"])
+        for r in ranked:
+            print("prescreen seed {} : {:.3e} Msun".format(r["seed"], r["halo_mass"]))
+        seed = [r["seed"] for r in ranked[:args.promote]]
 
+    extra = [] if base_level is None else ["--seed-base-level", base_level]
+    search = SeedSearch(args.config_file, seed, concurrency, args.ranks,
+                        args.min_mass, args.max_offset, extra_args=extra)
+    result = search.run()
+    if result is None:
+        print("No seed produced a suitable halo")
+        sys.exit(1)
+    s = result["seed"]
+
+    print("SEED!!!!! {}".format(s))
 
     # now recenter the halos to see if the halos are now really centered!
-    pos = fhw.halo_positions
-    midx = np.argsort(fhw.halo_mass)[-1]
-    print(midx)
+    fhw = FindHaloWorkFlow(args.config_file, random_seed = s)
+    fhw.test_dir += str(s)
+    fhw.update_music_random_seed(base_level=base_level)
+    fhw.MPI_CORE = os.cpu_count()
     print("Centering On the Most Massive Halos")
-    print(fhw.halo_mass[midx], " Msun")
-    new_center = pos[:,midx]
+    print(result["halo_mass"], " Msun")
+    new_center = result["position"]
     print(new_center)
 
     fhw.update_music_center(new_center)
     fhw.test_dir += "_recentered"
-    fhw.run_music()
-    fhw.run_enzo()
-    fhw.find_halos()
+    import enzo_monitor
+    # candidates are cancelled with SIGTERM and must die at once, only the
+    # recentered run checkpoints on it
+    with run_registry.recording(fhw):
+        fhw.run_music()
+        with enzo_monitor.checkpoint_on_signals():
+            fhw.run_enzo()
+        fhw.find_halos()
@@ -1,40 +1,98 @@
-import numpy as np
-import matplotlib.pyplot as plt
-import yaml
-from jinja2 import FileSystemLoader, Environment
 import os
-import utilities
 import logging
 import subprocess
 import sys
 import importlib
+import importlib.util
 import glob
-
-MPI_CORE = 32
+import shutil
+import filecmp
+import workflow_cache
+import workflow_dag
+import templating
+import workflow_profile
+import workflow_config
+import parameter_files
+import jobqueue
+from enzo_chemistry import EnzoChemistryInitialCondition
+
+# capped by the cpus this node gives us
+MPI_CORE = min(32, len(jobqueue.node_cpus()))
+# MUSIC threads unless the config's `resources` section says otherwise
+MUSIC_THREADS = 8
 MUSIC_CONFIG = "init.music"
 ENZO_CONFIG  = "music_input.enzo"
+# paths entries that change the compiled dengo solver
+SOLVER_CACHE_PATHS = ["HDF5_DIR", "HDF5_PATH", "LIBTOOL_PATH", "CVODE_PATH",
+                      "SUITESPARSE_PATH", "DENGO_INSTALL_PATH"]
+ENZO_MAKE_JOBS = 32
+GB = 1024**3
+# records the dengo/grackle make mode the enzo tree was last configured with
+ENZO_MAKE_MODE_FILE = ".workflow_make_mode"
+ENZO_SOURCE_SUFFIXES = (".C", ".c", ".h", ".F", ".F90", ".src", ".def", ".inc")
+# written by enzo's make on every build, never part of the source hash
+ENZO_BUILD_GENERATED = ["auto_show_compile_options.C", "auto_show_config.C",
+                        "auto_show_flags.C", "auto_show_version.C"]
 
 class ConfigReader:
+    # top level sections the workflow cannot run without
+    REQUIRED_SECTIONS = ("run_directory",)
+
     def __init__(self, config_file):
-        self.config = self.parse_config(config_file)
+        # the mixins of one workflow share the config, it is only parsed once
+        if getattr(self, "config", None) is None:
+            self.config = self.parse_config(config_file)
 
     def parse_config(self, config_file):
+        """the validated config from a YAML file (see workflow_config.py),
+        or an already loaded config dict"""
+        if isinstance(config_file, dict):
+            return workflow_config.validate(config_file, self.REQUIRED_SECTIONS)
         logging.info("Parsing Config File = {}".format(config_file))
-        stream = open(config_file, 'r')
-        data = yaml.load(stream, Loader=yaml.FullLoader)
-        return data
-
-    def run_subprocess(self, commands, outfile=None):
-        p = subprocess.run(commands, check=True, stdout=subprocess.PIPE,
-                           universal_newlines=True)
+        return workflow_config.load_config(config_file, require=self.REQUIRED_SECTIONS)
+
+    def run_subprocess(self, commands, outfile=None, cwd=None, cpus=1, threads=None, memory=0):
+        """run `commands` once the node's job queue grants it `cpus` cpus
+        and `memory` bytes, pinned to those cpus"""
+        name = os.path.basename(str(commands[0]))
+        with jobqueue.reserve(cpus, memory, name=name) as reserved:
+            command, env = jobqueue.pinned(commands, reserved, threads)
+            _, out = workflow_profile.run_command(command, cwd=cwd, env=env, name=name)
         if outfile:
             with open(outfile, 'w') as f:
-                f.write(p.stdout)
+                f.write(out)
+
+    def resources(self):
+        """the optional `resources` section of the config
+
+            resources:
+              music_threads: 8
+              music_memory_gb: 16
+              enzo_memory_gb: 64
+        """
+        return self.config.get("resources") or {}
+
+def file_stats(directory):
+    """name -> (inode, mtime, size) of the files in `directory`"""
+    if not os.path.isdir(directory):
+        return {}
+    stats = {}
+    for entry in os.scandir(directory):
+        if entry.is_file(follow_symlinks=False):
+            st = entry.stat(follow_symlinks=False)
+            stats[entry.name] = (st.st_ino, st.st_mtime_ns, st.st_size)
+    return stats
+
 
 class MUSICGenerator(ConfigReader):
+    REQUIRED_SECTIONS = ("run_directory", "executables", "music_configs")
+
     def __init__(self, config_file):
         ConfigReader.__init__(self, config_file)
         self.test_dir = self.config["run_directory"]
+        # MUSIC runs here and leaves its config, log and power spectrum here
+        self.work_dir = "."
+        self.baryons  = self.config["music_configs"]["setup"]["baryons"] != "no"
 
     def write_music_configs(self):
         config = self.config["music_configs"]
@@ -44,82 +102,183 @@ class MUSICGenerator(ConfigReader):
         else:
             self.baryons = True
         logging.info("Write Music configurations = {}".format(config))
-        with open(MUSIC_CONFIG, 'w') as f:
-            for k, v in config.items():
-                f.write("[{}]\n".format(k))
-                for param, val in  v.items():
-                    f.write("{0:10} = {1}\n".format(param, val))
-            f.write( "filename = {0}".format(self.test_dir))
+        parameter_files.write_music_config(config, os.path.join(self.work_dir, MUSIC_CONFIG),
+                                           os.path.relpath(self.test_dir, self.work_dir))
+
+    def music_cache_key(self):
+        """hash of the music_configs and the MUSIC executable"""
+        music = self.config["executables"]["music"]
+        return workflow_cache.hash_config({"music_configs": self.config["music_configs"],
+                                           "music": workflow_cache.hash_tree(music)})
 
     def run_music(self):
         config = self.config
-        music  = config["executables"]["music"]
-        music_configs = self.write_music_configs()
-        self.run_subprocess(["./"+music, MUSIC_CONFIG],
-                            "run_music.out")
+        music  = os.path.abspath(config["executables"]["music"])
+
+        cache = workflow_cache.ICStore()
+        key   = self.music_cache_key()
+        if cache.lookup(key):
+            logging.info("Reusing cached initial conditions {}".format(cache.path(key)))
+            cache.link_into(key, self.test_dir)
+            return
+        if os.path.isdir(self.test_dir):
+            # read-only links into the store from an earlier config, MUSIC rewrites them
+            for f in glob.glob(os.path.join(self.test_dir, "*")):
+                if os.path.isfile(f) and not os.access(f, os.W_OK):
+                    os.remove(f)
+
+        # only what MUSIC writes goes into the store, not dumps of an earlier enzo run
+        before = file_stats(self.test_dir)
+        self.write_music_configs()
+        threads = self.resources().get("music_threads", MUSIC_THREADS)
+        self.run_subprocess([music, MUSIC_CONFIG],
+                            os.path.join(self.work_dir, "run_music.out"),
+                            cwd=self.work_dir, cpus=threads, threads=threads,
+                            memory=int(self.resources().get("music_memory_gb", 0) * GB))
         music_out = ["input_powerspec.txt", "{0}".format(MUSIC_CONFIG), "{0}_log.txt".format(MUSIC_CONFIG)]
-        self.run_subprocess(["mv", *music_out, self.test_dir])
+        for f in music_out:
+            shutil.move(os.path.join(self.work_dir, f), os.path.join(self.test_dir, f))
+        after = file_stats(self.test_dir)
+        cache.store_files(key, self.test_dir, sorted(f for f in after if after[f] != before.get(f)),
+                          meta={"music_configs": config["music_configs"]})
 
 
 class DengoNetworkBuilder(ConfigReader):
+    REQUIRED_SECTIONS = ("run_directory", "paths", "dengo_configs")
+
     def __init__(self, config_file):
         ConfigReader.__init__(self, config_file)
 
-        config             = self.parse_config(config_file)
-        self.dengo_configs = config['dengo_configs']
-        self.paths         = config['paths']
+        self.dengo_configs = self.config['dengo_configs']
+        self.paths         = self.config['paths']
         self.set_environment_variables()
+        self.apply_tuned_layout()
 
     def set_environment_variables(self):
         for envar, path in self.paths.items():
             os.environ[envar] = path
 
+    def apply_tuned_layout(self, tune=False):
+        """resolve `omp_num_threads: auto` from this host's autotune record
+
+        The record also sets the MPI rank count enzo is launched with.
+        With `tune`, a host without a record is measured first (autotune.py).
+        """
+        if self.dengo_configs['omp_num_threads'] != "auto":
+            return
+        import autotune
+        solver_option = self.dengo_configs['solver_option']
+        record = autotune.tuned_layout(solver_option)
+        if record is None:
+            if not tune:
+                return
+            record = autotune.autotune(self.network, solver_option,
+                                       solver_name=f"{self.dengo_configs['solver_name']}_autotune")
+        logging.info(f"Using tuned layout {record['mpi_ranks']} ranks x "
+                     f"{record['omp_num_threads']} threads")
+        self.dengo_configs['omp_num_threads'] = record['omp_num_threads']
+        self.MPI_CORE = record['mpi_ranks']
+
+    def solver_templates(self):
+        """dengo solver template and ODE solver source for `solver_option`"""
+        from workflow_config import SOLVER_OPTIONS
+        solver_option = self.dengo_configs['solver_option']
+        if solver_option not in SOLVER_OPTIONS:
+            raise Exception(f"Solver {solver_option} not implemented")
+        return SOLVER_OPTIONS[solver_option]
+
+    def load_dengo_network(self):
+        """the network of `network_file`; `enforce_conservation` and
+        `equilibrium_species`, when given, go to its setup function"""
+        network_file  = self.dengo_configs['network_file']
+        kwargs = {k: self.dengo_configs[k] for k in workflow_config.NETWORK_ARGUMENTS
+                  if k in self.dengo_configs}
+        self.network  = workflow_cache.cached_network(network_file, **kwargs)
+        return self.network
+
     def write_dengo_network(self):
         configs       = self.dengo_configs
         solver_name   = configs['solver_name']
-        solver_option = configs['solver_option']
         output_dir    = configs['output_dir']
 
-        network_file  = configs['network_file']
-        module        = importlib.import_module(network_file)
-        network = module.setup_network()
-        self.network = network
-
-        if solver_option == "be_chem":
-            solver_template = "be_chem_solve/rates_and_rate_tables"
-            ode_solver_source = "BE_chem_solve.C"
-        elif solver_option == "cv_omp":
-            solver_template = "cv_omp/sundials_CVDls"
-            ode_solver_source = "initialize_cvode_solver.C"
-        else:
-            raise Exception(f"Solver {solver_option} not implemented")
-
+        if not hasattr(self, "network"):
+            self.load_dengo_network()
+        network = self.network
+        solver_template, ode_solver_source = self.solver_templates()
 
         network.write_solver(solver_name,
                              solver_template= solver_template,
                              ode_solver_source=ode_solver_source, output_dir= output_dir)
 
+    def solver_cache_key(self):
+        """hash everything that goes into the compiled dengo solver"""
+        import dengo
+        configs = self.dengo_configs
+        solver_template, ode_solver_source = self.solver_templates()
+        templatedir = os.path.join(os.path.dirname(dengo.__file__), "templates",
+                                   os.path.dirname(solver_template))
+        # describe_network has no rate coefficients, the sources they come from stand in
+        key = {"network": workflow_cache.describe_network(self.network),
+               "network_source": workflow_cache.network_source(configs['network_file']),
+               "dengo": workflow_cache.dengo_signature(),
+               "solver_name": configs['solver_name'],
+               "solver_template": solver_template,
+               "ode_solver_source": ode_solver_source,
+               "template_hash": workflow_cache.hash_tree(templatedir),
+               "omp_num_threads": configs['omp_num_threads'],
+               # entries made before installs were matched by exact name hold
+               # other solvers' files, they must not be restored
+               "install_files": workflow_cache.SOLVER_INSTALL_FILES,
+               "paths": {k: v for k, v in self.paths.items()
+                         if k in SOLVER_CACHE_PATHS}}
+        return workflow_cache.hash_config(key)
+
     def build_dengo_solver(self):
-        self.write_dengo_network()
-        current_path = os.getcwd()
         configs     = self.dengo_configs
         dengo_dir   = configs['output_dir']
-        omp_threads = configs['omp_num_threads']
+        solver_name = configs['solver_name']
+        install_dir = self.paths['DENGO_INSTALL_PATH']
+
+        self.load_dengo_network()
+        self.apply_tuned_layout(tune=True)
+        cache = workflow_cache.BuildCache("dengo_solver")
+        key   = self.solver_cache_key()
+        if cache.lookup(key):
+            self.restore_dengo_solver(cache, key)
+            return
 
-        os.chdir(dengo_dir)
-        with open("Makefile", "r+") as f:
+        self.write_dengo_network()
+        omp_threads = configs['omp_num_threads']
+        with open(os.path.join(dengo_dir, "Makefile"), "r+") as f:
             lines = f.readlines()
             for i, l in enumerate(lines):
                 if "-fopenmp" in l:
                     lines[i] = f"OPTIONS += -fopenmp -DNTHREADS={omp_threads}\n"
             f.seek(0)
             f.writelines(lines)
-        out = subprocess.run("make")
-        os.chdir(current_path)
+            f.truncate()
+        self.run_subprocess(["make"], cwd=dengo_dir, cpus=1)
+
+        files = {"build": dengo_dir}
+        for f in workflow_cache.installed_solver_files(install_dir, solver_name):
+            files[os.path.join("install", os.path.relpath(f, install_dir))] = f
+        cache.store(key, files, meta={"dengo_configs": configs})
+
+    def restore_dengo_solver(self, cache, key):
+        """populate the build and install directories from a cached solver"""
+        install_dir = self.paths['DENGO_INSTALL_PATH']
+        logging.info("Reusing cached dengo solver {}".format(cache.path(key)))
+        cache.restore(key, "build", self.dengo_configs['output_dir'])
+        for name in cache.manifest(key)["files"]:
+            if name.startswith("install" + os.sep):
+                cache.restore(key, name,
+                              os.path.join(install_dir, os.path.relpath(name, "install")))
 
     def write_simulation_templates(self, simulation='gamer'):
         """Write necessary simulations files for Dengo."""
         supported_simulations = ['enzo', 'gamer']
+        if not hasattr(self, "network"):
+            self.load_dengo_network()
         network               = self.network
         solver_name           = self.dengo_configs['solver_name']
 
@@ -141,22 +300,18 @@ class DengoNetworkBuilder(ConfigReader):
         outdir     : str, optional
             location of the desired templates ouput directory,
             will be created if not existed
+
+        Returns
+        -------
+        report : list of (template, render seconds, written)
+            only files whose rendered contents changed are rewritten
         """
         network     = self.network
         solver_name = self.dengo_configs['solver_name']
 
-        templateLoader = FileSystemLoader(searchpath=searchpath)
-        env = Environment(extensions=['jinja2.ext.loopcontrols'], loader=templateLoader)
-
         template_vars = dict(network=network, solver_name=solver_name)
         templateFiles = self.walk_template_files(searchpath, outdir)
-        for infile in templateFiles:
-            template_inst = env.get_template(infile)
-            solver_out = template_inst.render(**template_vars)
-
-            outfile = infile.replace(".template", "")
-            with open(os.path.join(outdir,outfile), 'w') as f:
-               f.write(solver_out)
+        return templating.render_templates(searchpath, templateFiles, outdir, template_vars)
 
     def walk_template_files(self, searchpath, outputdir):
         """collect relative paths of templates, and create local directory if needed"""
@@ -175,171 +330,280 @@ class DengoNetworkBuilder(ConfigReader):
 
 
 class EnzoWorkFlow(MUSICGenerator):
+    REQUIRED_SECTIONS = MUSICGenerator.REQUIRED_SECTIONS + ("enzo_configs",)
+
     def __init__(self, config_file):
+        # configured before the config is parsed so nothing is lost
+        workflow_profile.setup_logging()
         MUSICGenerator.__init__(self, config_file)
 
         self.MPI_CORE = MPI_CORE
-        templateLoader = FileSystemLoader(searchpath='./templates')
-        self.templateEnv = Environment(loader=templateLoader)
         self.test_dir = self.config["run_directory"]
-        #logging.basicConfig(filename="logWorkFlow.log", level=logging.DEBUG)
-        logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p', filename='logWorkFlow.log')
+
+    @property
+    def templateEnv(self):
+        # jinja2 is only imported by the stages that render templates
+        return templating.get_environment('./templates')
 
     def build_enzo(self, outtemplatedir = "autogen_enzo_templates",
                    enzorepo = "enzo-dev", chem_solver='dengo'):
-        if chem_solver == "grackle":
-            # current path
-            current_path = os.getcwd()
-            os.chdir(f"{enzorepo}/src/enzo")
-            self.run_subprocess(['make', 'dengo-no'])
-            self.run_subprocess(['make', 'grackle-yes'])
-            self.run_subprocess(["make", "-j32"])
-            os.chdir(current_path)
-            self.run_subprocess(["cp", f"{enzorepo}/bin/enzo","."])
-            return
+        """build enzo against the generated dengo solver (or grackle)
 
-        # chem solver anything elese are Dengo
+        Only generated files whose contents changed are copied into the
+        enzo source tree, `make clean` only runs when the dengo/grackle
+        make mode flips, and finished binaries are cached by
+        (source tree hash, generated solver hash, make flags).
+        """
         if not os.path.exists(enzorepo):
-            raise Exception("{enzorepo} does not exist")
-        # move templates to enzo repo
-        for f in glob.glob(f"{outtemplatedir}/*"):
-            self.run_subprocess(["cp", f, f"{enzorepo}/src/enzo/"])
-
-        # current path
-        current_path = os.getcwd()
-        os.chdir(f"{enzorepo}/src/enzo")
-        self.run_subprocess(['make', 'clean'])
-        self.run_subprocess(['make', 'dengo-yes'])
-        self.run_subprocess(['make', 'grackle-no'])
-        self.run_subprocess(["make", "-j32"])
-        os.chdir(current_path)
-        self.run_subprocess(["cp", f"{enzorepo}/bin/enzo","."])
+            raise Exception(f"{enzorepo} does not exist")
+        srcdir = os.path.join(enzorepo, "src", "enzo")
 
+        if chem_solver == "grackle":
+            make_modes = ['dengo-no', 'grackle-yes']
+            generated  = []
+        else:
+            # chem solver anything elese are Dengo
+            make_modes = ['dengo-yes', 'grackle-no']
+            generated  = sorted(f for f in glob.glob(f"{outtemplatedir}/*")
+                                if os.path.isfile(f))
+        make_flags = make_modes + [f"-j{ENZO_MAKE_JOBS}"]
+        enzo_exe   = self.config["executables"]["enzo"]
+
+        cache = workflow_cache.BuildCache("enzo")
+        key   = self.enzo_cache_key(srcdir, generated, make_flags)
+        if cache.lookup(key):
+            cache.restore(key, "enzo", enzo_exe)
+            return
 
-    def write_enzo_config(self):
+        # move templates to enzo repo
+        self.copy_changed_files(generated, srcdir)
+
+        mode_file = os.path.join(srcdir, ENZO_MAKE_MODE_FILE)
+        last_modes = None
+        if os.path.exists(mode_file):
+            with open(mode_file) as f:
+                last_modes = f.read().split()
+        if last_modes != make_modes:
+            logging.info(f"Enzo make mode {last_modes} -> {make_modes}, cleaning")
+            self.run_subprocess(['make', 'clean'], cwd=srcdir)
+            for mode in make_modes:
+                self.run_subprocess(['make', mode], cwd=srcdir)
+            with open(mode_file, "w") as f:
+                f.write(" ".join(make_modes))
+        # as many jobs as the queue grants cpus
+        with jobqueue.reserve(ENZO_MAKE_JOBS, name="make enzo") as cpus:
+            command, env = jobqueue.pinned(["make", f"-j{len(cpus)}"], cpus)
+            workflow_profile.run_command(command, cwd=srcdir, env=env, name="make")
+
+        shutil.copy2(f"{enzorepo}/bin/enzo", enzo_exe)
+        cache.store(key, {"enzo": f"{enzorepo}/bin/enzo"},
+                    meta={"make_flags": make_flags, "enzorepo": os.path.abspath(enzorepo)})
+
+    def enzo_cache_key(self, srcdir, generated, make_flags):
+        """hash the enzo sources, the generated solver files and make flags"""
+        names  = [os.path.basename(f) for f in generated]
+        source = workflow_cache.hash_tree(srcdir, suffixes=ENZO_SOURCE_SUFFIXES,
+                                          exclude=names + ENZO_BUILD_GENERATED)
+        solver = {n: workflow_cache.hash_tree(f) for n, f in zip(names, generated)}
+        return workflow_cache.hash_config({"source": source,
+                                           "generated": solver,
+                                           "make_flags": make_flags})
+
+    def copy_changed_files(self, files, outdir):
+        """copy `files` into `outdir`, leaving identical files (and mtimes) alone"""
+        for f in files:
+            dst = os.path.join(outdir, os.path.basename(f))
+            if os.path.exists(dst) and filecmp.cmp(f, dst, shallow=False):
+                continue
+            logging.info(f"Updating {dst}")
+            shutil.copy(f, dst)
+
+
+    def enzo_parameters(self):
+        """MUSIC's parameter_file.txt, the simulation template and the
+        `enzo_configs` values (FinalRedshift as CosmologyFinalRedshift)"""
         config = self.config
-        fenzo  = open(os.path.join(self.test_dir,ENZO_CONFIG), 'w')
-        fmusic = open(os.path.join(self.test_dir, "parameter_file.txt"), "r")
-
-        fenzo.write("# [Configurations from MUSIC]\n")
-        fenzo.write(fmusic.read())
+        params = parameter_files.EnzoParameters.read(
+            os.path.join(self.test_dir, "parameter_file.txt"), "Configurations from MUSIC")
 
         if self.baryons:
             enzo_baryon_templates = self.templateEnv.get_template( "enzo_baryons.template")
             out = enzo_baryon_templates.render(config["enzo_configs"])
         else:
-            enzo_dmonly = open("templates/enzo_dmonly.template")
-            out = enzo_dmonly.read()
-
-        fenzo.write("# [Enzo Simulation Configs]\n")
-        fenzo.write(out)
-
-        fenzo.close()
-        fmusic.close()
-
-        # specify the final redshift
-        os.system(f"sed -i 's/CosmologyFinalRedshift                   = 0/CosmologyFinalRedshift = {config['enzo_configs']['FinalRedshift']}/g' {self.test_dir}/{ENZO_CONFIG}")
-
-    def run_enzo(self):
-        os.system("cp {} {}".format(self.config["executables"]["enzo"],
-                                    self.test_dir))
-        os.chdir(self.test_dir)
-        command = "mpirun -np {0} ./enzo -d {1} > enzo_run.out 2>&1".format(self.MPI_CORE, ENZO_CONFIG)
-        os.system(command)
-        os.chdir("../")
-
-class EnzoChemistryInitialCondition:
-    """initialize the same condition as Grackle would for Enzo"""
-    def __init__(self):
-        self.H2_1Fraction = 2.0e-20
-        self.H2_2Fraction = 3.0e-14
-        self.H_1Fraction  = 0.76
-        self.H_2Fraction  = 1.2e-5
-        self.H_m0Fraction = 2.0e-9
-        self.He_1Fraction = 0.24
-        self.He_2Fraction = 1.0e-14
-        self.He_3Fraction = 1.0e-17
-        self.de_1Fraction = 1.2e-5
-
-        self.CosmologySimulationOmegaBaryonNow       = 0.045000
-        self.CosmologySimulationOmegaCDMNow          = 0.231000
-        self.CosmologySimulationInitialTemperature   = 35.408777
-
-    def calculate_fraction(self):
-        self.OmegaMatterNow = 0.276
-        self.HubbleConstantNow = 0.703
-
-        h_2 = self.H_2Fraction*0.76*self.OmegaMatterNow**0.5 / (self.CosmologySimulationOmegaBaryonNow*self.HubbleConstantNow)
-
-        he2 = self.He_2Fraction*4.0*0.24
-        he3 = self.He_3Fraction*4*0.24
-        he1 = 0.24 - he2 - he3
-
-        hm   = self.H_m0Fraction*h_2*(self.CosmologySimulationInitialTemperature**0.88)
-        h2_2 = self.H2_2Fraction*2.*h_2* (self.CosmologySimulationInitialTemperature**1.8)
-        h2   = self.H2_1Fraction*0.76*301.0**5.1 * self.OmegaMatterNow**1.5 / self.CosmologySimulationOmegaBaryonNow/self.HubbleConstantNow*2.0
-        h1   = 0.76-h2-h2_2-hm
-
-        de   = h_2 + 0.25*he2+0.5*he3 + 0.5*h2_2 -hm
-
-        return {"H2_1": h2, "H2_2": h2_2, "H_m0": hm, "He_1": he1,
-                "He_2": he2, "He_3": he3, "H_2": h_2, "H_1":h1,
-                'de': de}
-    def add_primordial_initial_fraction(self, filename):
-        initial_condition = self.calculate_fraction()
-        with open(filename,'a') as f:
-            for k in sorted(initial_condition):
-                f.write(f"CosmologySimulation{k}Fraction = {initial_condition[k]}\n")
+            with open("templates/enzo_dmonly.template") as enzo_dmonly:
+                out = enzo_dmonly.read()
+        params.merge(parameter_files.EnzoParameters.parse(out, "Enzo Simulation Configs"))
+        params.update(parameter_files.enzo_parameters(config["enzo_configs"]))
+        return params
+
+    def write_enzo_config(self, extra_parameters=None):
+        """write the enzo parameter file once, `extra_parameters` (name ->
+        value) go on top in their own section"""
+        params = self.enzo_parameters()
+        if extra_parameters:
+            params.update(extra_parameters, "Workflow")
+        params.write(os.path.join(self.test_dir, ENZO_CONFIG))
+
+    def enzo_command(self, restart=None):
+        """fresh start from the parameter file, or `-r` from the dump `restart`"""
+        if restart is not None:
+            return ["mpirun", "-np", str(self.MPI_CORE), "./enzo", "-d", "-r", restart]
+        return ["mpirun", "-np", str(self.MPI_CORE), "./enzo", "-d", ENZO_CONFIG]
+
+    def enzo_threads(self):
+        """OpenMP threads per enzo rank, the dengo solver's `omp_num_threads`"""
+        threads = self.config.get("dengo_configs", {}).get("omp_num_threads", 1)
+        return threads if isinstance(threads, int) else 1
+
+    def link_enzo_executable(self):
+        workflow_cache.share_file(self.config["executables"]["enzo"],
+                                  os.path.join(self.test_dir, "enzo"))
+
+    def launch_enzo(self, **kwargs):
+        """link the enzo executable into the run directory and return an
+        EnzoRun for it; `await run.run()` or pass several to monitor_runs"""
+        import enzo_monitor
+        self.link_enzo_executable()
+        return enzo_monitor.EnzoRun(self.test_dir, self.enzo_command(), **kwargs)
+
+    def run_enzo(self, inflight=None, max_restarts=3, **kwargs):
+        """run enzo to completion; with an analysis.InflightAnalysis as
+        `inflight` every dump is reduced while the run goes on
+
+        An unfinished run in `test_dir` (preempted or crashed) is resumed
+        from its latest intact dump, and a crash is restarted from there up
+        to `max_restarts` times. Inside enzo_monitor.checkpoint_on_signals()
+        a SIGTERM/SIGUSR1 asks enzo for a dump before it is stopped and an
+        exception is raised.
+        """
+        import asyncio
+        import enzo_monitor
+        self.link_enzo_executable()
+        # every rank runs `threads` OpenMP threads, all of them need a cpu
+        ranks, threads = jobqueue.fit_layout(self.MPI_CORE, self.enzo_threads())
+        if (ranks, threads) != (self.MPI_CORE, self.enzo_threads()):
+            logging.warning(f"{self.MPI_CORE} ranks x {self.enzo_threads()} threads do not fit "
+                            f"the node, running {ranks} x {threads}")
+            self.MPI_CORE = ranks
+        memory  = int(self.resources().get("enzo_memory_gb", 0) * GB)
+        with jobqueue.reserve(ranks * threads, memory, name=f"enzo {self.test_dir}") as cpus:
+            run = asyncio.run(enzo_monitor.run_with_restarts(
+                self.test_dir, self.enzo_command(), self.enzo_command,
+                max_restarts=max_restarts, parameter_file=os.path.join(self.test_dir, ENZO_CONFIG),
+                watch=inflight.watch if inflight is not None else None,
+                cpus=cpus, threads=threads, **kwargs))
+        if run.preempted:
+            raise Exception(f"enzo run in {self.test_dir} was preempted, "
+                            f"rerun to resume from {enzo_monitor.latest_dump(self.test_dir)}")
+        return run.progress
+
+    def inflight_analysis(self):
+        """InflightAnalysis for the optional `analysis` config section, or None
+
+            analysis:
+              inflight: true
+              workers: 4
+              stop_density: 1.0e-12   # g/cm^3, stop enzo once reached
+        """
+        configs = self.config.get("analysis") or {}
+        if not configs.get("inflight"):
+            return None
+        import analysis
+        return analysis.InflightAnalysis(max_workers=configs.get("workers", 2),
+                                         stop_density=configs.get("stop_density"))
 
 class EnzoDengoWorkflow(EnzoWorkFlow, DengoNetworkBuilder, EnzoChemistryInitialCondition):
+    REQUIRED_SECTIONS = EnzoWorkFlow.REQUIRED_SECTIONS + ("paths", "dengo_configs")
 
-    def __init__(self, config_file="dmonly.yaml"):
+    def __init__(self, config_file="cvode.yaml"):
         EnzoWorkFlow.__init__(self,config_file)
         DengoNetworkBuilder.__init__(self,config_file)
-        EnzoChemistryInitialCondition.__init__(self)
+        EnzoChemistryInitialCondition.__init__(self,
+                                               cosmology=self.config["music_configs"]["cosmology"],
+                                               zstart=self.config["music_configs"]["setup"]["zstart"])
 
     def write_enzo_templates(self, searchpath=".", outdir="."):
         network = self.network
         solver_name = self.dengo_configs['solver_name']
 
-        templateLoader = FileSystemLoader(searchpath=searchpath)
-        env = Environment(extensions=['jinja2.ext.loopcontrols'], loader=templateLoader)
-
         template_vars = dict(network=network, solver_name=solver_name)
 
         templateFiles = list(map(os.path.basename, glob.glob(os.path.join(searchpath, "*.template"))))
-        for infile in templateFiles:
-            template_inst = env.get_template(infile)
-            solver_out = template_inst.render(**template_vars)
+        return templating.render_templates(searchpath, templateFiles, outdir, template_vars)
 
-            outfile = infile.replace(".template", "")
-            with open(os.path.join(outdir,outfile), 'w') as f:
-               f.write(solver_out)
 
+    def copy_rate_tables(self):
+        """link the rate data into the run directory from the artifact store"""
+        tables = f"{self.dengo_configs['solver_name']}_tables.h5"
+        workflow_cache.share_file(f"{self.paths['DENGO_INSTALL_PATH']}/{tables}",
+                                  os.path.join(self.test_dir, tables))
 
-    def run(self):
-        print(self.dengo_configs)
-        self.build_dengo_solver()
-        self.run_music()
-        self.write_simulation_templates(simulation='enzo')
-
-        self.build_enzo()
-        self.write_enzo_config()
-        self.add_primordial_initial_fraction(f"{self.test_dir}/{ENZO_CONFIG}")
-
-        # copy the rate data to the local directory
-        import shutil
-        shutil.copy(f"{self.paths['DENGO_INSTALL_PATH']}/{self.dengo_configs['solver_name']}_tables.h5",
-                    f"{self.test_dir}")
+    def write_full_enzo_config(self):
+        self.write_enzo_config(self.primordial_fraction_parameters())
 
-        self.run_enzo()
-        #self.run_enzo()
+    def workflow_stages(self):
+        """the run() pipeline as a StageGraph
 
+        MUSIC only feeds the enzo parameter file and the run directory, so
+        it runs alongside the dengo solver and enzo compile chain.
+        """
+        configs      = self.dengo_configs
+        solver_name  = configs['solver_name']
+        tables       = f"{self.paths['DENGO_INSTALL_PATH']}/{solver_name}_tables.h5"
+        spec         = importlib.util.find_spec(configs['network_file'])
+        network_src  = [spec.origin] if spec and spec.origin else []
+        enzo_exe     = self.config["executables"]["enzo"]
+        music_params = os.path.join(self.test_dir, "parameter_file.txt")
+        templates    = "autogen_enzo_templates"
+
+        dag = workflow_dag.StageGraph(f"{os.path.normpath(self.test_dir)}.stages.json")
+        dag.add("dengo_solver", self.build_dengo_solver,
+                inputs=network_src, outputs=[configs['output_dir'], tables],
+                params={"dengo_configs": configs, "paths": self.paths})
+        dag.add("music", self.run_music,
+                inputs=[self.config["executables"]["music"]], outputs=[music_params],
+                params={"music_configs": self.config["music_configs"],
+                        "run_directory": self.test_dir})
+        dag.add("enzo_templates", lambda: self.write_simulation_templates(simulation='enzo'),
+                deps=["dengo_solver"], inputs=[tables], outputs=[templates],
+                params={"dengo_configs": configs})
+        dag.add("enzo_build", self.build_enzo,
+                deps=["enzo_templates"], inputs=[templates], outputs=[enzo_exe],
+                params={"chem_solver": "dengo", "dengo_configs": configs})
+        dag.add("enzo_config", self.write_full_enzo_config,
+                deps=["music"],
+                inputs=[music_params, os.path.join("templates", "enzo_baryons.template")],
+                outputs=[os.path.join(self.test_dir, ENZO_CONFIG)],
+                params={"enzo_configs": self.config["enzo_configs"],
+                        "music_configs": self.config["music_configs"]})
+        dag.add("rate_tables", self.copy_rate_tables,
+                deps=["dengo_solver", "music"], inputs=[tables],
+                outputs=[os.path.join(self.test_dir, f"{solver_name}_tables.h5")])
+        # the simulation itself declares no outputs, so it always runs
+        dag.add("enzo", lambda: self.run_enzo(inflight=self.inflight_analysis()),
+                deps=["enzo_build", "enzo_config", "rate_tables"])
+        dag.add("analysis", self.analyze_outputs, deps=["enzo"])
+        return dag
+
+    def analyze_outputs(self):
+        """cached reductions of every output of this run, see analysis.py"""
+        import analysis
+        return analysis.analyze_runs([self.test_dir])[self.test_dir]
 
+    def run(self):
+        """run the stage graph; call it from the main thread, so a SIGTERM
+        checkpoints enzo (the enzo stage itself runs in a worker thread)"""
+        import run_registry
+        import enzo_monitor
+        print(self.dengo_configs)
+        with run_registry.recording(self), workflow_profile.trace_to(self.test_dir), \
+             enzo_monitor.checkpoint_on_signals():
+            self.workflow_stages().run()
 
 
 if __name__ == "__main__":
     config_file = sys.argv[1]
+    workflow_profile.setup_logging()
 
     enzo_dengo = EnzoDengoWorkflow(config_file)
     enzo_dengo.run()
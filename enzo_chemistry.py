@@ -0,0 +1,135 @@
+# numpy is imported by the functions that need it, so the workflow
+# entry points can import this module without paying for it at startup
+
+# species fractions Enzo/Grackle start a cosmology simulation from
+SPECIES = ["H2_1", "H2_2", "H_m0", "He_1", "He_2", "He_3", "H_2", "H_1", "de"]
+
+
+def initial_temperature(zstart):
+    """enzo's default CosmologySimulationInitialTemperature for a start redshift"""
+    import numpy as np
+    return 550.0 * ((1.0 + np.asarray(zstart, dtype=float)) / 201.0)**2
+
+
+def primordial_fractions(Omega_b, Omega_m, h, T_init=None, z_start=None,
+                         ic=None, structured=False):
+    """initial primordial species fractions for arrays of cosmologies
+
+    Vectorized counterpart of `EnzoChemistryInitialCondition.calculate_fraction`,
+    all arguments broadcast against each other.
+
+    Parameters
+    ----------
+    Omega_b, Omega_m : array_like, baryon and total matter density today
+    h                : array_like, hubble constant in units of 100 km/s/Mpc
+    T_init           : array_like, optional, initial gas temperature in K
+    z_start          : array_like, optional, start redshift, used for
+                       `T_init` when that is not given
+    ic               : EnzoChemistryInitialCondition, optional, where the
+                       base fractions are taken from
+    structured       : bool, return a structured array instead of a dict
+
+    Returns
+    -------
+    dict of arrays keyed by species (or a structured array with one field per species)
+    """
+    import numpy as np
+    if ic is None:
+        ic = EnzoChemistryInitialCondition()
+    if T_init is None:
+        if z_start is None:
+            T_init = ic.CosmologySimulationInitialTemperature
+        else:
+            T_init = initial_temperature(z_start)
+    Omega_b, Omega_m, h, T = np.broadcast_arrays(*(np.asarray(a, dtype=float) for a in
+                                                   (Omega_b, Omega_m, h, T_init)))
+
+    h_2  = ic.H_2Fraction*0.76*np.sqrt(Omega_m) / (Omega_b*h)
+    he2  = np.full_like(h_2, ic.He_2Fraction*4.0*0.24)
+    he3  = np.full_like(h_2, ic.He_3Fraction*4.0*0.24)
+    he1  = 0.24 - he2 - he3
+    hm   = ic.H_m0Fraction*h_2*T**0.88
+    h2_2 = ic.H2_2Fraction*2.0*h_2*T**1.8
+    h2   = ic.H2_1Fraction*0.76*301.0**5.1 * Omega_m**1.5 / Omega_b / h*2.0
+    h1   = 0.76 - h2 - h2_2 - hm
+    de   = h_2 + 0.25*he2 + 0.5*he3 + 0.5*h2_2 - hm
+
+    out = {"H2_1": h2, "H2_2": h2_2, "H_m0": hm, "He_1": he1,
+           "He_2": he2, "He_3": he3, "H_2": h_2, "H_1": h1,
+           'de': de}
+    if not structured:
+        return out
+    table = np.empty(h_2.shape, dtype=[(s, float) for s in SPECIES])
+    for s in SPECIES:
+        table[s] = out[s]
+    return table
+
+
+class EnzoChemistryInitialCondition:
+    """initialize the same condition as Grackle would for Enzo
+
+    `cosmology` is the `music_configs['cosmology']` section (Omega_b,
+    Omega_m, H0); `zstart` sets the initial temperature the way enzo does.
+    Without them the values of the original dmonly/cvode setups are used.
+    """
+    def __init__(self, cosmology=None, zstart=None):
+        self.H2_1Fraction = 2.0e-20
+        self.H2_2Fraction = 3.0e-14
+        self.H_1Fraction  = 0.76
+        self.H_2Fraction  = 1.2e-5
+        self.H_m0Fraction = 2.0e-9
+        self.He_1Fraction = 0.24
+        self.He_2Fraction = 1.0e-14
+        self.He_3Fraction = 1.0e-17
+        self.de_1Fraction = 1.2e-5
+
+        self.CosmologySimulationOmegaBaryonNow       = 0.045000
+        self.CosmologySimulationOmegaCDMNow          = 0.231000
+        self.CosmologySimulationInitialTemperature   = 35.408777
+        self.OmegaMatterNow    = 0.276
+        self.HubbleConstantNow = 0.703
+
+        if cosmology is not None:
+            self.CosmologySimulationOmegaBaryonNow = float(cosmology["Omega_b"])
+            self.CosmologySimulationOmegaCDMNow    = float(cosmology["Omega_m"]) - float(cosmology["Omega_b"])
+            self.OmegaMatterNow    = float(cosmology["Omega_m"])
+            self.HubbleConstantNow = float(cosmology["H0"]) / 100.0
+        if zstart is not None:
+            self.CosmologySimulationInitialTemperature = float(initial_temperature(zstart))
+
+    def calculate_fraction(self):
+        h_2 = self.H_2Fraction*0.76*self.OmegaMatterNow**0.5 / (self.CosmologySimulationOmegaBaryonNow*self.HubbleConstantNow)
+
+        he2 = self.He_2Fraction*4.0*0.24
+        he3 = self.He_3Fraction*4*0.24
+        he1 = 0.24 - he2 - he3
+
+        hm   = self.H_m0Fraction*h_2*(self.CosmologySimulationInitialTemperature**0.88)
+        h2_2 = self.H2_2Fraction*2.*h_2* (self.CosmologySimulationInitialTemperature**1.8)
+        h2   = self.H2_1Fraction*0.76*301.0**5.1 * self.OmegaMatterNow**1.5 / self.CosmologySimulationOmegaBaryonNow/self.HubbleConstantNow*2.0
+        h1   = 0.76-h2-h2_2-hm
+
+        de   = h_2 + 0.25*he2+0.5*he3 + 0.5*h2_2 -hm
+
+        return {"H2_1": h2, "H2_2": h2_2, "H_m0": hm, "He_1": he1,
+                "He_2": he2, "He_3": he3, "H_2": h_2, "H_1":h1,
+                'de': de}
+
+    def calculate_fraction_grid(self, Omega_b, Omega_m, h, T_init=None, z_start=None,
+                                structured=False):
+        """`calculate_fraction` over arrays of cosmologies, see `primordial_fractions`"""
+        return primordial_fractions(Omega_b, Omega_m, h, T_init=T_init, z_start=z_start,
+                                    ic=self, structured=structured)
+
+    def primordial_fraction_parameters(self):
+        """the CosmologySimulation<species>Fraction enzo parameters"""
+        initial_condition = self.calculate_fraction()
+        return {f"CosmologySimulation{k}Fraction": float(initial_condition[k])
+                for k in sorted(initial_condition)}
+
+    def add_primordial_initial_fraction(self, filename):
+        """set the initial fractions in the enzo parameter file `filename`"""
+        from parameter_files import EnzoParameters
+        params = EnzoParameters.read(filename)
+        params.update(self.primordial_fraction_parameters(), "Workflow")
+        params.write(filename)
@@ -0,0 +1,418 @@
+"""asyncio launcher and progress monitor for enzo runs
+
+`EnzoRun` starts `mpirun ... ./enzo` as a managed subprocess, tees its
+output into `enzo_run.out` as it arrives and parses the top grid cycle
+lines into an `EnzoProgress` stream (cycle, redshift, dt, deepest level,
+wall time per cycle). New `OutputLog` entries are picked up incrementally
+each cycle. Everything is driven by the child's output and asyncio
+timers, so many runs can be watched from one process without polling the
+filesystem.
+
+    runs = [EnzoRun(d, command) for d in run_dirs]
+    asyncio.run(monitor_runs(runs))
+
+Inside `checkpoint_on_signals()`, entered from the main thread, SIGTERM
+(or SIGUSR1, which batch systems send ahead of a wall limit) makes every
+active run ask enzo for a dump through its `outputNow` file; enzo is only
+terminated once that dump is logged or `checkpoint_grace` runs out.
+Outside of it signals keep their default and reach enzo directly.
+`run_with_restarts` relaunches enzo with `-r` from the latest intact dump
+after a crash, and resumes a preempted run the next time it is called.
+"""
+import os
+import re
+import json
+import time
+import signal
+import asyncio
+import logging
+import threading
+import contextlib
+import collections
+
+# EvolveHierarchy: "TopGrid dt = 6.4e-03     time = 0.81236    cycle = 1    z = 49.45"
+CYCLE_RE = re.compile(r"TopGrid dt = (\S+)\s+time = (\S+)\s+cycle = (\d+)(?:\s+z = (\S+))?")
+# printed for every level that is evolved with -d
+LEVEL_RE = re.compile(r"EvolveLevel\[(\d+)\]")
+
+
+# EnzoRuns currently running, with the event loop that drives each
+ACTIVE_RUNS = {}
+_active_lock = threading.Lock()
+PREEMPTION_SIGNALS = [signal.SIGTERM, signal.SIGUSR1]
+# progress snapshots kept for a slow (or absent) stream() reader
+UPDATE_BACKLOG = 100
+# marks a run directory whose enzo run finished, it is not resumed
+COMPLETED_FILE = ".enzo_completed"
+
+
+def dump_files(dataset):
+    """the grid files the hierarchy of `dataset` refers to"""
+    files = set()
+    with open(dataset + ".hierarchy") as f:
+        for l in f:
+            if l.startswith(("BaryonFileName", "ParticleFileName")):
+                name = l.split("=", 1)[1].strip()
+                files.add(os.path.join(os.path.dirname(dataset), os.path.basename(name)))
+    return sorted(files)
+
+
+def validate_dump(dataset):
+    """True if the parameter file, hierarchy and every grid file of
+    `dataset` exist, are non empty and (with h5py) open as HDF5"""
+    try:
+        if os.path.getsize(dataset) == 0 or os.path.getsize(dataset + ".hierarchy") == 0:
+            return False
+        files = dump_files(dataset)
+        if not files or any(os.path.getsize(f) == 0 for f in files):
+            return False
+    except OSError:
+        return False
+    try:
+        import h5py
+    except ImportError:
+        return True
+    try:
+        for f in files:
+            h5py.File(f, "r").close()
+    except OSError:
+        return False
+    return True
+
+
+def latest_dump(run_dir, newer_than=None):
+    """path of the newest intact dump listed in `run_dir`'s OutputLog (or None),
+    only dumps written after `newer_than` (a file, e.g. the parameter file) count"""
+    fname = os.path.join(run_dir, "OutputLog")
+    if not os.path.exists(fname):
+        return None
+    with open(fname) as f:
+        outputs = parse_output_log(f)
+    since = os.path.getmtime(newer_than) if newer_than and os.path.exists(newer_than) else None
+    for name, _, _ in reversed(outputs):
+        dataset = os.path.normpath(os.path.join(run_dir, name))
+        if since is not None and os.path.exists(dataset) and os.path.getmtime(dataset) < since:
+            break
+        if validate_dump(dataset):
+            return dataset
+        logging.warning(f"Skipping incomplete dump {dataset}")
+    return None
+
+
+def request_checkpoints(signum=None, frame=None):
+    """signal handler: every active run dumps and then stops"""
+    with _active_lock:
+        runs = list(ACTIVE_RUNS.items())
+    logging.info(f"Signal {signum}: checkpointing {len(runs)} enzo runs")
+    for run, loop in runs:
+        loop.call_soon_threadsafe(run.checkpoint_and_stop)
+
+
+@contextlib.contextmanager
+def checkpoint_on_signals():
+    """route SIGTERM/SIGUSR1 to `request_checkpoints` for the block and
+    restore the previous handlers after it; yields False (and does
+    nothing) outside of the main thread, where python cannot install them"""
+    if threading.current_thread() is not threading.main_thread():
+        yield False
+        return
+    previous = {sig: signal.signal(sig, request_checkpoints) for sig in PREEMPTION_SIGNALS}
+    try:
+        yield True
+    finally:
+        for sig, handler in previous.items():
+            signal.signal(sig, handler)
+
+
+def checkpointing():
+    """True while `checkpoint_on_signals` handles SIGTERM in this process"""
+    return signal.getsignal(signal.SIGTERM) is request_checkpoints
+
+
+class EnzoProgress:
+    """latest state of one enzo run"""
+    def __init__(self):
+        self.cycle          = None
+        self.time           = None
+        self.redshift       = None
+        self.dt             = None
+        self.max_level      = 0
+        self.wall_per_cycle = None
+        self.outputs        = []
+
+    def as_dict(self):
+        return {"cycle": self.cycle, "time": self.time, "redshift": self.redshift,
+                "dt": self.dt, "max_level": self.max_level,
+                "wall_per_cycle": self.wall_per_cycle,
+                "last_output": self.outputs[-1] if self.outputs else None}
+
+
+def parse_output_log(lines):
+    """(name, time, redshift) of every "DATASET WRITTEN" line"""
+    out = []
+    for l in lines:
+        fields = l.split()
+        if len(fields) >= 3 and fields[:2] == ["DATASET", "WRITTEN"]:
+            out.append((fields[2],
+                        float(fields[3]) if len(fields) > 3 else None,
+                        float(fields[4]) if len(fields) > 4 else None))
+    return out
+
+
+class EnzoRun:
+    """run and watch one enzo job
+
+    Parameters
+    ----------
+    run_dir       : str, directory enzo runs in
+    command       : list of str, e.g. ["mpirun", "-np", "32", "./enzo", "-d", "music_input.enzo"]
+    log_name      : str, where stdout/stderr are written inside `run_dir`
+    on_progress   : callable(run, progress), called after every top grid cycle
+    on_output     : callable(run, (name, time, redshift)), called once for every
+                    dataset enzo finished writing
+    checkpoint_grace : float, seconds to wait for the dump requested on preemption
+    append_log    : bool, append to `log_name` instead of truncating it (restarts)
+    cpus          : list of int, optional, cpus reserved for the run in the node's
+                    job queue (jobqueue.py); enzo and its ranks are pinned to them
+    threads       : int, optional, OMP_NUM_THREADS of every rank
+    on_stall      : callable(run, reason), defaults to logging a warning
+    stall_timeout : float, seconds without a new cycle before the run counts as stalled
+    dt_collapse   : float, dt below this fraction of the recent maximum counts as collapsing
+    stall_cycles  : int, consecutive collapsing cycles before the run counts as stalled
+    """
+    def __init__(self, run_dir, command, log_name="enzo_run.out",
+                 on_progress=None, on_stall=None, stall_timeout=3600.0,
+                 dt_collapse=1.0e-4, stall_cycles=20, on_output=None,
+                 checkpoint_grace=600.0, append_log=False, cpus=None, threads=None):
+        self.run_dir       = run_dir
+        self.command       = command
+        self.log_name      = log_name
+        self.on_progress   = on_progress
+        self.on_output     = on_output
+        self.checkpoint_grace = checkpoint_grace
+        self.append_log    = append_log
+        self.cpus          = cpus
+        self.threads       = threads
+        self.preempted     = False
+        self.stopped       = False
+        self.on_stall      = on_stall or self.log_stall
+        self.stall_timeout = stall_timeout
+        self.dt_collapse   = dt_collapse
+        self.stall_cycles  = stall_cycles
+
+        self.progress   = EnzoProgress()
+        self.proc       = None
+        self.returncode = None
+        self.updates    = asyncio.Queue(maxsize=UPDATE_BACKLOG)
+        self._dts       = collections.deque(maxlen=50)
+        self._collapsed = 0
+        self._last_cycle_wall = None
+        self._output_log_offset = 0
+        self._cycle_seen = None
+
+    @property
+    def name(self):
+        return os.path.basename(os.path.normpath(self.run_dir))
+
+    def log_stall(self, run, reason):
+        logging.warning(f"Enzo run {run.name} stalled: {reason}")
+
+    def terminate(self):
+        if self.proc is not None and self.proc.returncode is None:
+            logging.info(f"Terminating enzo run {self.name}")
+            self.proc.terminate()
+
+    def stop(self):
+        """stop enzo on purpose (a target was reached); it is not restarted"""
+        self.stopped = True
+        self.terminate()
+
+    def checkpoint_and_stop(self):
+        """ask enzo for a dump now and terminate it once the dump is logged"""
+        if self.preempted or self.proc is None or self.proc.returncode is not None:
+            return
+        self.preempted = True
+        logging.info(f"Requesting a dump from enzo run {self.name} before stopping")
+        open(os.path.join(self.run_dir, "outputNow"), "w").close()
+        asyncio.ensure_future(self._stop_after_dump(len(self.progress.outputs)))
+
+    async def _stop_after_dump(self, noutputs):
+        deadline = time.time() + self.checkpoint_grace
+        while self.proc.returncode is None and time.time() < deadline:
+            self.read_output_log()
+            if len(self.progress.outputs) > noutputs:
+                logging.info(f"Enzo run {self.name} wrote {self.progress.outputs[-1][0]}")
+                break
+            await asyncio.sleep(1.0)
+        else:
+            if self.proc.returncode is None:
+                logging.warning(f"Enzo run {self.name} wrote no dump within "
+                                f"{self.checkpoint_grace:.0f} s")
+        self.terminate()
+
+    def read_output_log(self):
+        """parse only the OutputLog lines written since the last call"""
+        fname = os.path.join(self.run_dir, "OutputLog")
+        if not os.path.exists(fname) or os.path.getsize(fname) <= self._output_log_offset:
+            return []
+        with open(fname) as f:
+            f.seek(self._output_log_offset)
+            chunk = f.read()
+        # leave a partially written last line for the next call
+        complete = chunk[:chunk.rfind("\n") + 1]
+        self._output_log_offset += len(complete.encode())
+        new = parse_output_log(complete.splitlines())
+        self.progress.outputs += new
+        if self.on_output:
+            # enzo logs a dataset only once it is completely written
+            for entry in new:
+                self.on_output(self, entry)
+        return new
+
+    def parse_line(self, line):
+        m = LEVEL_RE.search(line)
+        if m:
+            self.progress.max_level = max(self.progress.max_level, int(m.group(1)))
+            return
+        m = CYCLE_RE.search(line)
+        if not m:
+            return
+        p   = self.progress
+        now = time.time()
+        if self._last_cycle_wall is not None:
+            p.wall_per_cycle = now - self._last_cycle_wall
+        self._last_cycle_wall = now
+        p.dt, p.time, p.cycle = float(m.group(1)), float(m.group(2)), int(m.group(3))
+        if m.group(4) is not None:
+            p.redshift = float(m.group(4))
+        self.read_output_log()
+        self.check_dt_collapse(p.dt)
+
+        self._cycle_seen.set()
+        self.publish(p.as_dict())
+        with open(os.path.join(self.run_dir, "enzo_progress.jsonl"), "a") as f:
+            f.write(json.dumps(p.as_dict()) + "\n")
+        if self.on_progress:
+            self.on_progress(self, p)
+
+    def check_dt_collapse(self, dt):
+        if self._dts and dt < self.dt_collapse * max(self._dts):
+            self._collapsed += 1
+        else:
+            self._collapsed = 0
+        self._dts.append(dt)
+        if self._collapsed == self.stall_cycles:
+            self.on_stall(self, f"dt collapsed to {dt:.3e} for {self._collapsed} cycles "
+                                f"(recent max {max(self._dts):.3e})")
+
+    async def _read_output(self):
+        with open(os.path.join(self.run_dir, self.log_name), "a" if self.append_log else "w") as log:
+            async for raw in self.proc.stdout:
+                line = raw.decode(errors="replace")
+                log.write(line)
+                log.flush()
+                self.parse_line(line)
+
+    async def _watchdog(self):
+        while self.proc.returncode is None:
+            try:
+                await asyncio.wait_for(self._cycle_seen.wait(), self.stall_timeout)
+                self._cycle_seen.clear()
+            except asyncio.TimeoutError:
+                self.on_stall(self, f"no new cycle for {self.stall_timeout:.0f} s")
+
+    async def run(self):
+        """launch enzo and return its exit code once it finishes"""
+        self._cycle_seen = asyncio.Event()
+        logging.info(f"Launching enzo in {self.run_dir}: {' '.join(self.command)}")
+        command, env = self.command, None
+        if self.cpus is not None:
+            import jobqueue
+            command, env = jobqueue.pinned(self.command, self.cpus, self.threads)
+        # with checkpointing, its own session: a SIGTERM sent to our process
+        # group must not kill enzo before it dumps; without, it has to
+        self.proc = await asyncio.create_subprocess_exec(
+            *command, cwd=self.run_dir, start_new_session=checkpointing(), env=env,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        with _active_lock:
+            ACTIVE_RUNS[self] = asyncio.get_event_loop()
+        watchdog = asyncio.ensure_future(self._watchdog())
+        try:
+            await self._read_output()
+            self.returncode = await self.proc.wait()
+        except asyncio.CancelledError:
+            self.terminate()
+            await self.proc.wait()
+            raise
+        finally:
+            with _active_lock:
+                ACTIVE_RUNS.pop(self, None)
+            watchdog.cancel()
+            self.read_output_log()
+            self.publish(None)
+        logging.info(f"Enzo run {self.name} exited with {self.returncode}")
+        return self.returncode
+
+    def publish(self, update):
+        """queue `update` for `stream()`, dropping the oldest one when nobody
+        keeps up (run_enzo never reads the stream)"""
+        if self.updates.full():
+            self.updates.get_nowait()
+        self.updates.put_nowait(update)
+
+    async def stream(self):
+        """async iterator over progress snapshots, ends when the run exits"""
+        while True:
+            update = await self.updates.get()
+            if update is None:
+                return
+            yield update
+
+
+async def run_with_restarts(run_dir, command, restart_command, max_restarts=3,
+                            parameter_file=None, watch=None, **kwargs):
+    """run enzo in `run_dir`, resuming from the latest intact dump
+
+    Parameters
+    ----------
+    command         : list of str, fresh start
+    restart_command : callable(dataset) -> list of str, restart from a dump
+    max_restarts    : int, relaunches after enzo exits non zero
+    parameter_file  : str, optional, dumps older than this file belong to an
+                      earlier configuration and are never restarted from
+    watch           : coroutine function(run) -> exit code, optional, used
+                      instead of `run.run()` (e.g. InflightAnalysis.watch)
+
+    Returns the last EnzoRun; `run.preempted` is set when it was stopped by
+    a signal, the next call then resumes it. A run that finished, or was
+    stopped on purpose through `run.stop()`, is started from scratch again.
+    Raises once enzo still fails after `max_restarts` relaunches.
+    """
+    completed = os.path.join(run_dir, COMPLETED_FILE)
+    resume = not os.path.exists(completed)
+    if not resume and parameter_file and os.path.exists(parameter_file):
+        resume = os.path.getmtime(parameter_file) > os.path.getmtime(completed)
+    if os.path.exists(completed):
+        os.remove(completed)
+    for attempt in range(max_restarts + 1):
+        dump = latest_dump(run_dir, newer_than=parameter_file) if resume or attempt else None
+        if dump is None:
+            run = EnzoRun(run_dir, command, append_log=attempt > 0, **kwargs)
+        else:
+            logging.info(f"Restarting enzo in {run_dir} from {dump}")
+            run = EnzoRun(run_dir, restart_command(os.path.relpath(dump, run_dir)),
+                          append_log=True, **kwargs)
+        returncode = await (watch(run) if watch else run.run())
+        if (returncode == 0 or run.stopped) and not run.preempted:
+            open(completed, "w").close()
+        if returncode == 0 or run.preempted or run.stopped:
+            return run
+        logging.warning(f"Enzo run {run.name} exited with {returncode} "
+                        f"(attempt {attempt + 1} of {max_restarts + 1})")
+    raise Exception(f"enzo in {run_dir} failed {max_restarts + 1} times, "
+                    f"last exit code {run.returncode}, see {os.path.join(run_dir, run.log_name)}")
+
+
+async def monitor_runs(runs):
+    """run several EnzoRun concurrently, return their exit codes"""
+    return await asyncio.gather(*(r.run() for r in runs))
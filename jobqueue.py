@@ -0,0 +1,191 @@
+"""Node wide admission of make, MUSIC and mpirun jobs.
+
+Every workflow process on a node shares one ledger,
+`<build cache>/jobqueue/<hostname>.json`, updated under `flock`. A job
+asks for a number of cpus (ranks x threads) and optionally memory;
+`reserve` blocks until that much is free, hands out cpus no other job
+holds and releases them when the job ends. Jobs run pinned to their cpus
+(`pinned` wraps the command in `taskset`), so concurrent workflows and
+sweeps share the node instead of oversubscribing it. Reservations of
+processes that died are dropped.
+
+    with jobqueue.reserve(8, name="make") as cpus:
+        command, env = jobqueue.pinned(["make", "-j8"], cpus)
+        subprocess.run(command, env=env)
+"""
+import os
+import json
+import time
+import shutil
+import socket
+import itertools
+import logging
+import contextlib
+
+import workflow_cache
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+QUEUE_DIR = os.path.join(workflow_cache.BUILD_CACHE, "jobqueue")
+# share of the node's memory jobs may reserve
+MEMORY_FRACTION = 0.9
+POLL_INTERVAL = 1.0
+
+_job_ids = itertools.count()
+
+
+def node_cpus():
+    """cpus this process may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def node_memory():
+    """total memory of the node in bytes, None if unknown"""
+    try:
+        with open("/proc/meminfo") as f:
+            for l in f:
+                if l.startswith("MemTotal:"):
+                    return int(l.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobQueue:
+    """the node's cpu/memory ledger
+
+    Parameters
+    ----------
+    cpus   : list of int, cpus jobs may be pinned to, defaults to this process' affinity
+    memory : int, bytes jobs may reserve in total, defaults to MEMORY_FRACTION of the node
+    """
+    def __init__(self, cpus=None, memory=None, queue_dir=QUEUE_DIR):
+        self.cpus   = cpus or node_cpus()
+        total       = node_memory()
+        self.memory = memory or (int(total * MEMORY_FRACTION) if total else None)
+        os.makedirs(queue_dir, exist_ok=True)
+        self.ledger = os.path.join(queue_dir, f"{socket.gethostname()}.json")
+
+    @contextlib.contextmanager
+    def locked(self):
+        """the ledger, written back when the block exits"""
+        with open(self.ledger + ".lock", "w") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            state = {"jobs": {}, "waiting": {}}
+            if os.path.exists(self.ledger):
+                with open(self.ledger) as f:
+                    state = json.load(f)
+            for table in state.values():
+                for job_id in [j for j, job in table.items() if not pid_alive(job["pid"])]:
+                    logging.info(f"Dropping reservation {job_id} of a dead process")
+                    del table[job_id]
+            yield state
+            tmp = self.ledger + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(state, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.ledger)
+
+    def try_reserve(self, state, job_id, ncpus, memory):
+        busy = {c for job in state["jobs"].values() for c in job["cpus"]}
+        free = [c for c in self.cpus if c not in busy]
+        used = sum(job["memory"] for job in state["jobs"].values())
+        if len(free) < ncpus:
+            return None
+        if memory and self.memory and used + memory > self.memory:
+            return None
+        # an earlier waiter that also fits goes first
+        mine = state["waiting"].get(job_id, {}).get("since", time.time())
+        for other, w in state["waiting"].items():
+            if other != job_id and w["since"] < mine and w["cpus"] <= len(free) and \
+               not (w["memory"] and self.memory and used + w["memory"] > self.memory):
+                return None
+        cpus = free[:ncpus]
+        state["waiting"].pop(job_id, None)
+        state["jobs"][job_id] = {"pid": os.getpid(), "cpus": cpus, "memory": memory,
+                                 "name": job_id.rsplit(":", 1)[-1], "since": time.time()}
+        return cpus
+
+    @contextlib.contextmanager
+    def reserve(self, ncpus, memory=0, name="job"):
+        """block until `ncpus` cpus and `memory` bytes are free, yield the cpus"""
+        if ncpus > len(self.cpus):
+            logging.warning(f"{name} asks for {ncpus} cpus, the node only has {len(self.cpus)}")
+            ncpus = len(self.cpus)
+        if memory and self.memory and memory > self.memory:
+            # it would wait forever otherwise
+            logging.warning(f"{name} asks for {memory / 1024**3:.1f} GB, jobs may only "
+                            f"reserve {self.memory / 1024**3:.1f} GB")
+            memory = self.memory
+        job_id = f"{os.getpid()}:{next(_job_ids)}:{name}"
+        waited = time.time()
+        while True:
+            with self.locked() as state:
+                cpus = self.try_reserve(state, job_id, ncpus, memory)
+                if cpus is None:
+                    state["waiting"].setdefault(job_id, {"pid": os.getpid(), "cpus": ncpus,
+                                                         "memory": memory, "name": name,
+                                                         "since": waited})
+            if cpus is not None:
+                break
+            time.sleep(POLL_INTERVAL)
+        if time.time() - waited > POLL_INTERVAL:
+            logging.info(f"{name} waited {time.time() - waited:.0f} s for {ncpus} cpus")
+        logging.info(f"{name} runs on cpus {cpus}")
+        try:
+            yield cpus
+        finally:
+            with self.locked() as state:
+                state["jobs"].pop(job_id, None)
+                state["waiting"].pop(job_id, None)
+
+
+_queue = None
+
+
+def reserve(ncpus, memory=0, name="job"):
+    """`JobQueue.reserve` on the node's shared queue"""
+    global _queue
+    if _queue is None:
+        _queue = JobQueue()
+    return _queue.reserve(ncpus, memory, name)
+
+
+def fit_layout(ranks, threads, ncpus=None):
+    """(ranks, threads) with ranks x threads <= `ncpus` (the node's cpus)"""
+    ncpus = ncpus or len(node_cpus())
+    ranks = max(1, min(ranks, ncpus))
+    return ranks, max(1, min(threads, ncpus // ranks))
+
+
+def pinned(command, cpus, threads=None):
+    """(command, env) that run `command` on `cpus`
+
+    The command is started through `taskset` rather than a preexec_fn,
+    which is not safe in the threaded workflow processes. The affinity is
+    inherited by everything the job starts, MPI ranks included, since
+    OpenMPI is told not to rebind them.
+    """
+    env = dict(os.environ)
+    env["OMPI_MCA_hwloc_base_binding_policy"] = "none"
+    if threads is not None:
+        env["OMP_NUM_THREADS"] = str(threads)
+    if shutil.which("taskset") is None:
+        logging.warning(f"taskset not found, {command[0]} runs unpinned")
+        return list(command), env
+    return ["taskset", "-c", ",".join(map(str, sorted(cpus)))] + list(command), env
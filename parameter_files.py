@@ -0,0 +1,163 @@
+"""Enzo parameter files and MUSIC configs, built in memory and written once.
+
+An enzo run's parameter file is assembled from MUSIC's
+`parameter_file.txt`, the rendered simulation template, the `enzo_configs`
+values and the primordial species fractions:
+
+    params = EnzoParameters.read("run/parameter_file.txt", "Configurations from MUSIC")
+    params.merge(EnzoParameters.parse(rendered, "Enzo Simulation Configs"))
+    params.update(enzo_parameters(config["enzo_configs"]))
+    params.write("run/music_input.enzo")
+
+A parameter set again replaces the earlier value where it first appeared,
+so every name is written exactly once, in the section it came from.
+"""
+import os
+import logging
+
+# enzo_configs keys that are not enzo parameter names
+ENZO_PARAMETER_NAMES = {"FinalRedshift": "CosmologyFinalRedshift"}
+NAME_WIDTH = 40
+
+
+def format_value(value):
+    """an enzo/MUSIC parameter value as text"""
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, (list, tuple)):
+        return " ".join(format_value(v) for v in value)
+    return str(value)
+
+
+class EnzoParameters:
+    """an enzo parameter file: ordered name -> value, grouped in sections"""
+    def __init__(self):
+        self.values   = {}
+        self.comments = {}
+        self.sections = []
+
+    @classmethod
+    def parse(cls, text, section=None):
+        """parameters of enzo parameter file text; `#` lines and parameters
+        without a value are dropped, trailing `//` comments are kept"""
+        params = cls()
+        for number, line in enumerate(text.splitlines(), 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if "=" not in line:
+                logging.warning(f"Skipping line {number} of {section or 'parameters'}: {line}")
+                continue
+            name, _, value = line.partition("=")
+            value, _, comment = value.partition("//")
+            if not value.strip():
+                # a template variable the config leaves unset, enzo keeps its default
+                continue
+            params.set(name.strip(), value.strip(), section, comment.strip() or None)
+        return params
+
+    @classmethod
+    def read(cls, filename, section=None):
+        with open(filename) as f:
+            return cls.parse(f.read(), section or os.path.basename(filename))
+
+    def section(self, title):
+        for t, names in self.sections:
+            if t == title:
+                return names
+        self.sections.append((title, []))
+        return self.sections[-1][1]
+
+    def set(self, name, value, section=None, comment=None):
+        """set `name`; a new name goes to the end of `section`"""
+        if name not in self.values:
+            self.section(section).append(name)
+        self.values[name] = format_value(value)
+        if comment is not None:
+            self.comments[name] = comment
+
+    def update(self, params, section=None):
+        """set every name -> value of the mapping `params`"""
+        for name, value in params.items():
+            self.set(name, value, section)
+
+    def merge(self, other):
+        """layer the EnzoParameters `other` over these"""
+        for title, names in other.sections:
+            for name in names:
+                self.set(name, other.values[name], title, other.comments.get(name))
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    def __setitem__(self, name, value):
+        self.set(name, value)
+
+    def __contains__(self, name):
+        return name in self.values
+
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+    def format(self):
+        lines = []
+        for title, names in self.sections:
+            if not names:
+                continue
+            if title is not None:
+                lines.append(f"# [{title}]")
+            for name in names:
+                line = f"{name:<{NAME_WIDTH}} = {self.values[name]}"
+                if name in self.comments:
+                    line += f"  // {self.comments[name]}"
+                lines.append(line)
+            lines.append("")
+        return "\n".join(lines)
+
+    def write(self, filename):
+        """write the parameter file in one go, replacing `filename` atomically
+
+        An identical file is left alone: enzo_monitor only resumes from
+        dumps newer than the parameter file, so rewriting the same
+        parameters would throw away a killed run's dumps. Returns True if
+        the file was written.
+        """
+        text = self.format()
+        if os.path.exists(filename):
+            with open(filename) as f:
+                if f.read() == text:
+                    return False
+        tmp = filename + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(text)
+        os.replace(tmp, filename)
+        return True
+
+
+def enzo_parameters(enzo_configs):
+    """the `enzo_configs` section as enzo parameter names -> values"""
+    return {ENZO_PARAMETER_NAMES.get(k, k): v for k, v in (enzo_configs or {}).items()}
+
+
+def format_music_config(music_configs, output_filename=None):
+    """MUSIC's ini config from the `music_configs` sections; `output_filename`
+    sets [output] filename, where MUSIC writes the ICs"""
+    sections = {k: dict(v) for k, v in music_configs.items()}
+    if output_filename is not None:
+        sections.setdefault("output", {})["filename"] = output_filename
+    lines = []
+    for section, values in sections.items():
+        lines.append(f"[{section}]")
+        for param, value in values.items():
+            if isinstance(value, bool):
+                value = "yes" if value else "no"
+            lines.append(f"{param:10} = {format_value(value)}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def write_music_config(music_configs, filename, output_filename=None):
+    with open(filename, "w") as f:
+        f.write(format_music_config(music_configs, output_filename))
@@ -0,0 +1,189 @@
+"""Accuracy vs. cost of the dengo solver options and tolerances.
+
+    python pareto.py mynetwork --solver-option be_chem cv_omp \
+        --reltol 1e-3 1e-4 1e-5 1e-6 --error-budget 1e-2 --out pareto.json
+
+A fixed library of one-zone free-fall collapse trajectories (initial
+densities / temperatures on a grid, species from the enzo primordial
+initial fractions) is integrated by every (solver_option, reltol) setting,
+each in its own process, one after the other: wall time is the cost
+measure, and settings sharing the cores would time each other's
+contention. All settings follow the same
+density path: each segment compresses the gas by the free-fall rate and
+heats it adiabatically, then the solver integrates the chemistry over the
+segment. Every setting's final abundances are compared with a tight
+tolerance reference run; the wall time, ODE steps and error of every
+setting, and the settings on the (wall time, error) Pareto front, are
+written to `--out`.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+
+import solver_bench
+
+G = 6.67430e-8
+
+
+def free_fall_time(density):
+    return np.sqrt(3.0*np.pi / (32.0*G*density))
+
+
+def collapse(run, init_values, nsegments, safety=0.1, gamma=5.0/3.0, reltol=None):
+    """integrate the cells of `init_values` along a free-fall collapse
+
+    Returns the final state, the total ODE steps and failed steps.
+    """
+    state = dict(init_values)
+    steps = failures = 0
+    for _ in range(nsegments):
+        density = state["density"]
+        dt      = safety*free_fall_time(density).min()
+        rv, rv_int = solver_bench.integrate(run, state, dt, reltol=reltol)
+        s, f = solver_bench.step_stats(rv_int)
+        steps, failures = steps + s, failures + f
+
+        # the density path only depends on the density, the same for every setting
+        compression = 1.0 + dt / free_fall_time(density)
+        state = {k: np.asarray(v, dtype=float).ravel() * compression
+                 for k, v in rv.items() if k not in ("T", "ge", "density")}
+        state["density"] = density*compression
+        state["ge"] = np.asarray(rv["ge"], dtype=float).ravel() * compression**(gamma - 1.0)
+    return state, steps, failures
+
+
+def run_setting(build_dir, solver_name, ntraj, nsegments, reltol, out, threads=1):
+    """one setting over the trajectory library in this process, saves the final state to `out`"""
+    with open(os.path.join(build_dir, "species.json")) as f:
+        species = json.load(f)
+    solver_bench.require_reltol(build_dir, solver_name, reltol)
+    run = solver_bench.load_solver(build_dir, solver_name, threads)
+    init_values = solver_bench.synthetic_cells(species, ntraj, density_range=(1e-24, 1e-20),
+                                               temperature_range=(1e2, 1e3))
+    t0 = time.perf_counter()
+    state, steps, failures = collapse(run, init_values, nsegments, reltol=reltol)
+    wall = time.perf_counter() - t0
+    np.savez(out, **state)
+    return {"reltol": reltol, "wall": wall, "ode_steps": steps, "failures": failures,
+            "state": out}
+
+
+def run_setting_subprocess(**kwargs):
+    p = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", json.dumps(kwargs)],
+                       stdout=subprocess.PIPE, universal_newlines=True,
+                       cwd=os.path.dirname(os.path.abspath(__file__)))
+    if p.returncode != 0:
+        return {"reltol": kwargs["reltol"], "error": f"worker exited with {p.returncode}"}
+    return json.loads(p.stdout.splitlines()[-1])
+
+
+def abundance_error(state, reference, floor=1e-20):
+    """max and median |log10(x / x_ref)| of the mass fractions over species
+    and trajectories, fractions below `floor` count as `floor`"""
+    errors = []
+    for k, ref in reference.items():
+        if k in ("density", "ge"):
+            continue
+        x   = np.maximum(np.abs(state[k]) / state["density"], floor)
+        ref = np.maximum(np.abs(ref) / reference["density"], floor)
+        errors.append(np.abs(np.log10(x / ref)))
+    errors = np.concatenate(errors)
+    return float(errors.max()), float(np.median(errors))
+
+
+def pareto_front(results, cost="wall", error="max_error"):
+    """the settings no other setting beats in both cost and error"""
+    ok = [r for r in results if error in r]
+    return [r for r in ok
+            if not any(o[cost] <= r[cost] and o[error] <= r[error] and
+                       (o[cost] < r[cost] or o[error] < r[error]) for o in ok)]
+
+
+def explore(network_spec, solver_options, reltols, reference=("cv_omp", 1e-10), ntraj=64,
+            nsegments=50, build_root="pareto_build"):
+    """run every (solver_option, reltol) and the reference, return the result records"""
+    network = solver_bench.load_network(network_spec)
+    solver_name = network_spec.partition(":")[0] + "_pareto"
+    settings = [(o, r) for o in solver_options for r in reltols]
+    if tuple(reference) not in settings:
+        settings.append(tuple(reference))
+    for option in {o for o, _ in settings}:
+        solver_bench.write_benchmark_solver(network, option, solver_name,
+                                            os.path.abspath(os.path.join(build_root, option)))
+        # compile outside of the timed runs
+        run_setting_subprocess(build_dir=os.path.abspath(os.path.join(build_root, option)),
+                               solver_name=solver_name, ntraj=1, nsegments=1, reltol=None,
+                               out=os.path.abspath(os.path.join(build_root, option, "warmup.npz")))
+
+    results = []
+    for option, reltol in settings:
+        build_dir = os.path.abspath(os.path.join(build_root, option))
+        r = run_setting_subprocess(build_dir=build_dir, solver_name=solver_name, ntraj=ntraj,
+                                   nsegments=nsegments, reltol=reltol,
+                                   out=os.path.join(build_dir, f"state_{reltol:g}.npz"))
+        r.update(solver_option=option, reltol=reltol)
+        print(json.dumps(r))
+        results.append(r)
+
+    ref = [r for r in results if (r["solver_option"], r["reltol"]) == tuple(reference)][0]
+    if "error" in ref:
+        raise Exception(f"reference run {reference} failed: {ref['error']}")
+    with np.load(ref["state"]) as f:
+        ref_state = dict(f)
+    for r in results:
+        if "error" in r:
+            continue
+        with np.load(r["state"]) as f:
+            r["max_error"], r["median_error"] = abundance_error(dict(f), ref_state)
+        r["reference"] = r is ref
+    return results
+
+
+def cheapest_within(results, budget, error="max_error"):
+    ok = [r for r in results if error in r and not r["reference"] and r[error] <= budget]
+    return min(ok, key=lambda r: r["wall"]) if ok else None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--worker":
+        print(json.dumps(run_setting(**json.loads(sys.argv[2]))))
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="solver accuracy vs. cost explorer")
+    parser.add_argument("network", nargs="?", default="mynetwork:setup_network")
+    parser.add_argument("--solver-option", nargs="+", default=["be_chem", "cv_omp"],
+                        choices=sorted(solver_bench.SOLVER_OPTIONS))
+    parser.add_argument("--reltol", nargs="+", type=float, default=[1e-3, 1e-4, 1e-5, 1e-6])
+    parser.add_argument("--reference", nargs=2, default=["cv_omp", "1e-10"],
+                        metavar=("SOLVER_OPTION", "RELTOL"))
+    parser.add_argument("--trajectories", type=int, default=64)
+    parser.add_argument("--segments", type=int, default=50)
+    parser.add_argument("--error-budget", type=float, default=None,
+                        help="max |log10| abundance error for the recommendation")
+    parser.add_argument("--build-dir", default="pareto_build")
+    parser.add_argument("--out", default="pareto.json")
+    args = parser.parse_args()
+
+    results = explore(args.network, args.solver_option, args.reltol,
+                      reference=(args.reference[0], float(args.reference[1])),
+                      ntraj=args.trajectories, nsegments=args.segments,
+                      build_root=args.build_dir)
+    front = pareto_front([r for r in results if not r.get("reference")])
+    with open(args.out, "w") as f:
+        json.dump({"results": results, "pareto_front": front, "timing": "serial"}, f, indent=2)
+
+    print("Pareto front (each setting timed alone, one after the other):")
+    for r in sorted(front, key=lambda r: r["wall"]):
+        print("    {:8s} reltol = {:8.1e}  wall = {:8.3f} s  max error = {:.3e}  steps = {}".format(
+            r["solver_option"], r["reltol"], r["wall"], r["max_error"], r["ode_steps"]))
+    if args.error_budget is not None:
+        best = cheapest_within(results, args.error_budget)
+        if best is None:
+            print(f"no setting within an error of {args.error_budget:g}")
+        else:
+            print(f"cheapest within {args.error_budget:g}: solver_option = {best['solver_option']}, "
+                  f"dengo_reltol = {best['reltol']:g}")
@@ -0,0 +1,314 @@
+"""SQLite registry of workflow runs.
+
+    python run_registry.py query enzo_configs.dengo_reltol=1e-5 \
+        music_configs.setup.levelmax=8 --reached-redshift 17
+    python run_registry.py show cvode_run12345
+
+The workflows record every run they start (`recording`): its run
+directory, the flattened config and its hash, and when it finishes the
+status, stage timings from `workflow_trace.json`, the artifacts it left
+(datasets, analysis summaries, halo files), the last redshift enzo wrote and
+a halo summary. Every config value is a row of `params` indexed on
+(key, value), so lookups by any parameter (reltol, levelmax, seed, ...)
+stay index scans however many runs there are. The database defaults to
+`runs.sqlite` in the working directory (`WORKFLOW_RUN_REGISTRY`).
+"""
+import os
+import sys
+import glob
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import contextlib
+
+import workflow_cache
+import workflow_profile
+
+REGISTRY = os.environ.get("WORKFLOW_RUN_REGISTRY", "runs.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id              INTEGER PRIMARY KEY,
+    run_directory   TEXT UNIQUE NOT NULL,
+    workflow        TEXT,
+    config_hash     TEXT,
+    config          TEXT,
+    status          TEXT,
+    started         REAL,
+    finished        REAL,
+    final_output    TEXT,
+    final_redshift  REAL,
+    final_time      REAL,
+    halo_count      INTEGER,
+    halo_max_mass   REAL,
+    halo_position   TEXT
+);
+CREATE TABLE IF NOT EXISTS params (
+    run_id      INTEGER REFERENCES runs(id) ON DELETE CASCADE,
+    key         TEXT,
+    value_num   REAL,
+    value_text  TEXT
+);
+CREATE TABLE IF NOT EXISTS stages (
+    run_id      INTEGER REFERENCES runs(id) ON DELETE CASCADE,
+    name        TEXT,
+    cat         TEXT,
+    start       REAL,
+    wall        REAL,
+    cpu         REAL,
+    peak_rss_kb INTEGER
+);
+CREATE TABLE IF NOT EXISTS artifacts (
+    run_id      INTEGER REFERENCES runs(id) ON DELETE CASCADE,
+    kind        TEXT,
+    path        TEXT
+);
+CREATE INDEX IF NOT EXISTS params_num  ON params (key, value_num, run_id);
+CREATE INDEX IF NOT EXISTS params_text ON params (key, value_text, run_id);
+CREATE INDEX IF NOT EXISTS params_run  ON params (run_id);
+CREATE INDEX IF NOT EXISTS stages_run  ON stages (run_id);
+CREATE INDEX IF NOT EXISTS artifacts_run ON artifacts (run_id);
+CREATE INDEX IF NOT EXISTS runs_redshift ON runs (final_redshift);
+CREATE INDEX IF NOT EXISTS runs_hash   ON runs (config_hash);
+CREATE INDEX IF NOT EXISTS runs_status ON runs (status);
+"""
+
+
+def flatten(config, prefix=""):
+    """{"a": {"b": 1}} -> {"a.b": 1}, the `section.key` names sweeps use"""
+    out = {}
+    for k, v in config.items():
+        key = f"{prefix}{k}"
+        if isinstance(v, dict):
+            out.update(flatten(v, key + "."))
+        else:
+            out[key] = v
+    return out
+
+
+def param_value(value):
+    """(value_num, value_text) of a config value"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value), None
+    if isinstance(value, str):
+        try:
+            return float(value), None
+        except ValueError:
+            return None, value
+    return None, json.dumps(value, default=str)
+
+
+def run_artifacts(run_dir):
+    """(kind, path) of what a run left behind"""
+    out = []
+    output_log = os.path.join(run_dir, "OutputLog")
+    if os.path.exists(output_log):
+        from enzo_monitor import parse_output_log
+        with open(output_log) as f:
+            out += [("dataset", os.path.normpath(os.path.join(run_dir, name)))
+                    for name, _, _ in parse_output_log(f)]
+    for kind, pattern in [("analysis", os.path.join(run_dir, "analysis", "*.npz")),
+                          ("trace", os.path.join(run_dir, workflow_profile.TRACE_FILE)),
+                          ("log", os.path.join(run_dir, "enzo_run.out")),
+                          ("progress", os.path.join(run_dir, "enzo_progress.jsonl")),
+                          ("halos", f"{os.path.normpath(run_dir)}_halo_*.npy"),
+                          ("halos", f"{os.path.normpath(run_dir)}_halo_catalogs"),
+                          ("candidate", f"{os.path.normpath(run_dir)}_candidate.json")]:
+        out += [(kind, os.path.abspath(p)) for p in sorted(glob.glob(pattern))]
+    return out
+
+
+def final_output(run_dir):
+    """(name, time, redshift) of the last dataset in OutputLog, or None"""
+    output_log = os.path.join(run_dir, "OutputLog")
+    if not os.path.exists(output_log):
+        return None
+    from enzo_monitor import parse_output_log
+    with open(output_log) as f:
+        outputs = parse_output_log(f)
+    return outputs[-1] if outputs else None
+
+
+class RunRegistry:
+    """the run database at `path`"""
+    def __init__(self, path=REGISTRY):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60.0)
+        self.db.row_factory = sqlite3.Row
+        # sweep workers record from several processes at once
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA foreign_keys=ON")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def run_id(self, run_dir):
+        row = self.db.execute("SELECT id FROM runs WHERE run_directory = ?",
+                              (os.path.abspath(run_dir),)).fetchone()
+        return row["id"] if row else None
+
+    def record_start(self, run_dir, config, workflow=None):
+        """register (or reset) `run_dir` as running with `config`"""
+        run_dir = os.path.abspath(run_dir)
+        with self.db:
+            self.db.execute(
+                "INSERT INTO runs (run_directory, workflow, status, started) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(run_directory) DO UPDATE SET workflow = excluded.workflow, "
+                "status = excluded.status, started = excluded.started, finished = NULL",
+                (run_dir, workflow, "running", time.time()))
+            self.set_config(self.run_id(run_dir), config)
+        return self.run_id(run_dir)
+
+    def set_config(self, run_id, config):
+        self.db.execute("UPDATE runs SET config = ?, config_hash = ? WHERE id = ?",
+                        (json.dumps(config, default=str), workflow_cache.hash_config(config),
+                         run_id))
+        self.db.execute("DELETE FROM params WHERE run_id = ?", (run_id,))
+        self.db.executemany("INSERT INTO params VALUES (?, ?, ?, ?)",
+                            [(run_id, k, *param_value(v)) for k, v in flatten(config).items()])
+
+    def record_finish(self, run_dir, status, config=None, halo_positions=None, halo_mass=None):
+        """status, timings, artifacts, final redshift and halos of a finished run"""
+        run_id = self.run_id(run_dir)
+        if run_id is None:
+            run_id = self.record_start(run_dir, config or {})
+        last = final_output(run_dir)
+        halos = (None, None, None)
+        if halo_mass is not None and len(halo_mass):
+            i = int(halo_mass.argmax())
+            halos = (int(len(halo_mass)), float(halo_mass[i]),
+                     json.dumps([float(p) for p in halo_positions[:, i]]))
+        with self.db:
+            if config is not None:
+                self.set_config(run_id, config)
+            self.db.execute(
+                "UPDATE runs SET status = ?, finished = ?, final_output = ?, final_time = ?, "
+                "final_redshift = ?, halo_count = ?, halo_max_mass = ?, halo_position = ? "
+                "WHERE id = ?",
+                (status, time.time(), *(last if last else (None, None, None)), *halos, run_id))
+            self.db.execute("DELETE FROM stages WHERE run_id = ?", (run_id,))
+            self.db.executemany("INSERT INTO stages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                [(run_id, *s) for s in stage_timings(run_dir)])
+            self.db.execute("DELETE FROM artifacts WHERE run_id = ?", (run_id,))
+            self.db.executemany("INSERT INTO artifacts VALUES (?, ?, ?)",
+                                [(run_id, k, p) for k, p in run_artifacts(run_dir)])
+
+    def query(self, params=None, reached_redshift=None, status=None):
+        """runs whose config has every (dotted key, value) of `params`,
+        that got to `reached_redshift` or lower"""
+        sql, args = ["SELECT * FROM runs WHERE 1"], []
+        for key, value in (params or {}).items():
+            num, text = param_value(value)
+            if num is not None:
+                sql.append("AND id IN (SELECT run_id FROM params WHERE key = ? AND value_num = ?)")
+                args += [key, num]
+            else:
+                sql.append("AND id IN (SELECT run_id FROM params WHERE key = ? AND value_text = ?)")
+                args += [key, text]
+        if reached_redshift is not None:
+            sql.append("AND final_redshift <= ?")
+            args.append(reached_redshift)
+        if status is not None:
+            sql.append("AND status = ?")
+            args.append(status)
+        return [dict(r) for r in self.db.execute(" ".join(sql) + " ORDER BY id", args)]
+
+    def show(self, run_dir):
+        """everything recorded about `run_dir`"""
+        run_id = self.run_id(run_dir)
+        if run_id is None:
+            return None
+        run = dict(self.db.execute("SELECT * FROM runs WHERE id = ?", (run_id,)).fetchone())
+        run["config"] = json.loads(run["config"]) if run["config"] else None
+        run["stages"] = [dict(r) for r in self.db.execute(
+            "SELECT name, cat, start, wall, cpu, peak_rss_kb FROM stages WHERE run_id = ?", (run_id,))]
+        run["artifacts"] = [dict(r) for r in self.db.execute(
+            "SELECT kind, path FROM artifacts WHERE run_id = ?", (run_id,))]
+        return run
+
+
+def stage_timings(run_dir):
+    """(name, cat, start, wall, cpu, peak_rss_kb) of every event in the run's trace"""
+    trace = os.path.join(run_dir, workflow_profile.TRACE_FILE)
+    if not os.path.exists(trace):
+        return []
+    with open(trace) as f:
+        events = json.load(f)["traceEvents"]
+    return [(e["name"], e["cat"], e["ts"] / 1e6, e["dur"] / 1e6,
+             e["args"].get("cpu", 0.0) + e["args"].get("children_cpu", 0.0),
+             e["args"].get("peak_rss_kb", e["args"].get("children_peak_rss_kb")))
+            for e in events]
+
+
+@contextlib.contextmanager
+def recording(workflow, path=None):
+    """register `workflow`'s run directory while the block runs
+
+    Enter it outside `workflow_profile.trace_to`, so the trace is written
+    by the time the run is recorded as finished.
+    """
+    if path is None:
+        path = REGISTRY
+    try:
+        registry = RunRegistry(path)
+        registry.record_start(workflow.test_dir, workflow.config, type(workflow).__name__)
+    except sqlite3.Error as e:
+        logging.warning(f"Not recording {workflow.test_dir} in {path}: {e}")
+        yield None
+        return
+    status = "failed"
+    try:
+        yield registry
+        status = "finished"
+    finally:
+        try:
+            registry.record_finish(workflow.test_dir, status, workflow.config,
+                                   getattr(workflow, "halo_positions", None),
+                                   getattr(workflow, "halo_mass", None))
+        except sqlite3.Error as e:
+            logging.warning(f"Not recording {workflow.test_dir} in {path}: {e}")
+        registry.close()
+
+
+def parse_param(arg):
+    key, _, value = arg.partition("=")
+    if not value:
+        raise Exception(f"expected key=value, got {arg}")
+    return key, value
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="query the run registry")
+    parser.add_argument("--registry", default=REGISTRY)
+    sub = parser.add_subparsers(dest="command")
+    q = sub.add_parser("query", help="runs matching section.key=value parameters")
+    q.add_argument("params", nargs="*", type=parse_param)
+    q.add_argument("--reached-redshift", type=float, default=None)
+    q.add_argument("--status", default=None)
+    q.add_argument("--json", action="store_true")
+    s = sub.add_parser("show", help="everything recorded about a run directory")
+    s.add_argument("run_directory")
+    args = parser.parse_args()
+
+    registry = RunRegistry(args.registry)
+    if args.command == "query":
+        runs = registry.query(dict(args.params), args.reached_redshift, args.status)
+        if args.json:
+            print(json.dumps(runs, indent=2))
+        else:
+            for r in runs:
+                print("{:40s} {:9s} z = {:>8s}  halos = {}".format(
+                    r["run_directory"], r["status"] or "",
+                    f"{r['final_redshift']:.3f}" if r["final_redshift"] is not None else "-",
+                    r["halo_count"] if r["halo_count"] is not None else "-"))
+    elif args.command == "show":
+        run = registry.show(args.run_directory)
+        if run is None:
+            print(f"{args.run_directory} is not registered")
+            sys.exit(1)
+        print(json.dumps(run, indent=2))
+    else:
+        parser.print_help()
@@ -0,0 +1,197 @@
+"""Benchmark a generated dengo solver outside of enzo.
+
+    python solver_bench.py mynetwork --solver-option be_chem cv_omp \
+        --cells 1e3 1e5 1e7 --threads 1 8 32 --out solver_bench.json
+
+The network is taken from `<module>:<function>` (`mynetwork:setup_network`
+by default, `utilities:setup_primordial_network` works too). The solver
+is generated once per solver option; every (threads, cells) point then
+runs in its own python process, which compiles the solver's python
+extension with -DNTHREADS for that thread count (into `_pyxbuild_<threads>`
+of the build directory, so every thread count has its own build) and
+integrates a batch of synthetic cells spanning a density/temperature grid.
+Every point's cells/second, time per cell, ODE steps and failed ODE steps
+are written as a JSON list to `--out`.
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+
+import workflow_cache
+from workflow_config import SOLVER_OPTIONS
+from enzo_chemistry import EnzoChemistryInitialCondition
+
+kboltz = 1.3806504e-16
+mh     = 1.67262171e-24
+
+
+def load_network(spec, **kwargs):
+    """build (or load the snapshot of) a ChemicalNetwork from "module" or "module:function" """
+    module, _, func = spec.partition(":")
+    return workflow_cache.cached_network(module, func or "setup_network", **kwargs)
+
+
+def write_benchmark_solver(network, solver_option, solver_name, build_dir):
+    """generate the solver sources for `solver_option` into `build_dir`"""
+    if solver_option not in SOLVER_OPTIONS:
+        raise Exception(f"Solver {solver_option} not implemented")
+    solver_template, ode_solver_source = SOLVER_OPTIONS[solver_option]
+    os.makedirs(build_dir, exist_ok=True)
+    network.write_solver(solver_name, solver_template=solver_template,
+                         ode_solver_source=ode_solver_source, output_dir=build_dir)
+    # the workers only need species weights to set up cells, not dengo itself
+    species = {s.name: float(s.weight) for s in network.required_species}
+    with open(os.path.join(build_dir, "species.json"), "w") as f:
+        json.dump(species, f, indent=2)
+
+
+def synthetic_cells(species, ncells, density_range=(1e-25, 1e-10),
+                    temperature_range=(1e1, 1e4), gamma=5.0/3.0, fractions=None):
+    """initial values for `ncells` cells on a log density x temperature grid
+
+    species mass densities follow the enzo primordial initial fractions
+    (or `fractions`); species without a fraction get a floor value.
+    """
+    if fractions is None:
+        fractions = EnzoChemistryInitialCondition().calculate_fraction()
+    side = max(1, int(np.ceil(np.sqrt(ncells))))
+    d, T = np.meshgrid(np.logspace(*np.log10(density_range), side),
+                       np.logspace(*np.log10(temperature_range), side))
+    density     = d.ravel()[:ncells].copy()
+    temperature = T.ravel()[:ncells].copy()
+
+    init_values = {"density": density}
+    ndens = np.zeros(ncells)
+    for name, weight in species.items():
+        if name == "ge":
+            continue
+        init_values[name] = density * fractions.get(name, 1.0e-20)
+        ndens += init_values[name] / weight
+    mu = density / ndens
+    init_values["T"]  = temperature
+    init_values["ge"] = kboltz * temperature / ((gamma - 1.0) * mu * mh)
+    return init_values
+
+
+def load_solver(build_dir, solver_name, threads):
+    """compile (or reuse) the python extension of a generated solver
+
+    The extension is built into `_pyxbuild_<threads>`, never next to the
+    .pyx: a shared build would look up to date to distutils and keep the
+    first thread count's -DNTHREADS.
+    """
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    os.environ["CFLAGS"] = os.environ.get("CFLAGS", "") + f" -fopenmp -DNTHREADS={threads}"
+    pyxbuild_dir = os.path.join(build_dir, f"_pyxbuild_{threads}")
+    import pyximport
+    pyximport.install(setup_args={"include_dirs": np.get_include()}, build_dir=pyxbuild_dir)
+    module = pyximport.load_module(f"{solver_name}_solver_run",
+                                   os.path.join(build_dir, f"{solver_name}_solver_run.pyx"),
+                                   pyxbuild_dir=pyxbuild_dir)
+    return getattr(module, f"run_{solver_name}")
+
+
+def takes_reltol(build_dir, solver_name):
+    """True if the generated run_<solver_name> has a reltol argument"""
+    with open(os.path.join(build_dir, f"{solver_name}_solver_run.pyx")) as f:
+        m = re.search(rf"def run_{re.escape(solver_name)}\s*\(([^)]*)\)", f.read())
+    return m is not None and re.search(r"\breltol\b", m.group(1)) is not None
+
+
+def integrate(run, init_values, tf, niter=10000, reltol=None):
+    """call a dengo run_<solver> function, with `reltol` if given; check
+    `takes_reltol` first, a solver without it must not be timed"""
+    if reltol is not None:
+        return run(init_values, tf, niter=niter, reltol=reltol)
+    return run(init_values, tf, niter=niter)
+
+
+def require_reltol(build_dir, solver_name, reltol):
+    if reltol is not None and not takes_reltol(build_dir, solver_name):
+        raise Exception(f"run_{solver_name} in {build_dir} has no reltol argument, "
+                        f"it would integrate at its default tolerance instead of {reltol:g}")
+
+
+def step_stats(rv_int):
+    """(ODE steps, failed steps) from the integration info dengo returns"""
+    successful = np.asarray(rv_int.get("successful", []), dtype=bool)
+    return int(successful.size), int((~successful).sum())
+
+
+def run_batch(build_dir, solver_name, ncells, threads, tf, reltol=None,
+              density_range=(1e-25, 1e-10), temperature_range=(1e1, 1e4), niter=10000):
+    """time one batch of cells in this process and return a result record"""
+    with open(os.path.join(build_dir, "species.json")) as f:
+        species = json.load(f)
+    require_reltol(build_dir, solver_name, reltol)
+    run = load_solver(build_dir, solver_name, threads)
+    init_values = synthetic_cells(species, ncells, density_range, temperature_range)
+
+    t0 = time.perf_counter()
+    rv, rv_int = integrate(run, init_values, tf, niter=niter, reltol=reltol)
+    wall = time.perf_counter() - t0
+    steps, failures = step_stats(rv_int)
+    return {"ncells": ncells, "threads": threads, "tf": tf, "reltol": reltol,
+            "wall": wall, "cells_per_second": ncells / wall,
+            "time_per_cell": wall / ncells, "ode_steps": steps, "failures": failures}
+
+
+def run_batch_subprocess(build_dir, solver_name, ncells, threads, tf, reltol=None, **kwargs):
+    """`run_batch` in a fresh python process, so every thread count gets its
+    own OpenMP runtime and extension build"""
+    args = {"build_dir": build_dir, "solver_name": solver_name, "ncells": ncells,
+            "threads": threads, "tf": tf, "reltol": reltol, **kwargs}
+    p = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", json.dumps(args)],
+                       stdout=subprocess.PIPE, universal_newlines=True,
+                       cwd=os.path.dirname(os.path.abspath(__file__)))
+    if p.returncode != 0:
+        return {"ncells": ncells, "threads": threads, "tf": tf, "reltol": reltol,
+                "error": f"worker exited with {p.returncode}"}
+    return json.loads(p.stdout.splitlines()[-1])
+
+
+def benchmark(network_spec, solver_options, cells, threads, tf, reltol=None,
+              build_root="solver_bench_build", out="solver_bench.json"):
+    """generate each solver once and time it over cells x threads"""
+    network = load_network(network_spec)
+    solver_name = network_spec.partition(":")[0] + "_bench"
+    results = []
+    for option in solver_options:
+        build_dir = os.path.abspath(os.path.join(build_root, option))
+        write_benchmark_solver(network, option, solver_name, build_dir)
+        for n in threads:
+            for ncells in cells:
+                r = run_batch_subprocess(build_dir, solver_name, ncells, n, tf, reltol)
+                r.update(network=network_spec, solver_option=option)
+                print(json.dumps(r))
+                results.append(r)
+                with open(out, "w") as f:
+                    json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--worker":
+        print(json.dumps(run_batch(**json.loads(sys.argv[2]))))
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="benchmark a generated dengo solver")
+    parser.add_argument("network", nargs="?", default="mynetwork:setup_network",
+                        help="<module>[:<function>] returning a ChemicalNetwork")
+    parser.add_argument("--solver-option", nargs="+", default=["be_chem", "cv_omp"],
+                        choices=sorted(SOLVER_OPTIONS))
+    parser.add_argument("--cells", nargs="+", type=float, default=[1e3, 1e5])
+    parser.add_argument("--threads", nargs="+", type=int, default=[1, os.cpu_count()])
+    parser.add_argument("--tf", type=float, default=1e13, help="integration time [s]")
+    parser.add_argument("--reltol", type=float, default=None)
+    parser.add_argument("--build-dir", default="solver_bench_build")
+    parser.add_argument("--out", default="solver_bench.json")
+    args = parser.parse_args()
+
+    benchmark(args.network, args.solver_option, [int(c) for c in args.cells],
+              args.threads, args.tf, args.reltol, args.build_dir, args.out)
@@ -0,0 +1,238 @@
+"""Run a grid of EnzoDengoWorkflow configurations on the local machine.
+
+    python sweep-workflow.py cvode.yaml sweep.yaml [-j WORKERS] [--mpi-ranks N]
+
+The grid file names a sweep directory and a list of values for any
+`section.key` of the base config. Every grid point gets its own config
+and run directory under the sweep directory. MUSIC runs once per distinct
+`music_configs`, the dengo solver + enzo build once per distinct
+`dengo_configs`/`paths`, and each point only runs its own enzo job. The
+progress is kept in `<sweep_directory>/sweep_state.json` so a killed sweep
+picks up where it stopped.
+"""
+import os
+import sys
+import json
+import yaml
+import shutil
+import logging
+import argparse
+import importlib
+import itertools
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import workflow_cache
+import workflow_profile
+import workflow_config
+import run_registry
+from workflow_profile import TRACER
+
+workflow = importlib.import_module("dengo-workflow")
+
+STATE_FILE = "sweep_state.json"
+
+
+def expand_grid(base_config, grid):
+    """yield (overrides, config) for every point of the cartesian grid of
+    the validated `base_config`, each point's overrides validated"""
+    keys = sorted(grid)
+    for values in itertools.product(*(grid[k] for k in keys)):
+        overrides = dict(zip(keys, values))
+        yield overrides, workflow_config.with_overrides(base_config, overrides,
+                                                        source=f"sweep point {overrides}")
+
+
+def music_key(config):
+    return workflow_cache.hash_config({"music_configs": config["music_configs"],
+                                       "music": config["executables"]["music"]})
+
+
+def build_key(config):
+    return workflow_cache.hash_config({"dengo_configs": config["dengo_configs"],
+                                       "paths": config["paths"]})
+
+
+class Task:
+    def __init__(self, name, func, args, deps=(), exclusive=False):
+        self.name      = name
+        self.func      = func
+        self.args      = args
+        self.deps      = set(deps)
+        # exclusive tasks share the enzo tree / dengo install, run one at a time
+        self.exclusive = exclusive
+
+
+def music_task(config_file, ic_dir):
+    """generate the ICs for one distinct music_configs into `ic_dir`"""
+    music = workflow.MUSICGenerator(config_file)
+    music.test_dir = ic_dir
+    music.work_dir = ic_dir + ".work"
+    os.makedirs(music.work_dir, exist_ok=True)
+    if os.path.exists(ic_dir):
+        shutil.rmtree(ic_dir)
+    with workflow_profile.trace_to(ic_dir, "music_trace.json"):
+        with TRACER.stage("music"):
+            music.run_music()
+    shutil.rmtree(music.work_dir)
+
+
+def build_task(config_file, build_dir):
+    """build the dengo solver and the matching enzo binary into `build_dir`"""
+    wf = workflow.EnzoDengoWorkflow(config_file)
+    os.makedirs(build_dir, exist_ok=True)
+    with workflow_profile.trace_to(build_dir):
+        with TRACER.stage("dengo_solver"):
+            wf.build_dengo_solver()
+        with TRACER.stage("enzo_templates"):
+            wf.write_simulation_templates(simulation='enzo')
+        wf.config["executables"]["enzo"] = os.path.join(build_dir, "enzo")
+        with TRACER.stage("enzo_build"):
+            wf.build_enzo()
+    solver_name = wf.dengo_configs['solver_name']
+    shutil.copy(f"{wf.paths['DENGO_INSTALL_PATH']}/{solver_name}_tables.h5", build_dir)
+
+
+def run_task(config_file, ic_dir, build_dir, mpi_ranks):
+    """set up a point's run directory from the shared ICs and build, run enzo"""
+    import enzo_monitor
+    wf = workflow.EnzoDengoWorkflow(config_file)
+    wf.MPI_CORE = mpi_ranks
+    with run_registry.recording(wf), workflow_profile.trace_to(wf.test_dir):
+        with TRACER.stage("ics"):
+            for f in os.listdir(ic_dir):
+                workflow_cache.share_file(os.path.join(ic_dir, f), os.path.join(wf.test_dir, f))
+        wf.config["executables"]["enzo"] = os.path.join(build_dir, "enzo")
+        with TRACER.stage("enzo_config"):
+            wf.write_enzo_config(wf.primordial_fraction_parameters())
+        with TRACER.stage("rate_tables"):
+            tables = f"{wf.dengo_configs['solver_name']}_tables.h5"
+            workflow_cache.share_file(os.path.join(build_dir, tables),
+                                      os.path.join(wf.test_dir, tables))
+        # the pool runs this in a worker process' main thread
+        with TRACER.stage("enzo"), enzo_monitor.checkpoint_on_signals():
+            wf.run_enzo()
+
+
+def plan_sweep(base_config, sweep, mpi_ranks):
+    """write one config per grid point and return the deduplicated task graph"""
+    sweep_dir = sweep["sweep_directory"]
+    # every point is checked before anything is written or built
+    points = list(expand_grid(base_config, sweep["grid"]))
+    os.makedirs(sweep_dir, exist_ok=True)
+    tasks = {}
+    for overrides, config in points:
+        point = "p" + workflow_cache.hash_config(overrides)[:10]
+        config["run_directory"] = os.path.join(sweep_dir, point)
+        config_file = os.path.join(sweep_dir, f"{point}.yaml")
+        with open(config_file, "w") as f:
+            yaml.dump(config, f, default_flow_style=False)
+        logging.info(f"Sweep point {point} = {overrides}")
+
+        mkey, bkey = music_key(config), build_key(config)
+        ic_dir    = os.path.join(sweep_dir, "_ics", mkey[:16])
+        build_dir = os.path.join(sweep_dir, "_builds", bkey[:16])
+        if f"music:{mkey}" not in tasks:
+            tasks[f"music:{mkey}"] = Task(f"music:{mkey}", music_task,
+                                          (config_file, ic_dir))
+        if f"build:{bkey}" not in tasks:
+            tasks[f"build:{bkey}"] = Task(f"build:{bkey}", build_task,
+                                          (config_file, build_dir), exclusive=True)
+        tasks[f"run:{point}"] = Task(f"run:{point}", run_task,
+                                     (config_file, ic_dir, build_dir, mpi_ranks),
+                                     deps=[f"music:{mkey}", f"build:{bkey}"])
+    return tasks
+
+
+class SweepScheduler:
+    """run a task graph on a process pool, recording progress in a state file"""
+    def __init__(self, tasks, state_file, workers):
+        self.tasks      = tasks
+        self.state_file = state_file
+        self.workers    = workers
+        self.done       = set()
+        self.failed     = {}
+        if os.path.exists(state_file):
+            with open(state_file) as f:
+                state = json.load(f)
+            self.done = set(state["done"]) & set(tasks)
+            logging.info(f"Resuming sweep, {len(self.done)} tasks already done")
+
+    def save_state(self):
+        tmp = self.state_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"done": sorted(self.done), "failed": self.failed}, f, indent=2)
+        os.replace(tmp, self.state_file)
+
+    def ready(self, name, running):
+        task = self.tasks[name]
+        if not task.deps <= self.done:
+            return False
+        if task.exclusive and any(self.tasks[r].exclusive for r in running.values()):
+            return False
+        return True
+
+    def run(self):
+        pending = set(self.tasks) - self.done
+        running = {}
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            while pending or running:
+                # anything downstream of a failure can never run
+                blocked = {n for n in pending if self.tasks[n].deps & set(self.failed)}
+                for n in blocked:
+                    self.failed[n] = "dependency failed"
+                pending -= blocked
+
+                for name in sorted(pending):
+                    if len(running) >= self.workers:
+                        break
+                    if self.ready(name, running):
+                        task = self.tasks[name]
+                        logging.info(f"Starting {name}")
+                        running[pool.submit(task.func, *task.args)] = name
+                        pending.discard(name)
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logging.error(f"{name} failed: {e!r}")
+                        self.failed[name] = repr(e)
+                    else:
+                        logging.info(f"Finished {name}")
+                        self.done.add(name)
+                        self.failed.pop(name, None)
+                    self.save_state()
+        self.save_state()
+        return not self.failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="parameter sweep over a workflow config")
+    parser.add_argument("config_file", help="base workflow config")
+    parser.add_argument("sweep_file", help="sweep directory and parameter grid")
+    parser.add_argument("--mpi-ranks", type=int,
+                        default=min(workflow.MPI_CORE, os.cpu_count()))
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="concurrent stages, defaults to cores / mpi ranks")
+    args = parser.parse_args()
+
+    with open(args.sweep_file) as f:
+        sweep = yaml.load(f, Loader=workflow_config.UniqueKeyLoader)
+    os.makedirs(sweep["sweep_directory"], exist_ok=True)
+    logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p',
+                        filename=os.path.join(sweep["sweep_directory"], "sweep.log"),
+                        level=logging.INFO)
+
+    base_config = workflow_config.load_config(
+        args.config_file, require=workflow.EnzoDengoWorkflow.REQUIRED_SECTIONS)
+    workers = args.workers or max(1, os.cpu_count() // args.mpi_ranks)
+    tasks = plan_sweep(base_config, sweep, args.mpi_ranks)
+    scheduler = SweepScheduler(tasks, os.path.join(sweep["sweep_directory"], STATE_FILE),
+                               workers)
+    if not scheduler.run():
+        print("failed stages: {}".format(scheduler.failed))
+        sys.exit(1)
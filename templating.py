@@ -0,0 +1,89 @@
+"""shared jinja2 environments and incremental template rendering
+
+Every search path gets one precompiled `Environment` per process, backed
+by an on-disk bytecode cache, so repeated renders (and later processes)
+skip template compilation. Rendered files are only written when their
+contents change; untouched outputs keep their mtimes and enzo's make
+stays incremental.
+"""
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import workflow_cache
+from workflow_profile import TRACER
+
+TEMPLATE_CACHE = os.path.join(workflow_cache.BUILD_CACHE, "jinja2")
+
+_environments = {}
+_lock = threading.Lock()
+
+
+def get_environment(searchpath):
+    """the shared Environment for templates under `searchpath`"""
+    key = os.path.abspath(searchpath)
+    with _lock:
+        if key not in _environments:
+            from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+            os.makedirs(TEMPLATE_CACHE, exist_ok=True)
+            _environments[key] = Environment(
+                extensions=['jinja2.ext.loopcontrols'],
+                loader=FileSystemLoader(searchpath=searchpath),
+                bytecode_cache=FileSystemBytecodeCache(TEMPLATE_CACHE))
+        return _environments[key]
+
+
+def write_if_changed(filename, content):
+    """write `content` unless `filename` already holds exactly that,
+    return True if the file was written"""
+    if os.path.exists(filename):
+        with open(filename) as f:
+            if f.read() == content:
+                return False
+    with open(filename, 'w') as f:
+        f.write(content)
+    return True
+
+
+def render_templates(searchpath, templates, outdir, template_vars, max_workers=None):
+    """render `templates` (relative to `searchpath`) into `outdir` concurrently
+
+    Parameters
+    ----------
+    searchpath    : str, where the jinja2 templates are located
+    templates     : list of str, template paths relative to `searchpath`
+    outdir        : str, output directory, ".template" is dropped from the names
+    template_vars : dict, variables passed to every template
+    max_workers   : int, optional, size of the rendering thread pool
+
+    Returns
+    -------
+    report : list of (template, render seconds, written) sorted slowest first
+    """
+    env = get_environment(searchpath)
+
+    def render(infile):
+        start = time.time()
+        t0 = time.perf_counter()
+        out = env.get_template(infile).render(**template_vars)
+        elapsed = time.perf_counter() - t0
+        outfile = os.path.join(outdir, infile.replace(".template", ""))
+        written = write_if_changed(outfile, out)
+        TRACER.add(infile, "template", start, time.time() - start,
+                   {"render": elapsed, "written": written,
+                    "bytes_written": len(out) if written else 0})
+        return infile, elapsed, written
+
+    with TRACER.stage(f"render {os.path.basename(os.path.normpath(outdir))}", cat="template"), \
+         ThreadPoolExecutor(max_workers=max_workers) as pool:
+        report = list(pool.map(render, templates))
+    report.sort(key=lambda r: -r[1])
+
+    logging.info(f"Rendered {len(report)} templates from {searchpath} into {outdir}, "
+                 f"{sum(r[2] for r in report)} changed")
+    for infile, elapsed, written in report:
+        logging.info("  {:8.3f} s  {:9s} {}".format(elapsed, "written" if written else "unchanged",
+                                                   infile))
+    return report
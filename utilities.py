@@ -1,22 +1,4 @@
 import os
-import numpy as np
-from dengo.chemical_network import \
-    ChemicalNetwork, \
-    reaction_registry, \
-    cooling_registry, species_registry
-import dengo.primordial_rates
-import dengo.primordial_cooling
-from dengo.chemistry_constants import tiny, kboltz, mh, G
-import yt
-import yt.units as u
-import numpy
-import pickle
-import time
-import pyximport
-import sys
-import matplotlib.pyplot as plt
-import pytest
-import h5py
 
 
 def setup_primordial_network(enforce_conservation= True, equilibrium_species= ["H2_2"]):
@@ -25,6 +7,11 @@ def setup_primordial_network(enforce_conservation= True, equilibrium_species= ["
     Return:
         primordial: ChemicalNetwork with primordial reactions and cooling
     """
+    # dengo is only imported once a network is actually built
+    from dengo.chemical_network import ChemicalNetwork
+    import dengo.primordial_rates
+    import dengo.primordial_cooling
+
     # this register all the rates specified in `primordial_rates.py`
     dengo.primordial_rates.setup_primordial()
 
@@ -86,6 +73,15 @@ def setup_primordial_network(enforce_conservation= True, equilibrium_species= ["
 
 
 
+def load_primordial_network(enforce_conservation=True, equilibrium_species=["H2_2"]):
+    """`setup_primordial_network` from its on-disk snapshot when there is one
+    (see workflow_cache.NetworkCache)"""
+    import workflow_cache
+    return workflow_cache.cached_network("utilities", "setup_primordial_network",
+                                         enforce_conservation=enforce_conservation,
+                                         equilibrium_species=list(equilibrium_species))
+
+
 def write_network(network, solver_options={"output_dir": "test_dir",
                                            "solver_name": "primordial",
                                            "use_omp": False,
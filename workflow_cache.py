@@ -0,0 +1,571 @@
+import os
+import sys
+import json
+import glob
+import pickle
+import shutil
+import hashlib
+import logging
+import tempfile
+import importlib
+import importlib.util
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+BUILD_CACHE = os.environ.get("WORKFLOW_BUILD_CACHE",
+                             os.path.expanduser("~/.cache/enzo-dengo-workflow"))
+# upper bound on the size of the MUSIC initial condition store
+IC_CACHE_BYTES = int(float(os.environ.get("WORKFLOW_IC_CACHE_GB", 100)) * 1024**3)
+# WORKFLOW_NETWORK_CACHE=0 always rebuilds ChemicalNetworks from their module
+NETWORK_CACHE = os.environ.get("WORKFLOW_NETWORK_CACHE", "1") != "0"
+# how run directories get artifacts: "link" (hardlink, reflink or copy) or "symlink"
+ARTIFACT_LINK_MODE = os.environ.get("WORKFLOW_ARTIFACT_LINK", "link")
+# what the dengo solver templates install for a solver, by name
+SOLVER_INSTALL_FILES = ["lib{}.*", "{}_tables.h5", "{}_solver.h"]
+# linux ioctl to share the extents of one file with another (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def hash_config(obj):
+    """sha256 of a canonical JSON dump of a (nested) config object"""
+    blob = json.dumps(obj, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+def hash_file(path, h=None):
+    """feed the contents of `path` into the hash `h` (or a new sha256)"""
+    if h is None:
+        h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h
+
+
+def hash_tree(path, suffixes=None, exclude=()):
+    """sha256 over relative file names and contents below `path`
+
+    Parameters
+    ----------
+    path     : str
+        file or directory to hash
+    suffixes : tuple of str, optional
+        only hash files ending with one of these suffixes
+    exclude  : iterable of str, optional
+        file names to leave out of the hash
+    """
+    h = hashlib.sha256()
+    if os.path.isfile(path):
+        return hash_file(path, h).hexdigest()
+    exclude = set(exclude)
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for f in sorted(filenames):
+            if f in exclude:
+                continue
+            if suffixes and not f.endswith(tuple(suffixes)):
+                continue
+            filepath = os.path.join(dirpath, f)
+            h.update(os.path.relpath(filepath, path).encode())
+            hash_file(filepath, h)
+    return h.hexdigest()
+
+
+def describe_network(network):
+    """canonical, hashable description of a dengo ChemicalNetwork"""
+    def stoich(side):
+        return sorted(f"{n}*{s.name}" for n, s in side)
+
+    reactions = {}
+    for name, rxn in network.reactions.items():
+        reactions[name] = [stoich(rxn.left_side), stoich(rxn.right_side)]
+    cooling = {name: str(getattr(c, "equation", ""))
+               for name, c in network.cooling_actions.items()}
+    return {"reactions": reactions,
+            "cooling": cooling,
+            "species": sorted(s.name for s in network.required_species),
+            "equilibrium_species": sorted(str(s) for s in
+                                          getattr(network, "equilibrium_species", [])),
+            "enforce_conservation": getattr(network, "enforce_conservation", None),
+            "T_bounds": list(getattr(network, "T_bounds", []))}
+
+
+class BuildCache:
+    """directory based cache of build products keyed by a content hash
+
+    Each entry lives in `<root>/<namespace>/<key>/` and is only ever
+    published through an atomic rename, so a half-written entry from a
+    killed build is never picked up.
+    """
+    def __init__(self, namespace, root=BUILD_CACHE):
+        self.root = os.path.join(root, namespace)
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def lookup(self, key):
+        """return the entry directory for `key`, or None on a miss"""
+        entry = self.path(key)
+        if os.path.exists(os.path.join(entry, "manifest.json")):
+            logging.info("Build cache hit {}".format(entry))
+            return entry
+        logging.info("Build cache miss {}".format(entry))
+        return None
+
+    def manifest(self, key):
+        with open(os.path.join(self.path(key), "manifest.json")) as f:
+            return json.load(f)
+
+    def store(self, key, files, meta=None, link=False, reflink=False):
+        """copy `files` ({name: source path}) into a new entry for `key`
+
+        sources can be files or directories; with `link` the entry shares
+        the sources' data through `link_file` instead of copying it, with
+        `reflink` files are reflinked where possible and copied otherwise.
+        Returns the entry directory.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        tmpdir = tempfile.mkdtemp(prefix=f".{key}.", dir=self.root)
+        for name, src in files.items():
+            dst = os.path.join(tmpdir, name)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if os.path.isdir(src):
+                shutil.copytree(src, dst, symlinks=True,
+                                copy_function=link_file if link else shutil.copy2)
+            elif link:
+                link_file(src, dst)
+            elif reflink:
+                clone_or_copy(src, dst)
+            else:
+                shutil.copy2(src, dst)
+        with open(os.path.join(tmpdir, "manifest.json"), "w") as f:
+            json.dump({"key": key, "files": files, "meta": meta or {}},
+                      f, indent=2, sort_keys=True)
+        entry = self.path(key)
+        try:
+            os.rename(tmpdir, entry)
+        except OSError:
+            # another build published the same key first
+            shutil.rmtree(tmpdir)
+        logging.info("Build cache store {}".format(entry))
+        return entry
+
+    def restore(self, key, name, dst):
+        """copy the cached `name` of entry `key` to `dst`"""
+        src = os.path.join(self.path(key), name)
+        if os.path.isdir(src):
+            if os.path.exists(dst):
+                shutil.rmtree(dst)
+            shutil.copytree(src, dst, symlinks=True)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+            shutil.copy2(src, dst)
+        return dst
+
+
+def clone_or_copy(src, dst):
+    """reflink `src` to `dst` when the filesystem supports it, copy otherwise"""
+    if fcntl is not None:
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            shutil.copystat(src, dst)
+            return "reflink"
+        except OSError:
+            os.remove(dst)
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+def link_file(src, dst):
+    """make `dst` share the data of `src` without copying it
+
+    tries a hardlink, then a reflink, and only copies (with a warning)
+    when neither works, e.g. across filesystems without reflink support.
+    Returns the method that was used.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except OSError:
+        pass
+    method = clone_or_copy(src, dst)
+    if method == "copy":
+        logging.warning(f"Cannot hardlink or reflink {src}, copied it")
+    return method
+
+
+class ICStore(BuildCache):
+    """size bounded, least recently used store of MUSIC initial conditions
+
+    Entries hold the files MUSIC wrote into the run directory, reflinked
+    or copied so the run directory keeps files of its own. They are
+    shared with later run directories through hardlinks/reflinks and made
+    read only, so a run can never modify the cached copy. An entry's
+    manifest mtime is its last use.
+    """
+    def __init__(self, root=BUILD_CACHE, max_bytes=IC_CACHE_BYTES):
+        BuildCache.__init__(self, "music_ics", root)
+        self.max_bytes = max_bytes
+
+    def lookup(self, key):
+        entry = BuildCache.lookup(self, key)
+        if entry:
+            os.utime(os.path.join(entry, "manifest.json"))
+        return entry
+
+    def store_files(self, key, run_dir, names, meta=None):
+        """store the files `names` of `run_dir` as the entry `key`"""
+        files = {f: os.path.join(run_dir, f) for f in names}
+        entry = self.store(key, files, meta=meta, reflink=True)
+        for f in files:
+            os.chmod(os.path.join(entry, f), 0o444)
+        self.evict(keep=key)
+        return entry
+
+    def link_into(self, key, run_dir):
+        """populate `run_dir` with links to the cached initial conditions"""
+        os.makedirs(run_dir, exist_ok=True)
+        for name in self.manifest(key)["files"]:
+            link_file(os.path.join(self.path(key), name), os.path.join(run_dir, name))
+
+    def entries(self):
+        """(last use, size in bytes, key) of every entry, oldest first"""
+        if not os.path.isdir(self.root):
+            return []
+        out = []
+        for key in os.listdir(self.root):
+            manifest = os.path.join(self.root, key, "manifest.json")
+            if not os.path.exists(manifest):
+                continue
+            size = sum(os.path.getsize(f) for f in
+                       glob.glob(os.path.join(self.root, key, "*")))
+            out.append((os.path.getmtime(manifest), size, key))
+        return sorted(out)
+
+    def evict(self, keep=None):
+        """drop least recently used entries until the store fits `max_bytes`"""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            logging.info(f"Evicting cached initial conditions {key}")
+            shutil.rmtree(self.path(key))
+            total -= size
+
+
+def installed_solver_files(install_path, solver_name):
+    """files the solver template's `make install` put under the dengo install
+    path for `solver_name`; matched by exact name, so `primordial` does not
+    pick up `dengo_cvode_primordial`'s library and tables"""
+    files = set()
+    for name in SOLVER_INSTALL_FILES:
+        pattern = os.path.join(install_path, "**", name.format(glob.escape(solver_name)))
+        files.update(glob.glob(pattern, recursive=True))
+    return sorted(f for f in files if os.path.isfile(f))
+
+
+def network_source(module):
+    """hash of the source of the network module `module`"""
+    spec = importlib.util.find_spec(module)
+    if spec is None or not spec.origin:
+        raise Exception(f"cannot find network module {module}")
+    return hash_tree(spec.origin)
+
+
+def dengo_signature():
+    """dengo version and a hash of its python sources; a snapshot pickled
+    by another dengo may not unpickle into the same network"""
+    import dengo
+    return {"version": getattr(dengo, "__version__", None),
+            "source": hash_tree(os.path.dirname(dengo.__file__), suffixes=(".py",))}
+
+
+def dump_network(network):
+    """pickle a ChemicalNetwork, with dill for rate functions pickle cannot handle"""
+    try:
+        return pickle.dumps(network, protocol=pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, AttributeError, TypeError) as e:
+        try:
+            import dill
+        except ImportError:
+            raise e
+        return dill.dumps(network)
+
+
+def load_pickled_network(filename):
+    with open(filename, "rb") as f:
+        blob = f.read()
+    try:
+        return pickle.loads(blob)
+    except Exception:
+        import dill
+        return dill.loads(blob)
+
+
+class NetworkCache(BuildCache):
+    """pickled ChemicalNetwork snapshots
+
+    Keyed on the network module's source, the setup function and its
+    arguments, the dengo version/sources and the python version, so
+    editing any of them rebuilds the network. Networks are also memoized
+    per process; callers get the same instance back.
+    """
+    def __init__(self, root=BUILD_CACHE):
+        BuildCache.__init__(self, "networks", root)
+        self.memo = {}
+
+    def key(self, module, func, kwargs):
+        return hash_config({"module": module, "function": func, "kwargs": kwargs,
+                            "source": network_source(module),
+                            "dengo": dengo_signature(),
+                            "python": list(sys.version_info[:2])})
+
+    def load(self, module, func="setup_network", **kwargs):
+        """`module.func(**kwargs)` from the snapshot, building it on a miss"""
+        key = self.key(module, func, kwargs)
+        if key in self.memo:
+            return self.memo[key]
+        network = None
+        if self.lookup(key):
+            try:
+                network = load_pickled_network(os.path.join(self.path(key), "network.pkl"))
+            except Exception as e:
+                logging.warning(f"Dropping unreadable network snapshot {self.path(key)}: {e!r}")
+                shutil.rmtree(self.path(key), ignore_errors=True)
+        if network is None:
+            network = getattr(importlib.import_module(module), func)(**kwargs)
+            self.snapshot(key, network, {"module": module, "function": func, "kwargs": kwargs})
+        self.memo[key] = network
+        return network
+
+    def snapshot(self, key, network, meta):
+        try:
+            blob = dump_network(network)
+        except Exception as e:
+            logging.warning(f"Cannot snapshot network {meta}: {e!r}")
+            return None
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=".network.", dir=self.root)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(blob)
+            return self.store(key, {"network.pkl": tmp}, meta=meta)
+        finally:
+            os.remove(tmp)
+
+
+_network_cache = None
+
+
+def cached_network(module, func="setup_network", **kwargs):
+    """the ChemicalNetwork `module.func(**kwargs)` builds, from a snapshot if possible"""
+    global _network_cache
+    if not NETWORK_CACHE:
+        return getattr(importlib.import_module(module), func)(**kwargs)
+    if _network_cache is None:
+        _network_cache = NetworkCache()
+    return _network_cache.load(module, func, **kwargs)
+
+
+class ArtifactStore:
+    """content addressed store of read-only files shared by run directories
+
+    Objects live in `<root>/objects/<sha256[:2]>/<sha256>` and are never
+    modified once published. Run directories get hardlinks (or reflinks,
+    or copies across filesystems) of them, or read-only symlinks with
+    `mode="symlink"`; every file handed out is recorded under `refs/` so
+    `gc` can tell which objects are still in use. File digests are
+    remembered under `digests/` by (device, inode, size, mtime), so sharing
+    the same multi-GB IC into every sweep point hashes it once.
+    """
+    def __init__(self, root=os.path.join(BUILD_CACHE, "artifacts"), mode=ARTIFACT_LINK_MODE):
+        self.root     = root
+        self.objects  = os.path.join(root, "objects")
+        self.refs     = os.path.join(root, "refs")
+        self.digests  = os.path.join(root, "digests")
+        self.mode     = mode
+        self.verified = set()
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def digest(self, path, memo=True):
+        """sha256 of the file `path`, from the memo while the file is unchanged"""
+        st   = os.stat(path)
+        sig  = [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns]
+        path = os.path.abspath(path)
+        fname = os.path.join(self.digests, hashlib.sha256(path.encode()).hexdigest())
+        if memo:
+            try:
+                with open(fname) as f:
+                    record = json.load(f)
+                if record["stat"] == sig:
+                    return record["digest"]
+            except (OSError, ValueError, KeyError):
+                pass
+        digest = hash_file(path).hexdigest()
+        os.makedirs(self.digests, exist_ok=True)
+        tmp = f"{fname}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"path": path, "stat": sig, "digest": digest}, f)
+        os.replace(tmp, fname)
+        return digest
+
+    def put(self, src):
+        """add the file `src` to the store, return its sha256"""
+        digest = self.digest(src)
+        obj = self.object_path(digest)
+        if os.path.exists(obj):
+            return digest
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        # never hardlink the source in, the store has to own its inode
+        fd, tmp = tempfile.mkstemp(prefix=f".{digest}.", dir=os.path.dirname(obj))
+        os.close(fd)
+        clone_or_copy(src, tmp)
+        os.chmod(tmp, 0o555 if os.access(src, os.X_OK) else 0o444)
+        os.replace(tmp, obj)
+        logging.info(f"Artifact store added {src} as {digest}")
+        return digest
+
+    def verify(self, digest, memo=True):
+        """True if the object still hashes to its name; without `memo` it is
+        always rehashed"""
+        obj = self.object_path(digest)
+        return os.path.exists(obj) and self.digest(obj, memo) == digest
+
+    def link(self, digest, dst):
+        """materialize object `digest` at `dst` and record the reference"""
+        obj = self.object_path(digest)
+        if digest not in self.verified:
+            if not self.verify(digest):
+                raise Exception(f"artifact {digest} is missing or corrupt, "
+                                f"run `python workflow_cache.py verify`")
+            self.verified.add(digest)
+        if os.path.lexists(dst):
+            os.remove(dst)
+        os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+        if self.mode == "symlink":
+            os.symlink(obj, dst)
+            method = "symlink"
+        else:
+            method = link_file(obj, dst)
+        self.add_ref(digest, dst)
+        return method
+
+    def share(self, src, dst):
+        """`put(src)` and `link` it to `dst`, the zero-copy replacement of cp"""
+        return self.link(self.put(src), dst)
+
+    def add_ref(self, digest, dst):
+        dst = os.path.abspath(dst)
+        os.makedirs(self.refs, exist_ok=True)
+        ref = os.path.join(self.refs, hashlib.sha256(dst.encode()).hexdigest())
+        st  = os.lstat(dst)
+        tmp = f"{ref}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"path": dst, "digest": digest, "size": st.st_size,
+                       "mtime": st.st_mtime}, f)
+        os.replace(tmp, ref)
+
+    def ref_is_live(self, ref):
+        """the recorded file still exists and still is the object it was linked from"""
+        path, obj = ref["path"], self.object_path(ref["digest"])
+        if not os.path.lexists(path):
+            return False
+        if os.path.islink(path):
+            return os.path.realpath(path) == os.path.realpath(obj)
+        st = os.stat(path)
+        if os.path.exists(obj) and os.path.samefile(path, obj):
+            return True
+        # reflinks and copies: unchanged since they were handed out
+        return st.st_size == ref["size"] and st.st_mtime == ref["mtime"]
+
+    def gc(self, dry_run=False):
+        """drop dead references and objects nothing refers to, return the freed bytes"""
+        live = set()
+        if os.path.isdir(self.refs):
+            for name in os.listdir(self.refs):
+                fname = os.path.join(self.refs, name)
+                try:
+                    with open(fname) as f:
+                        ref = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                if self.ref_is_live(ref):
+                    live.add(ref["digest"])
+                elif not dry_run:
+                    os.remove(fname)
+        if os.path.isdir(self.digests) and not dry_run:
+            for name in os.listdir(self.digests):
+                fname = os.path.join(self.digests, name)
+                try:
+                    with open(fname) as f:
+                        gone = not os.path.exists(json.load(f)["path"])
+                except (OSError, ValueError, KeyError):
+                    gone = True
+                if gone:
+                    os.remove(fname)
+        freed = 0
+        for obj in glob.glob(os.path.join(self.objects, "*", "*")):
+            digest = os.path.basename(obj)
+            # an extra hardlink count is a reference too, e.g. from a copied run directory
+            if digest in live or os.stat(obj).st_nlink > 1:
+                continue
+            freed += os.path.getsize(obj)
+            logging.info(f"Artifact store removing unreferenced {digest}")
+            if not dry_run:
+                os.remove(obj)
+        return freed
+
+    def fsck(self, remove=False):
+        """digests of objects whose contents no longer match their name"""
+        corrupt = []
+        for obj in glob.glob(os.path.join(self.objects, "*", "*")):
+            digest = os.path.basename(obj)
+            if digest.startswith("."):
+                continue
+            if not self.verify(digest, memo=False):
+                corrupt.append(digest)
+                if remove:
+                    os.remove(obj)
+        return corrupt
+
+
+_artifact_store = None
+
+
+def share_file(src, dst):
+    """put `src` into the shared ArtifactStore and link it to `dst`"""
+    global _artifact_store
+    if _artifact_store is None:
+        _artifact_store = ArtifactStore()
+    return _artifact_store.share(src, dst)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="maintain the shared artifact store")
+    parser.add_argument("command", choices=["gc", "verify"])
+    parser.add_argument("--dry-run", action="store_true", help="gc: only report")
+    parser.add_argument("--remove", action="store_true", help="verify: delete corrupt objects")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    store = ArtifactStore()
+    if args.command == "gc":
+        freed = store.gc(dry_run=args.dry_run)
+        print("{} {:.1f} MB".format("would free" if args.dry_run else "freed", freed / 1024**2))
+    else:
+        corrupt = store.fsck(remove=args.remove)
+        for digest in corrupt:
+            print(f"corrupt: {digest}")
+        sys.exit(1 if corrupt else 0)
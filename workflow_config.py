@@ -0,0 +1,424 @@
+"""Workflow configs: parsed once, validated before any stage runs.
+
+    python workflow_config.py cvode.yaml [override.yaml ...] [--set enzo_configs.dengo_reltol=1e-6]
+
+`load_config` reads YAML with duplicate keys rejected (a second
+`StopFirstTimeAtDensity` used to silently win), layers the files
+(later files and `--set` overrides win, a file may name its base with
+`extends: base.yaml`), fills in defaults and checks every section against
+`SCHEMA`: required keys, types, choices, unknown keys (with a suggestion
+for typos) and a few cross checks, e.g. levelmin <= levelmax. All problems
+are reported at once, as a `ConfigError`, before anything is built.
+
+Parsed files are kept per process keyed on path and mtime, so the
+workflow classes sharing one config, or a sweep validating every grid
+point, never re-read the YAML.
+"""
+import os
+import re
+import sys
+import copy
+import difflib
+import argparse
+import functools
+
+import yaml
+
+# solver_option -> (dengo solver template, ODE solver source)
+SOLVER_OPTIONS = {"be_chem": ("be_chem_solve/rates_and_rate_tables", "BE_chem_solve.C"),
+                  "cv_omp": ("cv_omp/sundials_CVDls", "initialize_cvode_solver.C")}
+
+NUMBER = (int, float)
+# dengo_configs keys passed on to the network module's setup function
+NETWORK_ARGUMENTS = ("enforce_conservation", "equilibrium_species")
+
+
+class ConfigError(Exception):
+    pass
+
+
+class UniqueKeyLoader(getattr(yaml, "CFullLoader", yaml.FullLoader)):
+    """yaml.FullLoader that refuses a key given twice in one mapping"""
+    def construct_mapping(self, node, deep=False):
+        seen = {}
+        for key_node, _ in node.value:
+            key = self.construct_object(key_node, deep=deep)
+            if key in seen:
+                raise ConfigError(f"{key_node.start_mark.name}: {key!r} is given twice, on lines "
+                                  f"{seen[key] + 1} and {key_node.start_mark.line + 1}")
+            seen[key] = key_node.start_mark.line
+        return super().construct_mapping(node, deep=deep)
+
+
+class Key:
+    """one config value: its type(s), whether it has to be given, its
+    default and an optional check(value) returning a complaint or None"""
+    def __init__(self, types, required=False, default=None, choices=None, check=None):
+        self.types    = types if isinstance(types, tuple) else (types,)
+        self.required = required
+        self.default  = default
+        self.choices  = choices
+        self.check    = check
+
+    def problem(self, value):
+        if isinstance(value, bool) and bool not in self.types or \
+           not isinstance(value, self.types):
+            names = " or ".join(t.__name__ for t in self.types)
+            return f"expected {names}, got {value!r}"
+        if self.choices is not None and value not in self.choices:
+            return f"{value!r} is not one of {', '.join(map(str, self.choices))}"
+        if self.check is not None:
+            return self.check(value)
+        return None
+
+
+class Section:
+    """a mapping of Keys / Sections; `other` types the keys of an open
+    section that are not listed (paths, MUSIC seeds, ...)"""
+    def __init__(self, keys, required=False, other=None, key_pattern=None):
+        self.keys        = keys
+        self.required    = required
+        self.other       = other
+        self.key_pattern = key_pattern
+        self.default     = None
+
+
+def positive(value):
+    return None if value > 0 else f"must be positive, got {value}"
+
+
+def threads(value):
+    if value == "auto" or isinstance(value, int) and not isinstance(value, bool) and value >= 1:
+        return None
+    return f"expected a thread count or auto, got {value!r}"
+
+
+def species_names(value):
+    if all(isinstance(s, str) for s in value):
+        return None
+    return f"expected a list of species names, got {value!r}"
+
+
+def yes_no(value):
+    if isinstance(value, bool) or str(value).lower() in ("yes", "no"):
+        return None
+    return f"expected yes or no, got {value!r}"
+
+
+def box_coordinates(value):
+    try:
+        coords = [float(c) for c in str(value).replace(",", " ").split()]
+    except ValueError:
+        return f"expected three numbers, got {value!r}"
+    if len(coords) != 3 or not all(0.0 <= c <= 1.0 for c in coords):
+        return f"expected three numbers in [0, 1], got {value!r}"
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def importable(module):
+    import importlib.util
+    try:
+        found = importlib.util.find_spec(module) is not None
+    except (ImportError, ValueError):
+        found = False
+    return None if found else f"{module!r} is not an importable module"
+
+
+SCHEMA = Section({
+    "run_directory": Key(str, required=True),
+    "executables": Section({
+        "enzo":  Key(str, required=True),
+        "music": Key(str, required=True),
+    }),
+    "paths": Section({}, other=Key(str)),
+    "dengo_configs": Section({
+        "output_dir":      Key(str, required=True),
+        "network_file":    Key(str, required=True, check=importable),
+        "solver_name":     Key(str, required=True),
+        "solver_option":   Key(str, required=True, choices=sorted(SOLVER_OPTIONS)),
+        "omp_num_threads": Key((int, str), default=1, check=threads),
+        # passed to the network module's setup function (NETWORK_ARGUMENTS)
+        "enforce_conservation": Key(bool),
+        "equilibrium_species":  Key(list, check=species_names),
+        # older configs carry these, the solver is chosen by solver_option
+        "use_omp":         Key(bool),
+        "use_cvode":       Key(bool),
+        "use_suitesparse": Key(bool),
+    }),
+    # the keys templates/enzo_baryons.template fills in, plus FinalRedshift
+    "enzo_configs": Section({
+        "FinalRedshift":                   Key(NUMBER, default=18),
+        "dengo_reltol":                    Key(NUMBER, check=positive),
+        "MaximumRefinementLevel":          Key(int),
+        "MaximumGravityRefinementLevel":   Key(int),
+        "MaximumParticleRefinementLevel":  Key(int),
+        "RefineBy":                        Key(int, default=2),
+        "CellFlaggingMethod":              Key((int, str)),
+        "MinimumOverDensityForRefinement": Key((int, float, str)),
+        "MinimumMassForRefinementLevelExponent": Key((int, float, str)),
+        "RefineByJeansLengthSafetyFactor": Key(NUMBER, check=positive),
+        "JeansRefinementColdTemperature":  Key(NUMBER),
+        "OutputFirstTimeAtLevel":          Key(int),
+        "StopFirstTimeAtLevel":            Key(int),
+        "StopFirstTimeAtDensity":          Key(NUMBER),
+        "OutputOnDensity":                 Key(int),
+        "StartDensityOutputs":             Key(NUMBER),
+        "IncrementDensityOutput":          Key(NUMBER),
+    }),
+    # MUSIC has more options than the workflow uses, unlisted ones are passed on
+    "music_configs": Section({
+        "setup": Section({
+            "boxlength":   Key(NUMBER, required=True, check=positive),
+            "zstart":      Key(NUMBER, required=True),
+            "levelmin":    Key(int, required=True),
+            "levelmin_TF": Key(int, required=True),
+            "levelmax":    Key(int, required=True),
+            "ref_center":  Key(str, required=True, check=box_coordinates),
+            "ref_extent":  Key(str, check=box_coordinates),
+            "padding":     Key(int),
+            "overlap":     Key(int),
+            "align_top":   Key((str, bool), check=yes_no),
+            "baryons":     Key((str, bool), required=True, check=yes_no),
+            "use_2LPT":    Key((str, bool), check=yes_no),
+            "use_LLA":     Key((str, bool), check=yes_no),
+            "periodic_TF": Key((str, bool), check=yes_no),
+        }, required=True, other=Key((int, float, str, bool))),
+        "random": Section({}, required=True, other=Key(int), key_pattern=r"seed\[\d+\]"),
+        "cosmology": Section({
+            "Omega_m": Key(NUMBER, required=True),
+            "Omega_L": Key(NUMBER, required=True),
+            "Omega_b": Key(NUMBER, required=True),
+            "H0":      Key(NUMBER, required=True, check=positive),
+            "sigma_8": Key(NUMBER, required=True, check=positive),
+            "nspec":   Key(NUMBER, required=True),
+        }, required=True, other=Key((int, float, str))),
+        "output": Section({"format": Key(str, required=True)}, other=Key(str)),
+    }, other=Section({}, other=Key((int, float, str, bool)))),
+    "analysis": Section({
+        "inflight":     Key(bool, default=False),
+        "workers":      Key(int, check=positive),
+        "stop_density": Key(NUMBER, check=positive),
+    }),
+    "resources": Section({
+        "music_threads":   Key(int, check=positive),
+        "music_memory_gb": Key(NUMBER, check=positive),
+        "enzo_memory_gb":  Key(NUMBER, check=positive),
+    }),
+})
+
+
+def schema_entry(section, name, where, errors):
+    """the Key or Section of `name` in `section`, None (and a complaint) if unknown"""
+    key = section.keys.get(name)
+    if key is not None:
+        return key
+    if section.other is None or \
+       section.key_pattern and not re.fullmatch(section.key_pattern, str(name)):
+        close = difflib.get_close_matches(str(name), section.keys, n=1)
+        hint  = f", did you mean {close[0]}?" if close else ""
+        errors.append(f"{where}: unknown key{hint}")
+        return None
+    return section.other
+
+
+def check_value(key, value, where, errors):
+    """check one value against its Key or Section, returns the value with defaults"""
+    if isinstance(key, Section):
+        if value is not None or key.required:
+            return check_section(key, value, where, errors)
+        return value
+    problem = key.problem(value)
+    if problem:
+        errors.append(f"{where}: {problem}")
+    return value
+
+
+def check_section(section, values, where, errors):
+    """type check `values` against `section` in place, filling in defaults"""
+    if values is None:
+        values = {}
+    if not isinstance(values, dict):
+        errors.append(f"{where}: expected a mapping, got {values!r}")
+        return values
+    prefix = f"{where}." if where else ""
+    for name, key in section.keys.items():
+        if name not in values:
+            if key.required:
+                errors.append(f"{prefix}{name}: missing")
+            elif key.default is not None:
+                values[name] = copy.deepcopy(key.default)
+    for name, value in values.items():
+        key = schema_entry(section, name, prefix + str(name), errors)
+        if key is not None:
+            values[name] = check_value(key, value, prefix + str(name), errors)
+    return values
+
+
+@functools.lru_cache(maxsize=None)
+def setup_parameters(module, func="setup_network"):
+    """argument names of `module.func` and whether it takes **kwargs, read
+    from the source so validation does not import dengo; None if unknown"""
+    import ast
+    import importlib.util
+    try:
+        spec = importlib.util.find_spec(module)
+    except (ImportError, ValueError):
+        return None
+    if spec is None or not spec.origin or not spec.origin.endswith(".py"):
+        return None
+    with open(spec.origin) as f:
+        tree = ast.parse(f.read(), spec.origin)
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name == func:
+            args = node.args
+            names = [a.arg for a in args.posonlyargs + args.args + args.kwonlyargs]
+            return names, args.kwarg is not None
+    return None
+
+
+def cross_checks(config, errors):
+    setup = (config.get("music_configs") or {}).get("setup") or {}
+    enzo  = config.get("enzo_configs") or {}
+    dengo = config.get("dengo_configs") or {}
+
+    def ordered(small, large, a, b):
+        if isinstance(a, NUMBER) and isinstance(b, NUMBER) and a > b:
+            errors.append(f"{small} = {a} is larger than {large} = {b}")
+    ordered("levelmin", "levelmin_TF", setup.get("levelmin"), setup.get("levelmin_TF"))
+    ordered("levelmin", "levelmax", setup.get("levelmin"), setup.get("levelmax"))
+    ordered("MaximumParticleRefinementLevel", "MaximumRefinementLevel",
+            enzo.get("MaximumParticleRefinementLevel"), enzo.get("MaximumRefinementLevel"))
+    ordered("FinalRedshift", "zstart", enzo.get("FinalRedshift"), setup.get("zstart"))
+
+    given = [k for k in NETWORK_ARGUMENTS if k in dengo]
+    params = setup_parameters(dengo["network_file"]) \
+        if given and isinstance(dengo.get("network_file"), str) else None
+    if params is not None and not params[1]:
+        for k in given:
+            if k not in params[0]:
+                errors.append(f"dengo_configs.{k}: {dengo['network_file']}.setup_network "
+                              f"does not take {k}")
+
+
+def validate(config, require=(), source="config"):
+    """check `config` in place against SCHEMA, `require` names top level
+    sections the calling workflow needs; returns the config with defaults"""
+    errors = []
+    for name in require:
+        if config.get(name) is None:
+            errors.append(f"{name}: missing")
+    check_section(SCHEMA, config, "", errors)
+    cross_checks(config, errors)
+    if errors:
+        raise ConfigError(f"{source}: {len(errors)} problem(s)\n    " + "\n    ".join(errors))
+    return config
+
+
+def with_overrides(config, overrides, source="config"):
+    """a validated `config` with the `{"section.key": value}` overrides
+
+    Only the overridden values and the cross checks are validated, and
+    only the mappings on the way to them are copied, the rest is shared
+    with `config`; cheap enough for every point of a large sweep.
+    """
+    out, errors = dict(config), []
+    for dotted, value in overrides.items():
+        keys = dotted.split(".")
+        d, section = out, SCHEMA
+        for i, k in enumerate(keys):
+            entry = schema_entry(section, k, ".".join(keys[:i + 1]), errors)
+            if entry is None:
+                break
+            if i == len(keys) - 1:
+                d[k] = check_value(entry, copy.deepcopy(value), dotted, errors)
+            elif not isinstance(entry, Section):
+                errors.append(f"{dotted}: {'.'.join(keys[:i + 1])} is not a section")
+                break
+            else:
+                d[k] = dict(d.get(k) or {})
+                d, section = d[k], entry
+    cross_checks(out, errors)
+    if errors:
+        raise ConfigError(f"{source}: {len(errors)} problem(s)\n    " + "\n    ".join(errors))
+    return out
+
+
+_parsed = {}
+
+
+def read_yaml(filename):
+    """the parsed file, read once per process unless it changed"""
+    st  = os.stat(filename)
+    key = (os.path.abspath(filename), st.st_mtime_ns, st.st_size)
+    if key not in _parsed:
+        with open(filename) as f:
+            _parsed[key] = yaml.load(f, Loader=UniqueKeyLoader) or {}
+    return copy.deepcopy(_parsed[key])
+
+
+def merge(base, override):
+    """`override` layered over `base`, mappings are merged key by key"""
+    out = dict(base)
+    for k, v in override.items():
+        if isinstance(v, dict) and isinstance(out.get(k), dict):
+            out[k] = merge(out[k], v)
+        else:
+            out[k] = v
+    return out
+
+
+def read_layers(filename, _seen=()):
+    """`filename` over the chain of files it `extends`"""
+    path = os.path.abspath(filename)
+    if path in _seen:
+        raise ConfigError(f"{filename}: extends itself through {' -> '.join(_seen)}")
+    config = read_yaml(filename)
+    base   = config.pop("extends", None)
+    if base is None:
+        return config
+    base = os.path.join(os.path.dirname(path), base)
+    return merge(read_layers(base, _seen + (path,)), config)
+
+
+def set_value(config, dotted_key, value):
+    """set `config[a][b][c] = value` for `dotted_key = "a.b.c"`"""
+    keys = dotted_key.split(".")
+    d = config
+    for k in keys[:-1]:
+        if d.get(k) is None:
+            d[k] = {}
+        d = d[k]
+    d[keys[-1]] = value
+
+
+def load_config(*filenames, overrides=None, require=()):
+    """the validated config of `filenames` layered in order, with the
+    `{"section.key": value}` overrides on top"""
+    config = {}
+    for f in filenames:
+        config = merge(config, read_layers(f))
+    for k, v in (overrides or {}).items():
+        set_value(config, k, v)
+    return validate(config, require, source=" + ".join(filenames))
+
+
+def parse_override(arg):
+    key, _, value = arg.partition("=")
+    if not value:
+        raise argparse.ArgumentTypeError(f"expected section.key=value, got {arg}")
+    return key, yaml.load(value, Loader=UniqueKeyLoader)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="validate and print a layered workflow config")
+    parser.add_argument("config_files", nargs="+")
+    parser.add_argument("--set", dest="overrides", action="append", type=parse_override,
+                        default=[], metavar="SECTION.KEY=VALUE")
+    args = parser.parse_args()
+    try:
+        config = load_config(*args.config_files, overrides=dict(args.overrides))
+    except ConfigError as e:
+        print(e)
+        sys.exit(1)
+    yaml.dump(config, sys.stdout, default_flow_style=False)
@@ -0,0 +1,156 @@
+import os
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import workflow_cache
+from workflow_profile import TRACER
+
+
+def walk_files(paths):
+    """files named by `paths`, descending into directories"""
+    for p in paths:
+        if os.path.isdir(p):
+            for dirpath, dirnames, filenames in os.walk(p):
+                for f in filenames:
+                    yield os.path.join(dirpath, f)
+        elif os.path.exists(p):
+            yield p
+
+
+class Stage:
+    """one step of a workflow with declared inputs, outputs and parameters
+
+    Parameters
+    ----------
+    name    : str
+    func    : callable, run without arguments
+    deps    : list of str, stages that have to finish first
+    inputs  : list of str, files or directories the stage reads
+    outputs : list of str, files or directories the stage writes;
+              a stage without outputs always runs
+    params  : dict, anything else that changes what the stage produces
+    """
+    def __init__(self, name, func, deps=(), inputs=(), outputs=(), params=None):
+        self.name    = name
+        self.func    = func
+        self.deps    = list(deps)
+        self.inputs  = list(inputs)
+        self.outputs = list(outputs)
+        self.params  = workflow_cache.hash_config(params or {})
+
+
+def output_signature(paths):
+    """(mtime, size) of every file under `paths`"""
+    return {f: [os.stat(f).st_mtime_ns, os.path.getsize(f)] for f in sorted(walk_files(paths))}
+
+
+class StageGraph:
+    """run stages in dependency order, independent branches concurrently
+
+    A stage is skipped when all its outputs exist, the oldest output is
+    newer than the newest input and its parameters match the ones
+    recorded in `state_file` the last time it ran. Outputs outside the
+    run directory (the enzo binary, generated templates) are shared with
+    other configs, so the stage also reruns when its outputs changed
+    since it recorded them. A stage always runs when one of its deps ran
+    in this invocation: cached files a dep links in keep their old mtimes.
+    """
+    def __init__(self, state_file):
+        self.stages     = {}
+        self.state_file = state_file
+        self.state      = {}
+        self.ran        = set()
+        if os.path.exists(state_file):
+            with open(state_file) as f:
+                self.state = json.load(f)
+
+    def add(self, name, func, **kwargs):
+        self.stages[name] = Stage(name, func, **kwargs)
+        return self.stages[name]
+
+    def save_state(self):
+        tmp = self.state_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.state_file)
+
+    def is_up_to_date(self, stage):
+        state = self.state.get(stage.name)
+        if self.ran & set(stage.deps):
+            return False
+        if not stage.outputs or not isinstance(state, dict) or state["params"] != stage.params:
+            return False
+        if not all(os.path.exists(o) for o in stage.outputs):
+            return False
+        outputs = [os.path.getmtime(f) for f in walk_files(stage.outputs)]
+        inputs  = [os.path.getmtime(f) for f in walk_files(stage.inputs)]
+        if not outputs or state["outputs"] != output_signature(stage.outputs):
+            return False
+        return not inputs or min(outputs) >= max(inputs)
+
+    def check(self):
+        for stage in self.stages.values():
+            for d in stage.deps:
+                if d not in self.stages:
+                    raise Exception(f"stage {stage.name} depends on unknown stage {d}")
+        # a topological walk catches cycles before anything is launched
+        seen, visiting = set(), set()
+        def visit(name):
+            if name in visiting:
+                raise Exception(f"dependency cycle through stage {name}")
+            if name not in seen:
+                visiting.add(name)
+                for d in self.stages[name].deps:
+                    visit(d)
+                visiting.discard(name)
+                seen.add(name)
+        for name in self.stages:
+            visit(name)
+
+    def run_stage(self, stage):
+        with TRACER.stage(stage.name, cat="stage"):
+            stage.func()
+
+    def run(self):
+        self.check()
+        done, pending, running = set(), set(self.stages), {}
+        error = None
+        with ThreadPoolExecutor(max_workers=len(self.stages) or 1) as pool:
+            while pending or running:
+                if error is None:
+                    for name in sorted(pending):
+                        stage = self.stages[name]
+                        if not set(stage.deps) <= done:
+                            continue
+                        pending.discard(name)
+                        if self.is_up_to_date(stage):
+                            logging.info(f"Stage {name} is up to date, skipping")
+                            done.add(name)
+                            continue
+                        logging.info(f"Stage {name} starting")
+                        running[pool.submit(self.run_stage, stage)] = name
+                if not running:
+                    if pending and error is None:
+                        # skipped stages may have unblocked more work
+                        continue
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logging.error(f"Stage {name} failed: {e!r}")
+                        self.state.pop(name, None)
+                        error = error or e
+                    else:
+                        logging.info(f"Stage {name} finished")
+                        done.add(name)
+                        self.ran.add(name)
+                        self.state[name] = {"params": self.stages[name].params,
+                                            "outputs": output_signature(self.stages[name].outputs)}
+                    self.save_state()
+        if error is not None:
+            raise error
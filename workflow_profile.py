@@ -0,0 +1,172 @@
+"""Per-stage timing instrumentation for the workflows.
+
+Workflow stages, subprocesses (make, MUSIC, mpirun, ...), shell commands
+and template renders are recorded by the process wide `TRACER` as
+complete ("X") events of the Chrome trace format: wall time, cpu time of
+the python process and its children, peak RSS of child processes and
+bytes written. `TRACER.write(path)` dumps them to a JSON file that loads
+in chrome://tracing or Perfetto; the workflows write one per run
+directory.
+
+    python workflow_profile.py summarize sweep/*/workflow_trace.json
+
+aggregates many traces into a per-stage table.
+"""
+import os
+import json
+import glob
+import time
+import logging
+import resource
+import argparse
+import threading
+import subprocess
+import contextlib
+
+TRACE_FILE = "workflow_trace.json"
+
+
+def setup_logging(filename="logWorkFlow.log"):
+    """configure the workflow log before anything is parsed or built"""
+    logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p',
+                        filename=filename, level=logging.INFO)
+
+
+def io_counters():
+    """(wchar, write_bytes) of this process, including reaped children"""
+    counters = {}
+    try:
+        with open("/proc/self/io") as f:
+            for l in f:
+                k, v = l.split(":")
+                counters[k] = int(v)
+    except OSError:
+        pass
+    return counters.get("wchar", 0), counters.get("write_bytes", 0)
+
+
+class Tracer:
+    """collects trace events from every thread of the process"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.events = []
+            self.t0 = time.time()
+
+    def add(self, name, cat, start, duration, args):
+        event = {"name": name, "cat": cat, "ph": "X",
+                 "ts": (start - self.t0) * 1e6, "dur": duration * 1e6,
+                 "pid": os.getpid(), "tid": threading.get_ident(), "args": args}
+        with self.lock:
+            self.events.append(event)
+        logging.info(f"[{cat}] {name}: {duration:.3f} s {args}")
+
+    @contextlib.contextmanager
+    def stage(self, name, cat="stage", **args):
+        """record the enclosed block; counters are process wide, so
+        concurrently running stages see each other's cpu and I/O"""
+        start  = time.time()
+        cpu0   = os.times()
+        wchar0, wbytes0 = io_counters()
+        try:
+            yield
+        finally:
+            cpu1 = os.times()
+            wchar1, wbytes1 = io_counters()
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            args.update(wall=time.time() - start,
+                        cpu=(cpu1.user - cpu0.user) + (cpu1.system - cpu0.system),
+                        children_cpu=(cpu1.children_user - cpu0.children_user)
+                                     + (cpu1.children_system - cpu0.children_system),
+                        # lifetime maximum over all children reaped so far
+                        children_peak_rss_kb=children.ru_maxrss,
+                        bytes_written=wchar1 - wchar0,
+                        storage_bytes_written=wbytes1 - wbytes0)
+            self.add(name, cat, start, args["wall"], args)
+
+    def write(self, filename):
+        with self.lock:
+            events = list(self.events)
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, indent=1)
+        return filename
+
+
+TRACER = Tracer()
+
+
+@contextlib.contextmanager
+def trace_to(directory, name=TRACE_FILE):
+    """start a fresh trace and write it to `directory`, also on failure"""
+    TRACER.reset()
+    try:
+        yield TRACER
+    finally:
+        os.makedirs(directory, exist_ok=True)
+        trace = TRACER.write(os.path.join(directory, name))
+        logging.info(f"Stage timings written to {trace}")
+
+
+def run_command(commands, cwd=None, stdout=subprocess.PIPE, stderr=None, name=None,
+                check=True, env=None):
+    """run `commands`, trace it with the resource usage of that child alone
+
+    Returns (returncode, stdout text or None); raises CalledProcessError
+    on failure when `check` is set, like subprocess.run.
+    """
+    name  = name or os.path.basename(str(commands[0]))
+    start = time.time()
+    p = subprocess.Popen(commands, cwd=cwd, stdout=stdout, stderr=stderr,
+                         universal_newlines=True, env=env)
+    out = p.stdout.read() if stdout == subprocess.PIPE else None
+    _, status, usage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    if p.stdout:
+        p.stdout.close()
+    TRACER.add(name, "subprocess", start, time.time() - start,
+               {"command": " ".join(map(str, commands)), "cwd": cwd,
+                "returncode": p.returncode,
+                "cpu": usage.ru_utime + usage.ru_stime,
+                "peak_rss_kb": usage.ru_maxrss,
+                "storage_bytes_written": usage.ru_oublock * 512})
+    if check and p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, commands, out)
+    return p.returncode, out
+
+
+def summarize(trace_files):
+    """per (category, name) count, total and mean wall time, cpu and peak RSS"""
+    table = {}
+    for fname in trace_files:
+        with open(fname) as f:
+            events = json.load(f)["traceEvents"]
+        for e in events:
+            row = table.setdefault((e["cat"], e["name"]),
+                                   {"count": 0, "wall": 0.0, "cpu": 0.0, "peak_rss_kb": 0})
+            a = e["args"]
+            row["count"] += 1
+            row["wall"]  += e["dur"] / 1e6
+            row["cpu"]   += a.get("cpu", 0.0) + a.get("children_cpu", 0.0)
+            row["peak_rss_kb"] = max(row["peak_rss_kb"],
+                                     a.get("peak_rss_kb", a.get("children_peak_rss_kb", 0)))
+    return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="aggregate workflow traces")
+    parser.add_argument("command", choices=["summarize"])
+    parser.add_argument("traces", nargs="+")
+    args = parser.parse_args()
+
+    files = [f for pattern in args.traces for f in glob.glob(pattern)]
+    table = summarize(files)
+    print(f"{len(files)} traces")
+    print("{:10s} {:40s} {:>6s} {:>12s} {:>10s} {:>12s} {:>12s}".format(
+        "category", "name", "count", "total wall", "mean wall", "cpu", "peak rss MB"))
+    for (cat, name), row in sorted(table.items(), key=lambda r: -r[1]["wall"]):
+        print("{:10s} {:40s} {:6d} {:12.1f} {:10.2f} {:12.1f} {:12.1f}".format(
+            cat, name[:40], row["count"], row["wall"], row["wall"] / row["count"],
+            row["cpu"], row["peak_rss_kb"] / 1024))